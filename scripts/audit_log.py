@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Structured per-record audit log (NDJSON)
+
+Every created, updated, skipped or failed record is written as one compact
+JSON object per line, e.g.
+
+    {"ts":1729330000.12,"event":"invoice_created","old_id":812,"new_id":95}
+
+Events go through a queue to a background writer (see log_setup), so
+recording them costs the import loop about as much as a dict build. When no
+audit file is open, event() does nothing.
+
+The file can be queried with jq, pandas.read_json(lines=True), or this
+script:
+
+Usage:
+    python audit_log.py import_invoices_20250101_120000_audit.ndjson --count
+    python audit_log.py audit.ndjson --event invoice_failed
+    python audit_log.py audit.ndjson --event client_created --where original_id=1042
+    python audit_log.py audit.ndjson --event payment_created --fields new_invoice_id,amount
+
+Options:
+    --event NAME      Only events of this type (repeatable)
+    --where K=V       Only events whose field K equals V (repeatable)
+    --fields A,B      Print only these fields, tab-separated
+    --count           Print the number of matching events per event type
+"""
+
+import argparse
+import json
+import logging
+import sys
+from collections import Counter
+
+_logger = logging.getLogger('audit')
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+
+
+class NDJSONFormatter(logging.Formatter):
+    """Formats audit records as one compact JSON object per line"""
+
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'event': record.msg}
+        entry.update(record.fields)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+def open_audit_file(path):
+    """Start writing audit events to path (NDJSON, appended; created on first event)"""
+    import log_setup
+
+    handler = log_setup.BufferedFileHandler(path, delay=True)
+    handler.setFormatter(NDJSONFormatter())
+    log_setup.start_queue_logger(_logger, [handler])
+
+
+def event(name, /, **fields):
+    """Record one structured event, e.g. event('client_created', original_id=1, new_id=2)"""
+    if _logger.handlers:
+        _logger.info(name, extra={'fields': fields})
+
+
+def read_events(path, events=None, where=None):
+    """Yield events from an NDJSON audit file, optionally filtered.
+
+    events is a collection of event names; where maps field -> value
+    (compared as strings so CLI filters match numeric ids).
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if events and entry.get('event') not in events:
+                continue
+            if where and any(str(entry.get(k)) != v for k, v in where.items()):
+                continue
+            yield entry
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query an NDJSON audit log written by the migration scripts',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('files', nargs='+', help='Audit file(s) to read')
+    parser.add_argument('--event', action='append', help='Only this event type (repeatable)')
+    parser.add_argument('--where', action='append', default=[], metavar='K=V',
+                        help='Only events with field K equal to V (repeatable)')
+    parser.add_argument('--fields', help='Comma-separated fields to print (tab-separated output)')
+    parser.add_argument('--count', action='store_true', help='Print counts per event type')
+    args = parser.parse_args()
+
+    where = {}
+    for condition in args.where:
+        if '=' not in condition:
+            parser.error(f"--where expects K=V, got: {condition}")
+        key, value = condition.split('=', 1)
+        where[key] = value
+
+    counts = Counter()
+    fields = args.fields.split(',') if args.fields else None
+    for path in args.files:
+        for entry in read_events(path, args.event, where):
+            if args.count:
+                counts[entry['event']] += 1
+            elif fields:
+                print('\t'.join(str(entry.get(name, '')) for name in fields))
+            else:
+                print(json.dumps(entry, separators=(',', ':')))
+
+    if args.count:
+        for name, count in counts.most_common():
+            print(f"{count:>8}  {name}")
+        print(f"{sum(counts.values()):>8}  total")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(0)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+UISP Migration Benchmark
+
+Runs each migration step against local mock UISP servers (see mock_uisp.py)
+with synthetic datasets (see generate_dataset.py) and reports throughput, request latency and peak
+memory per step. Results are appended to a history file and compared with
+the previous run of the same step/size so hot-path regressions stand out.
+
+Usage:
+    python benchmark.py                         # 1K dataset, all steps
+    python benchmark.py --sizes 1000,10000,100000
+    python benchmark.py --steps csv_parse,plan_matching --sizes 100000
+    python benchmark.py --latency-ms 30 --keep-delays   # closer to production pacing
+
+Steps (run in this order, each in a fresh process):
+    csv_parse       CSVParser over the synthetic McBroad CSV
+    plan_matching   find_service_plan_period_id for every service
+    client_import   ClientImporter.run into the "new" mock UISP
+    invoice_export  export_invoices from the "old" mock UISP
+    invoice_import  build_client_mapping + import_invoices into "new"
+    pppoe_sync      PPPoE mapping from "old" + PATCH services on "new"
+
+Options:
+    --sizes N,N     Dataset sizes in clients
+    --invoices-per-client N  Invoices generated per client (default: 1)
+    --steps A,B     Subset of steps to run
+    --latency-ms N  Latency added by the mock servers
+    --keep-delays   Keep the scripts' per-record REQUEST_DELAY pauses
+    --history FILE  Results history (default: benchmark_history.jsonl)
+    --threshold P   Flag regressions worse than P percent (default: 10)
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from queue import Empty
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from mock_uisp import DEFAULT_PLANS_FILE, MockUISPServer, MockUISPState, load_json  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+STEPS = ['csv_parse', 'plan_matching', 'client_import', 'invoice_export', 'invoice_import', 'pppoe_sync']
+
+DEFAULT_HISTORY_FILE = 'benchmark_history.jsonl'
+
+# --- step bodies (run inside the child process) -----------------------------
+
+def _step_csv_parse(ctx):
+    import import_clients
+    start = time.perf_counter()
+    clients = import_clients.CSVParser(ctx['csv']).parse()
+    return len(clients), time.perf_counter() - start
+
+
+def _step_plan_matching(ctx):
+    import import_clients
+    clients = import_clients.CSVParser(ctx['csv']).parse()
+    uisp = import_clients.UISPClient(ctx['new_url'], 'bench')
+    start = time.perf_counter()
+    uisp.get_service_plans()
+    services = [s for c in clients for s in c['services']]
+    for service in services:
+        uisp.find_service_plan_period_id(service['name'])
+    return len(services), time.perf_counter() - start
+
+
+def _step_client_import(ctx):
+    import import_clients
+    import_clients.REQUEST_DELAY = ctx['request_delay']['import_clients']
+    uisp = import_clients.UISPClient(ctx['new_url'], 'bench')
+    importer = import_clients.ClientImporter(uisp, import_clients.CSVParser(ctx['csv']))
+    start = time.perf_counter()
+    importer.run()
+    return importer.stats['clients_created'], time.perf_counter() - start
+
+
+def _step_invoice_export(ctx):
+    import import_invoices
+    api = import_invoices.UISPApi(ctx['old_url'], 'bench')
+    start = time.perf_counter()
+    invoices = import_invoices.export_invoices(api, ctx['invoice_export'])
+    return len(invoices), time.perf_counter() - start
+
+
+def _step_invoice_import(ctx):
+    import export_store
+    import import_invoices
+    import_invoices.REQUEST_DELAY = ctx['request_delay']['import_invoices']
+    api = import_invoices.UISPApi(ctx['new_url'], 'bench')
+    start = time.perf_counter()
+    invoices = export_store.load_records(ctx['invoice_export'])
+    mapping = import_invoices.build_client_mapping(api)
+    stats = import_invoices.import_invoices(api, invoices, mapping)
+    return stats['invoices_created'], time.perf_counter() - start
+
+
+def _step_pppoe_sync(ctx):
+    import import_pppoe
+    import_pppoe.REQUEST_DELAY = ctx['request_delay']['import_pppoe']
+    old_api = import_pppoe.UISPApi(ctx['old_url'], 'bench')
+    new_api = import_pppoe.UISPApi(ctx['new_url'], 'bench')
+    start = time.perf_counter()
+    pppoe_map = import_pppoe.build_pppoe_mapping(old_api)
+    client_map = import_pppoe.build_client_id_mapping(new_api)
+    service_map = import_pppoe.build_service_mapping(new_api)
+    stats = import_pppoe.import_pppoe(new_api, pppoe_map, client_map, service_map)
+    return stats['updated'], time.perf_counter() - start
+
+
+STEP_FUNCTIONS = {
+    'csv_parse': _step_csv_parse,
+    'plan_matching': _step_plan_matching,
+    'client_import': _step_client_import,
+    'invoice_export': _step_invoice_export,
+    'invoice_import': _step_invoice_import,
+    'pppoe_sync': _step_pppoe_sync,
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list (None if empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _peak_rss_kb():
+    """Peak resident memory of this process in KB.
+
+    VmHWM is per address space and resets on exec; ru_maxrss would carry
+    over the parent's high-water mark into the spawned step process.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS
+
+
+def _run_step_in_child(step, ctx, queue):
+    """Child process entry point: run one step and report its measurements"""
+    os.chdir(ctx['workdir'])  # Script logs, audit files and the retry queue land in the workdir
+    logging.disable(logging.INFO)  # Per-record progress lines would swamp the report
+
+    import metrics
+
+    try:
+        records, elapsed = STEP_FUNCTIONS[step](ctx)
+        error = None
+    except Exception as e:  # Report, don't hang the parent
+        records, elapsed, error = 0, 0.0, f"{type(e).__name__}: {e}"
+    except SystemExit as e:  # The scripts sys.exit() on fatal errors
+        records, elapsed, error = 0, 0.0, f"exited with status {e.code}"
+
+    latencies = [d for stats in metrics.collector.endpoints.values() for d in stats.durations]
+    peak_rss_kb = _peak_rss_kb()
+
+    queue.put({
+        'records': records,
+        'seconds': round(elapsed, 4),
+        'records_per_sec': round(records / elapsed, 1) if elapsed > 0 else None,
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'error': error,
+    })
+
+
+def _failed_result(error):
+    return {'records': 0, 'seconds': 0.0, 'records_per_sec': None, 'requests': 0,
+            'p50_ms': None, 'p99_ms': None, 'peak_rss_mb': None, 'error': error}
+
+
+def run_step(step, ctx):
+    """Run one step in a fresh interpreter so peak RSS is per step"""
+    mp = multiprocessing.get_context('spawn')
+    queue = mp.Queue()
+    process = mp.Process(target=_run_step_in_child, args=(step, ctx, queue))
+    process.start()
+    # Poll, so a child that dies without reporting (killed, crashed) doesn't hang us
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                try:
+                    result = queue.get(timeout=1)  # Reported just before exiting
+                except Empty:
+                    result = _failed_result(f"step process died (exit code {process.exitcode})")
+                break
+    process.join()
+    return result
+
+
+# --- results history ---------------------------------------------------------
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    history = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    history.append(json.loads(line))
+    return history
+
+
+def previous_result(history, step, size, latency_ms):
+    for entry in reversed(history):
+        if entry['step'] == step and entry['size'] == size and entry.get('latency_ms') == latency_ms:
+            return entry
+    return None
+
+
+def compare(result, previous, threshold):
+    """Return a short regression note comparing throughput and peak RSS"""
+    if not previous or not previous.get('records_per_sec') or not result.get('records_per_sec'):
+        return ''
+    notes = []
+    rate_change = (result['records_per_sec'] - previous['records_per_sec']) / previous['records_per_sec'] * 100
+    rss_change = (result['peak_rss_mb'] - previous['peak_rss_mb']) / previous['peak_rss_mb'] * 100
+    notes.append(f"rate {rate_change:+.0f}%")
+    notes.append(f"rss {rss_change:+.0f}%")
+    flag = rate_change < -threshold or rss_change > threshold
+    return f"{'REGRESSION ' if flag else ''}vs {previous.get('revision') or '?'}: {', '.join(notes)}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark migration steps against a local mock UISP',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--sizes', default='1000',
+                        help='Comma-separated dataset sizes (default: 1000)')
+    parser.add_argument('--steps', default=','.join(STEPS),
+                        help='Comma-separated steps to run')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Latency added by the mock servers per request')
+    parser.add_argument('--keep-delays', action='store_true',
+                        help="Keep the scripts' per-record REQUEST_DELAY pauses")
+    parser.add_argument('--invoices-per-client', type=int, default=1,
+                        help='Invoices generated per client')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for the synthetic dataset')
+    parser.add_argument('--history', default=DEFAULT_HISTORY_FILE,
+                        help='Results history file (JSON lines)')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Regression threshold in percent')
+    parser.add_argument('--keep-data', action='store_true',
+                        help='Keep the generated dataset directory')
+
+    args = parser.parse_args()
+
+    # Imported here so step processes don't pay for it in their peak RSS
+    from generate_dataset import generate_dataset
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    steps = [s.strip() for s in args.steps.split(',') if s.strip()]
+    unknown = [s for s in steps if s not in STEP_FUNCTIONS]
+    if unknown:
+        logger.error(f"Unknown step(s): {', '.join(unknown)}. Choose from: {', '.join(STEPS)}")
+        sys.exit(1)
+    steps = [s for s in STEPS if s in steps]  # Steps depend on each other's data - keep order
+
+    history = load_history(args.history)
+    revision = git_revision()
+    results = []
+
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix=f'uisp_bench_{size}_')
+        logger.info(f"=== Dataset: {size} clients ({workdir}) ===")
+        paths = generate_dataset(workdir, clients=size, seed=args.seed,
+                                 invoices_per_client=args.invoices_per_client)
+
+        plans = load_json(DEFAULT_PLANS_FILE)
+        old_server = MockUISPServer(
+            state=MockUISPState(plans=plans, clients=load_json(paths['old_clients']),
+                                services=load_json(paths['services']),
+                                invoices=load_json(paths['invoices'])),
+            latency_ms=args.latency_ms).start()
+        new_server = MockUISPServer(state=MockUISPState(plans=plans), latency_ms=args.latency_ms).start()
+
+        delays = {'import_clients': 0.0, 'import_invoices': 0.0, 'import_pppoe': 0.0}
+        if args.keep_delays:
+            delays = {'import_clients': 0.1, 'import_invoices': 0.05, 'import_pppoe': 0.05}
+
+        ctx = {
+            'workdir': workdir,
+            'csv': paths['csv'],
+            'invoice_export': os.path.join(workdir, 'new_invoices_export.json'),
+            'old_url': old_server.base_url,
+            'new_url': new_server.base_url,
+            'request_delay': delays,
+        }
+
+        try:
+            for step in steps:
+                result = run_step(step, ctx)
+                entry = dict(step=step, size=size, latency_ms=args.latency_ms, revision=revision,
+                             timestamp=datetime.now().isoformat(timespec='seconds'), **result)
+                note = compare(entry, previous_result(history, step, size, args.latency_ms), args.threshold)
+                if entry['error']:
+                    logger.error(f"{step:15} FAILED: {entry['error']}")
+                else:
+                    p50 = f"{entry['p50_ms']}ms" if entry['p50_ms'] is not None else '-'
+                    p99 = f"{entry['p99_ms']}ms" if entry['p99_ms'] is not None else '-'
+                    logger.info(
+                        f"{step:15} {entry['records']:>7} rec in {entry['seconds']:>8.2f}s | "
+                        f"{entry['records_per_sec'] or 0:>9.1f} rec/s | "
+                        f"p50 {p50:>8} p99 {p99:>8} | "
+                        f"RSS {entry['peak_rss_mb']:>6.1f} MB {note}"
+                    )
+                results.append(entry)
+        finally:
+            old_server.stop()
+            new_server.stop()
+            if not args.keep_data:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.history, 'a') as f:
+        for entry in results:
+            f.write(json.dumps(entry) + '\n')
+    logger.info(f"Results appended to {args.history}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Duplicate detection for parsed McBroad clients
+
+One pass over the parsed CSV builds hash indexes on normalized
+contact keys:
+
+    email          lower-cased, every address in the Emails column
+    phone          digits only, last 10 (so 0917..., +63917..., 63917... match)
+    pppoe          PPPoE username, case-insensitive
+    name_address   first + last name + street + city, case/punctuation-insensitive
+
+Clients sharing any key are grouped (transitively, via union-find); the
+first client of a group in CSV order is its primary. Keys shared by more
+than MAX_SHARED_KEY clients (an office phone, a reseller's e-mail) are
+ignored rather than collapsing unrelated accounts into one group.
+
+Actions (import_clients.py --dedupe):
+    flag   report duplicates, import everything (default)
+    skip   import only the primary of each group
+    merge  like skip, but first move the duplicates' services, contacts and
+           note onto the primary
+"""
+
+import re
+from collections import defaultdict
+
+DEDUPE_ACTIONS = ('flag', 'skip', 'merge')
+
+# A key shared by more clients than this is treated as a shared contact, not identity
+MAX_SHARED_KEY = 5
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+_NON_DIGIT = re.compile(r'\D+')
+
+
+def normalize_email(value):
+    value = (value or '').strip().lower()
+    return value if '@' in value and '.' in value.split('@')[-1] else None
+
+
+def normalize_phone(value):
+    digits = _NON_DIGIT.sub('', value or '')
+    if len(digits) < 7 or len(set(digits)) == 1:
+        return None  # empty, too short, or a placeholder like 0000000
+    return digits[-10:]
+
+
+def normalize_pppoe(value):
+    value = (value or '').strip().lower()
+    return value or None
+
+
+def normalize_name_address(client):
+    name = _NON_ALNUM.sub(' ', f"{client.get('firstName', '')} {client.get('lastName', '')}".lower()).split()
+    street = _NON_ALNUM.sub(' ', (client.get('street1') or '').lower()).split()
+    if not name or not street:
+        return None
+    city = _NON_ALNUM.sub(' ', (client.get('city') or '').lower()).split()
+    return ' '.join(name) + '|' + ' '.join(street) + '|' + ' '.join(city)
+
+
+def client_keys(client):
+    """(kind, normalized value) identity keys of a parsed client"""
+    keys = set()
+    for email in client.get('emails') or []:
+        email = normalize_email(email)
+        if email:
+            keys.add(('email', email))
+    for phone in client.get('phones') or []:
+        phone = normalize_phone(phone)
+        if phone:
+            keys.add(('phone', phone))
+    pppoe = normalize_pppoe(client.get('attributes', {}).get('pppoeUsername'))
+    if pppoe:
+        keys.add(('pppoe', pppoe))
+    name_address = normalize_name_address(client)
+    if name_address:
+        keys.add(('name_address', name_address))
+    return keys
+
+
+class DuplicateGroup:
+    """A primary client and the later clients that match it"""
+
+    __slots__ = ('primary', 'duplicates', 'matched_on')
+
+    def __init__(self, primary, duplicates, matched_on):
+        self.primary = primary
+        self.duplicates = duplicates
+        self.matched_on = matched_on  # sorted key kinds that linked the group
+
+    def to_dict(self):
+        return {
+            'primary': self.primary.get('original_id'),
+            'duplicates': [c.get('original_id') for c in self.duplicates],
+            'matched_on': self.matched_on,
+        }
+
+
+def find_duplicates(clients, max_shared=MAX_SHARED_KEY):
+    """Group clients that share an identity key; returns [DuplicateGroup] in CSV order"""
+    index = defaultdict(list)
+    for i, client in enumerate(clients):
+        for key in client_keys(client):
+            index[key].append(i)
+
+    parent = list(range(len(clients)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    links = []  # (kind, a client index) for every key that linked clients
+    for (kind, _), members in index.items():
+        if len(members) < 2 or len(members) > max_shared:
+            continue
+        links.append((kind, members[0]))
+        for other in members[1:]:
+            a, b = find(members[0]), find(other)
+            if a != b:
+                # The earlier client stays the root, so it becomes the primary
+                parent[max(a, b)] = min(a, b)
+
+    if not links:
+        return []
+
+    kinds = defaultdict(set)
+    for kind, i in links:
+        kinds[find(i)].add(kind)
+
+    members_of = defaultdict(list)
+    for i in range(len(clients)):
+        root = find(i)
+        if root in kinds:
+            members_of[root].append(i)
+
+    return [
+        DuplicateGroup(clients[members[0]], [clients[i] for i in members[1:]], sorted(kinds[root]))
+        for root, members in members_of.items()
+    ]
+
+
+def merge_into(primary, duplicate):
+    """Move a duplicate's services, contacts and note onto the primary"""
+    seen_services = {(s.get('name'), s.get('activeFrom')) for s in primary['services']}
+    for service in duplicate.get('services', []):
+        key = (service.get('name'), service.get('activeFrom'))
+        if key not in seen_services:
+            primary['services'].append(service)
+            seen_services.add(key)
+
+    seen_emails = {c.get('email', '').lower() for c in primary['contacts']}
+    for contact in duplicate.get('contacts', []):
+        if contact.get('email', '').lower() not in seen_emails:
+            primary['contacts'].append(contact)
+            seen_emails.add(contact.get('email', '').lower())
+
+    merged_note = f"Merged McBroad client {duplicate.get('original_id')}"
+    if duplicate.get('note'):
+        merged_note += f": {duplicate['note']}"
+    primary['note'] = f"{primary.get('note', '')}\n{merged_note}".strip()
+
+
+def apply_dedupe(groups, action):
+    """Mark duplicates (client['duplicateOf']) and merge them if asked.
+
+    Duplicates stay in the client list so --start/--limit indexes are the
+    same with or without deduplication; the importer skips marked ones.
+    """
+    if action == 'flag':
+        return
+    for group in groups:
+        primary_id = group.primary.get('original_id')
+        for duplicate in group.duplicates:
+            if action == 'merge':
+                merge_into(group.primary, duplicate)
+            duplicate['duplicateOf'] = primary_id
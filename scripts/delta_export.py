@@ -0,0 +1,133 @@
+"""
+Incremental (delta) exports of old-UISP collections
+
+A full export of /invoices or /clients/services re-reads every record. During
+the cutover only the tail changes: new invoices and services are appended
+(UISP lists them by ascending ID) and recent ones get paid, suspended or
+voided. After every complete export a small state file is saved next to
+it (invoices_export.delta.json for invoices_export.json) with the highest
+ID, the latest createdDate, the record count and a content hash per record.
+
+A delta run (--delta) then reads only the last `recheck` records plus
+everything after them:
+
+* records whose ID is not in the state are new and are appended;
+* records whose hash differs from the state changed and are replaced;
+* IDs inside the re-read range that are no longer returned were deleted
+  and are dropped.
+
+Changes to records older than the recheck window are not seen; a full
+export (without --delta) picks those up and resets the state.
+"""
+
+import hashlib
+import logging
+import os
+import time
+
+import export_store
+import json_codec
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Most recent records re-read (and compared by hash) on every delta run
+DEFAULT_RECHECK = 2000
+
+
+def state_path(export_file):
+    """Delta state file for an export: invoices_export.json -> invoices_export.delta.json"""
+    return os.path.splitext(export_file)[0] + '.delta.json'
+
+
+def record_hash(record):
+    return hashlib.blake2b(json_codec.dumps(record), digest_size=12).hexdigest()
+
+
+def load_state(export_file):
+    """The delta state saved with export_file, or None if there is none (or no export)"""
+    path = state_path(export_file)
+    if not os.path.exists(path) or not os.path.exists(export_file):
+        return None
+    return json_codec.load(path)
+
+
+def save_state(export_file, records, hashes=None):
+    """Record the high-water mark and content hashes of a complete export.
+
+    hashes ({str(id): hash}) can be passed when they are already known, so
+    records read back from the export file are not hashed again.
+    """
+    if hashes is None:
+        hashes = {str(r['id']): record_hash(r) for r in records if r.get('id') is not None}
+    created = [r['createdDate'] for r in records if r.get('createdDate')]
+    state = {
+        'max_id': max((int(i) for i in hashes), default=0),
+        'max_created': max(created, default=None),
+        'count': len(records),
+        'saved': time.time(),
+        'hashes': hashes,
+    }
+    json_codec.dump(state, state_path(export_file))
+    return state
+
+
+def fetch_tail(api, endpoint, start, page_size=500):
+    """Every record from offset start to the end of a paginated collection"""
+    records = []
+    offset = start
+    while True:
+        page = api.get(f'{endpoint}?limit={page_size}&offset={offset}')
+        records.extend(page)
+        offset += len(page)
+        if len(page) < page_size:
+            return records
+
+
+def diff_tail(state, tail):
+    """(new, changed, gone IDs, {str(id): hash} of the tail) against the saved state"""
+    hashes = state['hashes']
+    new, changed, tail_hashes = [], [], {}
+    for record in tail:
+        key = str(record['id'])
+        tail_hashes[key] = record_hash(record)
+        old_hash = hashes.get(key)
+        if old_hash is None:
+            new.append(record)
+        elif old_hash != tail_hashes[key]:
+            changed.append(record)
+
+    # Known IDs inside the re-read ID range that UISP no longer returns
+    low = min((r['id'] for r in tail if str(r['id']) in hashes), default=state['max_id'] + 1)
+    gone = {key for key in hashes if low <= int(key) <= state['max_id'] and key not in tail_hashes}
+    return new, changed, gone, tail_hashes
+
+
+def delta_export(api, endpoint, export_file, state, recheck=DEFAULT_RECHECK, page_size=500):
+    """Bring export_file up to date with the records new or changed since state.
+
+    Returns (records, new, changed): the merged record list (also written
+    back to export_file, with a new state) and the new and changed records.
+    """
+    start = max(0, state['count'] - recheck)
+    logger.info(f"Delta export of {endpoint}: re-reading from offset {start} "
+                f"(last export: {state['count']} records, max ID {state['max_id']}, "
+                f"latest created {state.get('max_created') or '?'})")
+    tail = fetch_tail(api, endpoint, start, page_size)
+    new, changed, gone, tail_hashes = diff_tail(state, tail)
+    logger.info(f"  Read {len(tail)} records: {len(new)} new, {len(changed)} changed, {len(gone)} deleted")
+
+    with profiling.phase('parse'):
+        records = export_store.load_records(export_file)
+    if changed or gone:
+        replacements = {record['id']: record for record in changed}
+        records = [replacements.get(r['id'], r) for r in records if str(r['id']) not in gone]
+    records.extend(new)
+
+    with profiling.phase('export_write'):
+        export_store.write_export(records, export_file)
+    hashes = {key: value for key, value in state['hashes'].items() if key not in gone}
+    hashes.update(tail_hashes)
+    save_state(export_file, records, hashes)
+    logger.info(f"  {export_file} now holds {len(records)} records")
+    return records, new, changed
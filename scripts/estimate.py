@@ -0,0 +1,168 @@
+"""
+Wall-clock estimates for dry runs
+
+A dry run counts what it would import. With --estimate it also measures the
+new UISP with a few read-only requests and projects how long the real run
+would take at several concurrency levels:
+
+1. Probe: N GET /organizations requests (default 20) one at a time, for the
+   latency of a lone request (p50/p95), then N more with as many in flight
+   as the highest concurrency level, for the throughput UISP sustains and
+   whether it starts answering 429 (rate limited). Probes bypass the retry
+   policy and the response cache, so slow answers and 429s are seen as-is.
+2. Plan: the requests each step would send (client and service POSTs,
+   invoice and payment POSTs, PPPoE PATCHes) and the script's pause per
+   record (REQUEST_DELAY).
+3. Project, per step and concurrency level c:
+
+       time = max((requests * latency + records * pause) / c,
+                  requests / measured throughput)
+
+   once with the p50 latency and once with the p95 latency.
+
+Creates and updates are usually slower than the GETs probed, so read the
+p50 figure as a lower bound. Steps that run one record at a time
+(import_clients.py) get the same figure at every level.
+"""
+
+import argparse
+import logging
+import time
+from collections import Counter
+
+from metrics import percentile
+from uisp_api import map_concurrent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLES = 20
+DEFAULT_LEVELS = (1, 2, 4, 8, 16)
+PROBE_ENDPOINT = '/organizations'
+
+# Rate limit headers some proxies in front of UISP send (case-insensitive)
+RATE_LIMIT_HEADERS = ('X-RateLimit-Limit', 'RateLimit-Limit', 'Retry-After')
+
+
+class Step:
+    """Requests one step of a run would send"""
+
+    __slots__ = ('name', 'requests', 'records', 'pause', 'concurrent')
+
+    def __init__(self, name, requests, records=0, pause=0.0, concurrent=True):
+        self.name = name
+        self.requests = requests
+        self.records = records      # Records that are followed by `pause` seconds
+        self.pause = pause
+        self.concurrent = concurrent
+
+    def seconds(self, latency, workers, throughput=None):
+        workers = workers if self.concurrent else 1
+        seconds = (self.requests * latency + self.records * self.pause) / workers
+        if throughput:
+            seconds = max(seconds, self.requests / throughput)
+        return seconds
+
+
+def levels_arg(value):
+    """argparse type for --estimate-concurrency: '1,4,16' -> (1, 4, 16)"""
+    try:
+        levels = tuple(sorted({int(v) for v in value.split(',') if v.strip()}))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a list of numbers: {value!r}")
+    if not levels:
+        raise argparse.ArgumentTypeError("no concurrency level given")
+    if levels[0] < 1:
+        raise argparse.ArgumentTypeError(f"concurrency levels must be 1 or more, got {levels[0]}")
+    return levels
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+
+class ProbeResult:
+    """Latencies of the one-at-a-time probes and throughput of the parallel ones"""
+
+    def __init__(self, serial, parallel, parallel_seconds, workers):
+        self.workers = workers
+        ok = [seconds for status, seconds, _ in serial if status == 200]
+        self.latencies = sorted(ok)
+        self.failed = Counter(status for status, _, _ in serial if status != 200)
+        parallel_ok = sum(1 for status, _, _ in parallel if status == 200)
+        self.parallel_latencies = sorted(seconds for status, seconds, _ in parallel if status == 200)
+        self.throughput = parallel_ok / parallel_seconds if parallel_ok and parallel_seconds > 0 else None
+        self.rate_limited = sum(1 for status, _, _ in serial + parallel if status == 429)
+        self.rate_limit_headers = {}
+        for _, _, headers in serial + parallel:
+            for name in RATE_LIMIT_HEADERS:
+                if headers and headers.get(name) is not None:
+                    self.rate_limit_headers.setdefault(name, headers.get(name))
+
+    @property
+    def p50(self):
+        return percentile(self.latencies, 50)
+
+    @property
+    def p95(self):
+        return percentile(self.latencies, 95)
+
+
+def probe(api, samples=DEFAULT_SAMPLES, workers=max(DEFAULT_LEVELS)):
+    """Send the probe requests (see the module docstring)"""
+    serial = [api.probe(PROBE_ENDPOINT) for _ in range(samples)]
+    started = time.perf_counter()
+    parallel = [result for _, result, _ in
+                map_concurrent(lambda _: api.probe(PROBE_ENDPOINT), range(samples), workers)]
+    return ProbeResult(serial, parallel, time.perf_counter() - started, workers)
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}ms" if seconds is not None else '?'
+
+
+def log_estimate(api, steps, samples=DEFAULT_SAMPLES, levels=DEFAULT_LEVELS):
+    """Probe api and log the projected wall-clock time of steps at each level"""
+    logger.info("\n" + "=" * 60)
+    logger.info(f"WALL-CLOCK ESTIMATE ({api.base_url})")
+    logger.info("=" * 60)
+    result = probe(api, samples, max(levels))
+    if not result.latencies:
+        failed = ', '.join(f"{status} x{count}" for status, count in result.failed.items())
+        logger.error(f"No probe request succeeded ({failed}): no estimate")
+        return None
+
+    logger.info(f"Probe: {samples}x GET {PROBE_ENDPOINT} one at a time: p50 {_ms(result.p50)}, "
+                f"p95 {_ms(result.p95)}" + (f", {sum(result.failed.values())} failed" if result.failed else ''))
+    if result.throughput:
+        logger.info(f"       {samples}x with {result.workers} in flight: "
+                    f"p50 {_ms(percentile(result.parallel_latencies, 50))}, "
+                    f"{result.throughput:.1f} req/s sustained")
+    if result.rate_limited:
+        logger.warning(f"Rate limited: {result.rate_limited} probe(s) answered 429; "
+                       f"projections are capped at the measured {result.throughput or 0:.1f} req/s")
+    for name, value in result.rate_limit_headers.items():
+        logger.info(f"       {name}: {value}")
+
+    logger.info("\nPlanned requests:")
+    for step in steps:
+        detail = f", {step.pause:.2f}s pause per record" if step.pause and step.records else ''
+        sequential = ', one at a time' if not step.concurrent else ''
+        logger.info(f"  {step.name:<12} {step.requests:>8}{detail}{sequential}")
+
+    logger.info("\nProjected time (p50 latency - p95 latency):")
+    projection = {}
+    for workers in levels:
+        low = sum(step.seconds(result.p50, workers, result.throughput) for step in steps)
+        high = sum(step.seconds(result.p95, workers, result.throughput) for step in steps)
+        projection[workers] = (low, high)
+        per_step = ', '.join(f"{step.name} {format_duration(step.seconds(result.p50, workers, result.throughput))}"
+                             for step in steps)
+        logger.info(f"  concurrency {workers:>3}: {format_duration(low):>7} - {format_duration(high):<7}"
+                    f" ({per_step})")
+    logger.info("=" * 60)
+    return projection
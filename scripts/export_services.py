@@ -10,6 +10,10 @@ Usage:
     2. python export_services.py --test       # Test with 10 services
     3. python export_services.py              # Full export
     4. python export_services.py --verbose    # Full export with per-record logging
+    5. python export_services.py --format parquet  # Columnar export (needs pyarrow)
+    6. python export_services.py --profile    # Phase timing + flame graph stacks
+    7. python export_services.py --plans-only # Service plans only (no services)
+    8. python export_services.py --delta      # Only new/changed services since the last export
 """
 
 import argparse
@@ -18,97 +22,30 @@ import logging
 import os
 import sys
 import time
-from collections import Counter
-from datetime import datetime
-
-import requests
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Configure logging
-log_file = f'export_services_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(log_file)
-    ]
-)
-logger = logging.getLogger(__name__)
 
+import delta_export
+import export_store
+import log_setup
+import metrics
+import profiling
+import staging
+from report_stats import StatsAggregator
+from uisp_api import UISPApi, client_options
 
-class UISPApi:
-    """Generic UISP CRM API client"""
-
-    def __init__(self, base_url, api_token, verify_ssl=False):
-        self.base_url = base_url.rstrip('/')
-        self.api_token = api_token
-        self.verify_ssl = verify_ssl
-        self.session = requests.Session()
-        self.session.headers.update({
-            'X-Auth-App-Key': api_token,
-            'Content-Type': 'application/json'
-        })
-
-    def _request(self, method, endpoint, data=None, retries=3):
-        url = f"{self.base_url}/crm/api/v1.0{endpoint}"
-        for attempt in range(retries):
-            try:
-                response = self.session.request(
-                    method, url, json=data,
-                    verify=self.verify_ssl, timeout=30
-                )
-
-                if response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 60))
-                    logger.warning(f"Rate limited. Waiting {retry_after}s...")
-                    time.sleep(retry_after)
-                    continue
-
-                if response.status_code >= 400:
-                    error_text = response.text[:500]
-                    raise Exception(
-                        f"HTTP {response.status_code}: {error_text}"
-                    )
-
-                return response.json() if response.text else {}
-
-            except requests.exceptions.ConnectionError as e:
-                if attempt < retries - 1:
-                    wait = 5 * (attempt + 1)
-                    logger.warning(f"Connection error, retrying in {wait}s... ({e})")
-                    time.sleep(wait)
-                else:
-                    raise
-
-        raise Exception(f"Failed after {retries} retries")
-
-    def get(self, endpoint):
-        return self._request('GET', endpoint)
-
-    def test_connection(self):
-        try:
-            try:
-                orgs = self.get('/organizations')
-                logger.info(f"Connected to {self.base_url} ({len(orgs)} org(s))")
-                return True
-            except Exception:
-                clients = self.get('/clients?limit=1')
-                logger.info(f"Connected to {self.base_url} (verified via clients endpoint)")
-                return True
-        except Exception as e:
-            logger.error(f"Connection failed to {self.base_url}: {e}")
-            return False
+logger = logging.getLogger(__name__)
 
+SERVICE_STATUS_NAMES = {0: 'Prepared', 1: 'Active', 2: 'Suspended', 3: 'Prepared blocked',
+                        4: 'Ended', 5: 'Quoted', 6: 'Obsolete', 7: 'Deferred', 8: 'Suspended (going to end)'}
 
-def export_service_plans(api, export_file='service_plans_export.json'):
+
+def export_service_plans(api, export_file='service_plans_export.json', stage=None):
     """Export all service plans (single call, ~74 records)"""
     logger.info("=== Exporting service plans from old UISP ===")
 
     plans = api.get('/service-plans')
     logger.info(f"Fetched {len(plans)} service plans")
+    if stage:
+        stage.replace_old('plan', plans)
 
     with open(export_file, 'w') as f:
         json.dump(plans, f, indent=2)
@@ -126,15 +63,34 @@ def export_service_plans(api, export_file='service_plans_export.json'):
     return plans
 
 
-def export_services(api, export_file='services_export.json', limit=None, offset=0, verbose=False):
-    """Export all client services with pagination"""
+def service_stats():
+    """Aggregator behind the services export report"""
+    return (StatsAggregator()
+            .count_by('status', 'status')
+            .count_by('plan', 'servicePlanId')
+            .first_label('plan_name', 'servicePlanId',
+                         lambda s: s.get('servicePlanName', s.get('name', '?')))
+            .count_if('with_attrs', lambda s: bool(s.get('attributes'))))
+
+
+def export_services(api, export_file='services_export.json', limit=None, offset=0, verbose=False,
+                    stage=None):
+    """Export all client services with pagination.
+
+    A complete export (no limit/offset, no failed page) also saves the
+    delta state used by --delta, and is staged in stage (a
+    staging.StagingDB) if given.
+    """
     logger.info("=== Exporting client services from old UISP ===")
 
+    stats = service_stats()
+
     all_services = []
     page_size = 500
     current_offset = offset
     total_exported = 0
     start_time = time.time()
+    complete = not limit and not offset
 
     while True:
         if limit and total_exported >= limit:
@@ -148,12 +104,14 @@ def export_services(api, export_file='services_export.json', limit=None, offset=
         except Exception as e:
             logger.error(f"Failed to fetch at offset {current_offset}: {e}")
             logger.info(f"Saved {total_exported} services so far. Resume with --offset {current_offset}")
+            complete = False
             break
 
         if not services:
             break
 
         all_services.extend(services)
+        stats.feed_many(services)
         total_exported += len(services)
         current_offset += len(services)
 
@@ -164,43 +122,44 @@ def export_services(api, export_file='services_export.json', limit=None, offset=
         if total_exported % 1000 == 0 or len(services) < batch_limit:
             elapsed = time.time() - start_time
             rate = total_exported / elapsed if elapsed > 0 else 0
-            logger.info(f"  Progress: {total_exported} services exported ({rate:.0f}/s)")
+            logger.info(f"  Progress: {total_exported} services exported ({rate:.0f}/s) | "
+                        f"API: {metrics.collector.progress_line()}")
 
         if len(services) < batch_limit:
             break
 
-    # Save to file
-    with open(export_file, 'w') as f:
-        json.dump(all_services, f)
+    # Save to file (JSON array or columnar Parquet/Feather, by extension)
+    with profiling.phase('export_write'):
+        export_store.write_export(all_services, export_file)
+        if complete:
+            delta_export.save_state(export_file, all_services)
+            if stage:
+                stage.replace_old('service', all_services)
 
     file_size_mb = os.path.getsize(export_file) / 1024 / 1024
     elapsed = time.time() - start_time
     logger.info(f"Exported {total_exported} services to {export_file} ({file_size_mb:.1f} MB) in {elapsed:.1f}s")
 
-    # Print stats
-    status_names = {0: 'Prepared', 1: 'Active', 2: 'Suspended', 3: 'Prepared blocked',
-                    4: 'Ended', 5: 'Quoted', 6: 'Obsolete', 7: 'Deferred', 8: 'Suspended (going to end)'}
-
-    status_counts = Counter(s.get('status', -1) for s in all_services)
+    # Print stats (all gathered in the single pass above)
     logger.info("\nService status distribution:")
-    for status, count in sorted(status_counts.items()):
-        logger.info(f"  {status_names.get(status, f'Unknown({status})')}: {count}")
+    for status, count in sorted(stats.counts('status').items()):
+        logger.info(f"  {SERVICE_STATUS_NAMES.get(status, f'Unknown({status})')}: {count}")
 
-    plan_counts = Counter(s.get('servicePlanId', -1) for s in all_services)
+    plan_counts = stats.counts('plan')
+    plan_names = stats.labels('plan_name')
     logger.info(f"\nServices by plan (top 10 of {len(plan_counts)}):")
     for plan_id, count in plan_counts.most_common(10):
-        plan_name = next((s.get('servicePlanName', s.get('name', '?'))
-                         for s in all_services if s.get('servicePlanId') == plan_id), '?')
-        logger.info(f"  Plan {plan_id} ({plan_name}): {count}")
+        logger.info(f"  Plan {plan_id} ({plan_names.get(plan_id, '?')}): {count}")
 
     # Check for PPPoE-related attributes
-    services_with_attrs = sum(1 for s in all_services if s.get('attributes'))
+    services_with_attrs = stats.count('with_attrs')
     logger.info(f"\nServices with custom attributes: {services_with_attrs}/{total_exported}")
 
     return all_services
 
 
 def main():
+    log_file = log_setup.start_run('export_services')
     parser = argparse.ArgumentParser(
         description='Export services and service plans from old UISP',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -216,8 +175,24 @@ def main():
                         help='Show each service record')
     parser.add_argument('--skip-plans', action='store_true',
                         help='Skip service plans export')
+    parser.add_argument('--plans-only', action='store_true',
+                        help='Export service plans only')
+    parser.add_argument('--format', choices=export_store.EXPORT_FORMATS, default='json',
+                        help='Services export file format (parquet/feather need pyarrow)')
+    parser.add_argument('--delta', action='store_true',
+                        help='Fetch only services new or changed since the last complete export')
+    parser.add_argument('--recheck', type=int, default=delta_export.DEFAULT_RECHECK,
+                        help='With --delta: most recent services to re-read for changes')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                        help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+
+    parser.add_argument('--profile', nargs='?', const='sample', choices=profiling.PROFILE_MODES,
+                        help='Profile the run: sample (flame graph stacks of every thread, default) or cprofile (main thread only)')
 
     args = parser.parse_args()
+    metrics.write_summary_at_exit(args.metrics_out)
+    if args.profile:
+        profiling.start(args.profile, 'export_services')
 
     # Load config
     try:
@@ -227,6 +202,10 @@ def main():
         logger.error("config.py not found. Ensure it exists in the scripts directory.")
         sys.exit(1)
 
+    if args.format in export_store.COLUMNAR_FORMATS and not export_store.columnar_available():
+        logger.error("pyarrow is required for parquet/feather exports (pip install pyarrow)")
+        sys.exit(1)
+
     old_url = getattr(config, 'OLD_UISP_BASE_URL', None)
     old_token = getattr(config, 'OLD_UISP_API_KEY', None)
     if not old_url or not old_token:
@@ -234,7 +213,7 @@ def main():
         sys.exit(1)
 
     # Connect
-    api = UISPApi(old_url, old_token, verify_ssl=False)
+    api = UISPApi(old_url, old_token, verify_ssl=False, **client_options(config))
     if not api.test_connection():
         logger.error("Cannot connect to old UISP. Check credentials.")
         sys.exit(1)
@@ -243,12 +222,29 @@ def main():
     if args.test:
         limit = 10
 
+    stage = staging.open_staging(config)
+
     # Export service plans
     if not args.skip_plans:
-        export_service_plans(api)
+        export_service_plans(api, stage=stage)
+
+    if args.plans_only:
+        logger.info("Done!")
+        return
 
     # Export services
-    export_services(api, limit=limit, offset=args.offset, verbose=args.verbose)
+    export_file = export_store.export_path('services_export.json', args.format)
+    state = delta_export.load_state(export_file) if args.delta else None
+    if state:
+        services, _, _ = delta_export.delta_export(api, '/clients/services', export_file, state,
+                                                   recheck=args.recheck)
+        if stage:
+            stage.replace_old('service', services)
+    else:
+        if args.delta:
+            logger.info(f"No previous export of {export_file} to update: doing a full export")
+        export_services(api, export_file, limit=limit, offset=args.offset, verbose=args.verbose,
+                        stage=stage)
 
     logger.info(f"\nLog file: {log_file}")
     logger.info("Done!")
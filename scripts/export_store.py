@@ -0,0 +1,344 @@
+"""
+Export file storage for UISP migration data
+
+Exports can be written either as the original JSON array or as a columnar
+file (Parquet or Feather/Arrow IPC). Columnar exports keep every top-level
+field as its own column so status distributions and totals are computed
+with vectorized column aggregations, and are read back memory-mapped.
+
+Nested fields (invoice items, payment covers, custom attributes, ...) are
+stored as JSON text columns and decoded again by load_records(), so a
+columnar export round-trips to the same records the JSON export holds.
+A field some records lack reads back as absent, not None: a null in a
+column listed as sparse (or in a JSON column, where an explicit null is
+the text 'null') means the key was missing.
+
+An NDJSON export (one record per line) is written with a sidecar index
+(invoices_export.ndjson.idx) holding each record's byte offset, id and
+clientId. open_indexed() memory-maps the file and decodes only the records
+asked for, so --resume-from N or one client's invoices need no full parse.
+
+Parquet/Feather support needs pyarrow (pip install pyarrow), imported only
+when a columnar file is written or read. JSON goes through json_codec
+(orjson when installed).
+"""
+
+import mmap
+import os
+from collections.abc import Sequence
+
+import json_codec
+from lazy_import import lazy_import
+
+pa = lazy_import('pyarrow')  # Optional dependency - JSON exports still work
+
+EXPORT_FORMATS = ('json', 'ndjson', 'parquet', 'feather')
+COLUMNAR_FORMATS = ('parquet', 'feather')
+
+_EXTENSIONS = {'json': '.json', 'ndjson': '.ndjson', 'parquet': '.parquet', 'feather': '.feather'}
+
+INDEX_SUFFIX = '.idx'
+
+# Schema metadata key listing the columns that hold JSON-encoded values
+_JSON_COLUMNS_KEY = b'uisp_json_columns'
+# ... and the scalar columns whose nulls are keys the record did not have
+_SPARSE_COLUMNS_KEY = b'uisp_sparse_columns'
+
+
+def columnar_available():
+    """True if pyarrow is installed and columnar exports can be used"""
+    return pa is not None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for parquet/feather exports (pip install pyarrow)")
+
+
+def format_from_path(path):
+    """Guess the export format from a file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    for fmt, fmt_ext in _EXTENSIONS.items():
+        if ext == fmt_ext:
+            return fmt
+    if ext in ('.arrow', '.ipc'):
+        return 'feather'
+    if ext == '.jsonl':
+        return 'ndjson'
+    return 'json'
+
+
+def export_path(path, fmt):
+    """Return path with its extension swapped for the given format"""
+    return os.path.splitext(path)[0] + _EXTENSIONS[fmt]
+
+
+def is_columnar(path):
+    return format_from_path(path) in COLUMNAR_FORMATS
+
+
+def records_to_table(records):
+    """Build an Arrow table with one column per top-level record field"""
+    _require_pyarrow()
+
+    # Keep first-seen key order so columns follow the API field order
+    columns = {}
+    for record in records:
+        for key in record:
+            if key not in columns:
+                columns[key] = None
+
+    arrays = []
+    names = []
+    json_columns = []
+    sparse_columns = []
+    for key in columns:
+        values = [record.get(key) for record in records]
+        nested = any(isinstance(v, (list, dict)) for v in values)
+        missing = any(key not in record for record in records)
+        # A scalar column can't tell a missing key from an explicit None
+        ambiguous = missing and any(key in record and record[key] is None for record in records)
+        array = None
+        if not nested and not ambiguous:
+            try:
+                array = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                array = None  # Mixed scalar types - fall back to JSON text
+        if array is None:
+            array = pa.array([json_codec.dumps_text(record[key]) if key in record else None for record in records],
+                             type=pa.string())
+            json_columns.append(key)
+        elif missing:
+            sparse_columns.append(key)
+        names.append(key)
+        arrays.append(array)
+
+    table = pa.Table.from_arrays(arrays, names=names)
+    return table.replace_schema_metadata({_JSON_COLUMNS_KEY: json_codec.dumps(json_columns),
+                                          _SPARSE_COLUMNS_KEY: json_codec.dumps(sparse_columns)})
+
+
+def write_export(records, path, fmt=None):
+    """Write records to path as JSON, NDJSON (plus its index), Parquet or Feather.
+
+    Returns the Arrow table for columnar formats (so callers can aggregate
+    over it without re-reading the file), or None for JSON/NDJSON.
+    """
+    fmt = fmt or format_from_path(path)
+
+    if fmt == 'json':
+        json_codec.dump(records, path)
+        return None
+    if fmt == 'ndjson':
+        write_ndjson(records, path)
+        return None
+
+    table = records_to_table(records)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    elif fmt == 'feather':
+        import pyarrow.feather as feather
+        # Uncompressed Arrow IPC so reads can be memory-mapped without copying
+        feather.write_feather(table, path, compression='uncompressed')
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+    return table
+
+
+def read_table(path):
+    """Open a columnar export as a memory-mapped Arrow table"""
+    _require_pyarrow()
+    fmt = format_from_path(path)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(path, memory_map=True)
+    if fmt == 'feather':
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True)
+    raise ValueError(f"Not a columnar export: {path}")
+
+
+def _columns_listed(table, metadata_key):
+    """Column names listed under a schema metadata key (see records_to_table)"""
+    return set(json_codec.loads((table.schema.metadata or {}).get(metadata_key, b'[]')))
+
+
+def table_to_records(table):
+    """Convert an Arrow table back into the list of API records"""
+    json_columns = _columns_listed(table, _JSON_COLUMNS_KEY)
+    sparse_columns = _columns_listed(table, _SPARSE_COLUMNS_KEY)
+
+    records = table.to_pylist()
+    if json_columns or sparse_columns:
+        for record in records:
+            for key in json_columns:
+                value = record.get(key)
+                if value is None:
+                    del record[key]     # The record had no such key
+                else:
+                    record[key] = json_codec.loads(value)
+            for key in sparse_columns:
+                if record.get(key) is None:
+                    del record[key]
+    return records
+
+
+def load_records(path):
+    """Load an export file (any format) as a list of record dicts"""
+    if is_columnar(path):
+        return table_to_records(read_table(path))
+    if format_from_path(path) == 'ndjson':
+        export = open_indexed(path)
+        try:
+            return export[:]
+        finally:
+            export.close()
+    return json_codec.load(path)
+
+
+# --- NDJSON with an offset index -------------------------------------------
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def _index_entry(record):
+    return record.get('id'), record.get('clientId')
+
+
+def _save_index(path, offsets, ids, client_ids):
+    json_codec.dump({'size': os.path.getsize(path), 'offsets': offsets, 'ids': ids,
+                     'client_ids': client_ids}, index_path(path))
+
+
+def write_ndjson(records, path):
+    """Write one record per line and the offset index next to it"""
+    offsets, ids, client_ids = [], [], []
+    position = 0
+    with open(path, 'wb') as f:
+        for record in records:
+            line = json_codec.dumps(record) + b'\n'
+            offsets.append(position)
+            record_id, client_id = _index_entry(record)
+            ids.append(record_id)
+            client_ids.append(client_id)
+            f.write(line)
+            position += len(line)
+    _save_index(path, offsets, ids, client_ids)
+
+
+def build_index(path):
+    """(Re)build the index of an NDJSON file written without one (one full pass)"""
+    offsets, ids, client_ids = [], [], []
+    position = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets.append(position)
+                record_id, client_id = _index_entry(json_codec.loads(line))
+                ids.append(record_id)
+                client_ids.append(client_id)
+            position += len(line)
+    _save_index(path, offsets, ids, client_ids)
+
+
+class IndexedExport(Sequence):
+    """An NDJSON export as a read-only sequence of records.
+
+    The file is memory-mapped; export[i], export[i:j], by_id() and
+    by_client() decode only the records they return.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = None
+        if os.path.exists(index_path(path)):
+            index = json_codec.load(index_path(path))
+        if index is None or index.get('size') != os.path.getsize(path):
+            build_index(path)  # missing, or the file changed since it was indexed
+            index = json_codec.load(index_path(path))
+        self.size = index['size']
+        self.offsets = index['offsets']
+        self.ids = index['ids']
+        self.client_ids = index['client_ids']
+        self._id_positions = None
+        self._client_positions = None
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+    def close(self):
+        if self.size:
+            self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _decode(self, position):
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.size
+        return json_codec.loads(self._map[self.offsets[position]:end])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._decode(position) for position in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self._decode(key)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self._decode(position)
+
+    def position_of(self, record_id):
+        """Ordinal of the record with this id (None if absent)"""
+        if self._id_positions is None:
+            self._id_positions = {record_id: n for n, record_id in enumerate(self.ids)}
+        return self._id_positions.get(record_id)
+
+    def by_id(self, record_id):
+        position = self.position_of(record_id)
+        return None if position is None else self._decode(position)
+
+    def by_client(self, client_id):
+        """All records of one client, in file order"""
+        if self._client_positions is None:
+            self._client_positions = {}
+            for n, value in enumerate(self.client_ids):
+                self._client_positions.setdefault(value, []).append(n)
+        return [self._decode(n) for n in self._client_positions.get(client_id, [])]
+
+
+def open_indexed(path):
+    """Memory-mapped, indexed view of an NDJSON export"""
+    return IndexedExport(path)
+
+
+def value_counts(table, column):
+    """Count rows per value of a column. Missing column/nulls count as -1."""
+    if column not in table.column_names:
+        return {-1: table.num_rows} if table.num_rows else {}
+    import pyarrow.compute as pc
+    counts = {}
+    for entry in pc.value_counts(table.column(column)).to_pylist():
+        value = entry['values']
+        if value is not None and column in _columns_listed(table, _JSON_COLUMNS_KEY):
+            value = json_codec.loads(value)
+        key = -1 if value is None else value
+        counts[key] = counts.get(key, 0) + entry['counts']
+    return counts
+
+
+def column_sum(table, column):
+    """Sum a numeric column, treating nulls (and a missing column) as 0"""
+    if column not in table.column_names or table.num_rows == 0:
+        return 0
+    if column in _columns_listed(table, _JSON_COLUMNS_KEY):
+        values = (json_codec.loads(v) for v in table.column(column).to_pylist() if v is not None)
+        return sum(v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool))
+    import pyarrow.compute as pc
+    total = pc.sum(table.column(column)).as_py()
+    return total or 0
+
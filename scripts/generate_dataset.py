@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Synthetic McBroad / UISP Dataset Generator
+
+Generates a McBroad-format client CSV plus matching old-UISP JSON exports
+(clients, services, invoices) at any size, for profiling the parser and
+importers beyond the one real export file. Output is deterministic for a
+given --seed.
+
+The CSV uses the same columns CSVParser reads and mimics the real export's
+quirks: multi-service clients (service rows with an empty Id), mixed date
+formats, prices written as "₱1,200.00", multiple emails/phones per client.
+
+Usage:
+    python generate_dataset.py --clients 1000
+    python generate_dataset.py --clients 100000 --invoices-per-client 12 --output-dir scale_100k
+    python generate_dataset.py --clients 10000 --format parquet
+
+Output files (in --output-dir):
+    clients.csv               McBroad client/service export
+    old_clients.json          Old UISP /clients (PPPoE username attribute id 1)
+    services_export.json      Old UISP /clients/services
+    invoices_export.json      Old UISP /invoices
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+import export_store
+
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLANS_FILE = os.path.join(SCRIPTS_DIR, 'service_plans_export.json')
+
+CSV_HEADERS = [
+    'Id', 'First name', 'Last name', 'Username', 'Company name', 'Is Lead', 'Emails', 'Phones',
+    'Street 1', 'Street 2', 'City', 'Country', 'State', 'ZIP code', 'Note', 'Registration date',
+    'Client latitude', 'Client longitude', 'PPPOE Username (custom attribute)',
+    'Facility (custom attribute)', 'Address (custom attribute)', 'NOTE (custom attribute)',
+    'Service', 'Service invoice label', 'Service note', 'Service active from (Y-m-d)',
+    'Service active to (Y-m-d)', 'Service invoicing from (Y-m-d)',
+    'Service contract type (open/closed)', 'Service invoicing type (backward/forward)',
+    'Service latitude', 'Service longitude', 'Service period (months)', 'Service individual price',
+]
+
+# Relative plan popularity, from the McBroad export counts (see README)
+PLAN_WEIGHTS = {
+    '03. SILVER 999': 2603, '02.  BRONZE 799': 2451, '01. SOLO PLAN': 1656,
+    '04. GOLD 1200': 1290, '05. PLATINUM 1400': 794, '06. DIAMOND 1600': 676,
+    '08. OLD 800': 175, '07. RUBY 2000': 153, 'DIA BGP TIM': 23, 'DIA BGP VM2': 19,
+    '23. OLD 1000': 9,
+}
+DEFAULT_PLAN_WEIGHT = 1
+
+# Old UISP service status codes (see export_services.SERVICE_STATUS_NAMES)
+SERVICE_STATUS_WEIGHTS = {1: 80, 2: 8, 3: 1, 4: 6, 0: 2, 6: 1, 8: 2}
+
+FIRST_NAMES = ['Juan', 'Maria', 'Jose', 'Ana', 'Mark', 'Kristine', 'John Paul', 'Ma. Cristina',
+               'Rodel', 'Jenny', 'Ramon', 'Liza', 'Carlo', 'Rowena', 'Noel', 'Ailene']
+LAST_NAMES = ['Dela Cruz', 'Santos', 'Reyes', 'Garcia', 'Mendoza', 'Bautista', 'Escueta',
+              'Villanueva', 'Ramos', 'Aquino', 'Castillo', 'Del Rosario', 'Pascual', 'Ocampo']
+STREETS = ['Rizal St', 'Mabini Ave', 'Aguinaldo Hwy', 'Bonifacio St', 'Luna St', 'Purok 3',
+           'Phase 2 Blk 5', 'Sitio Malinis']
+CITIES = ['Imus', 'Bacoor', 'Dasmariñas', 'General Trias', 'Kawit', 'Silang']
+FACILITIES = ['FTTH', 'Wireless', 'Fiber NAP 12', 'LOS 3']
+
+
+def _weighted_choice(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def _irregular_date(rng, day):
+    """A date in one of the formats seen in the real export (or unparseable/blank)"""
+    roll = rng.random()
+    if roll < 0.70:
+        return day.strftime('%Y-%m-%d')
+    if roll < 0.80:
+        return day.strftime('%Y-%m-%d') + f"T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+08:00"
+    if roll < 0.87:
+        return day.strftime('%Y-%m-%d') + f"T{rng.randint(0, 23):02d}:00:00"
+    if roll < 0.90:
+        return day.strftime('%d/%m/%Y')  # Not parsed by CSVParser - ends up as None
+    if roll < 0.93:
+        return f"  {day.strftime('%Y-%m-%d')} "
+    return ''
+
+
+def _price_text(rng, price):
+    """Individual price as typed in McBroad: mostly blank, otherwise ₱/comma formatted"""
+    roll = rng.random()
+    if roll < 0.85:
+        return ''
+    if roll < 0.92:
+        return f"₱{price:,.2f}"
+    if roll < 0.96:
+        return f"{price:,.0f}"
+    if roll < 0.98:
+        return f"₱ {price:.2f}"
+    return 'FREE'  # Not a number - ignored by the parser
+
+
+def _enabled_period(plan):
+    for period in plan.get('periods', []):
+        if period.get('enabled'):
+            return period
+    return None
+
+
+class DatasetGenerator:
+    """Deterministic generator for clients, services and invoices"""
+
+    def __init__(self, seed=42, plans=None, invoices_per_client=3, multi_service_ratio=0.04,
+                 start_id=1000):
+        self.rng = random.Random(seed)
+        if plans is None:
+            with open(PLANS_FILE, 'r') as f:
+                plans = json.load(f)
+        self.plans = [p for p in plans if _enabled_period(p)]
+        self.plan_weights = {i: PLAN_WEIGHTS.get(p['name'], DEFAULT_PLAN_WEIGHT)
+                             for i, p in enumerate(self.plans)}
+        self.invoices_per_client = invoices_per_client
+        self.multi_service_ratio = multi_service_ratio
+        self.next_client_id = start_id
+        self.next_service_id = 1
+        self.next_invoice_id = 1
+        self.invoice_number = 100000
+
+    def client(self):
+        """Return (csv_rows, old_client, services, invoices) for one client"""
+        rng = self.rng
+        client_id = self.next_client_id
+        self.next_client_id += 1
+
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        registered = date(2018, 1, 1) + timedelta(days=rng.randint(0, 2900))
+        pppoe = f"{first.split()[0].lower()}{client_id}"
+
+        emails = f"{first.split()[0].lower()}.{client_id}@example.com"
+        if rng.random() < 0.08:
+            emails += f", alt{client_id}@example.com"
+        elif rng.random() < 0.05:
+            emails = ''
+        phones = f"0917{rng.randint(0, 9999999):07d}"
+        if rng.random() < 0.10:
+            phones += f" / 0918{rng.randint(0, 9999999):07d}"
+
+        has_gps = rng.random() < 0.6
+        client_row = {
+            'Id': str(client_id),
+            'First name': first,
+            'Last name': last,
+            'Company name': f"{last} Trading" if rng.random() < 0.03 else '',
+            'Is Lead': '0',
+            'Emails': emails,
+            'Phones': phones,
+            'Street 1': f"{rng.randint(1, 999)} {rng.choice(STREETS)}",
+            'Street 2': f"Brgy. {rng.randint(1, 120)}" if rng.random() < 0.5 else '',
+            'City': rng.choice(CITIES),
+            'Country': 'Philippines' if rng.random() < 0.9 else '',
+            'ZIP code': str(rng.choice([4102, 4103, 4114, 4107, 4118])),
+            'Note': 'Relocated, see ticket' if rng.random() < 0.02 else '',
+            'Registration date': _irregular_date(rng, registered),
+            'Client latitude': f"{14.4 + rng.random() * 0.1:.6f}" if has_gps else '',
+            'Client longitude': f"{120.9 + rng.random() * 0.1:.6f}" if has_gps else '',
+            'PPPOE Username (custom attribute)': pppoe if rng.random() < 0.95 else '',
+            'Facility (custom attribute)': rng.choice(FACILITIES) if rng.random() < 0.4 else '',
+            'Address (custom attribute)': '',
+            'NOTE (custom attribute)': '',
+        }
+
+        service_count = 1
+        if rng.random() < self.multi_service_ratio:
+            service_count = rng.choice([2, 2, 2, 3])
+
+        rows = []
+        services = []
+        for n in range(service_count):
+            plan = self.plans[_weighted_choice(rng, self.plan_weights)]
+            period = _enabled_period(plan)
+            active_from = registered + timedelta(days=rng.randint(0, 30) + n * 200)
+            ended = rng.random() < 0.05
+            service_cells = {
+                'Service': plan['name'],
+                'Service invoice label': plan['name'] if rng.random() < 0.3 else '',
+                'Service note': '',
+                'Service active from (Y-m-d)': _irregular_date(rng, active_from),
+                'Service active to (Y-m-d)': _irregular_date(rng, active_from + timedelta(days=365)) if ended else '',
+                'Service invoicing from (Y-m-d)': _irregular_date(rng, active_from),
+                'Service contract type (open/closed)': 'open',
+                'Service invoicing type (backward/forward)': rng.choice(['forward', 'forward', 'backward']),
+                'Service latitude': client_row['Client latitude'],
+                'Service longitude': client_row['Client longitude'],
+                'Service period (months)': rng.choice(['1', '1', '1', '', '3']),
+                'Service individual price': _price_text(rng, period['price']),
+            }
+            if n == 0 and rng.random() < 0.5:
+                # Client row carries its first service inline
+                client_row.update(service_cells)
+            else:
+                rows.append(dict(service_cells))
+
+            status = 4 if ended else _weighted_choice(rng, SERVICE_STATUS_WEIGHTS)
+            services.append({
+                'id': self.next_service_id,
+                'clientId': client_id,
+                'servicePlanId': plan['id'],
+                'servicePlanName': plan['name'],
+                'servicePlanPeriodId': period['id'],
+                'name': plan['name'],
+                'price': period['price'],
+                'status': status,
+                'activeFrom': active_from.strftime('%Y-%m-%dT00:00:00+0800'),
+                'attributes': [],
+            })
+            self.next_service_id += 1
+
+        old_client = {
+            'id': client_id,
+            'userIdent': str(client_id),
+            'firstName': first,
+            'lastName': last,
+            'attributes': ([{'customAttributeId': 1, 'key': 'pppoeUsername', 'value': pppoe}]
+                           if client_row['PPPOE Username (custom attribute)'] else []),
+        }
+
+        invoices = self._invoices(client_id, services)
+        return [client_row] + rows, old_client, services, invoices
+
+    def _invoices(self, client_id, services):
+        rng = self.rng
+        invoices = []
+        month = date(2025, 12, 1)
+        for n in range(self.invoices_per_client):
+            created = date(month.year, month.month, 1)
+            items = [{'label': s['servicePlanName'], 'price': s['price'], 'quantity': 1, 'unit': None}
+                     for s in services]
+            total = round(sum(i['price'] for i in items), 2)
+            if n == 0:
+                status = rng.choice([1, 1, 2, 3, 3])  # Latest month is often still open
+            else:
+                status = rng.choices([3, 1, 2, 4], weights=[85, 7, 4, 4])[0]
+            amount_paid = {3: total, 2: round(total * rng.choice([0.25, 0.5]), 2)}.get(status, 0)
+            invoices.append({
+                'id': self.next_invoice_id,
+                'clientId': client_id,
+                'number': str(self.invoice_number),
+                'createdDate': created.strftime('%Y-%m-%dT00:00:00+0800'),
+                'maturityDays': 14,
+                'status': status,
+                'total': total,
+                'amountPaid': amount_paid,
+                'currencyCode': 'PHP',
+                'notes': None,
+                'items': items,
+                'paymentCovers': [{'amount': amount_paid}] if amount_paid else [],
+            })
+            self.next_invoice_id += 1
+            self.invoice_number += 1
+            month = (month.replace(day=1) - timedelta(days=1)).replace(day=1)
+        return invoices
+
+
+def generate_dataset(output_dir, clients=1000, seed=42, invoices_per_client=3,
+                     multi_service_ratio=0.04, fmt='json'):
+    """Write a synthetic dataset to output_dir and return the file paths"""
+    os.makedirs(output_dir, exist_ok=True)
+    generator = DatasetGenerator(seed=seed, invoices_per_client=invoices_per_client,
+                                 multi_service_ratio=multi_service_ratio)
+
+    paths = {
+        'csv': os.path.join(output_dir, 'clients.csv'),
+        'old_clients': os.path.join(output_dir, export_store.export_path('old_clients.json', fmt)),
+        'services': os.path.join(output_dir, export_store.export_path('services_export.json', fmt)),
+        'invoices': os.path.join(output_dir, export_store.export_path('invoices_export.json', fmt)),
+    }
+
+    old_clients = []
+    services = []
+    invoices = []
+    with open(paths['csv'], 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, restval='')
+        writer.writeheader()
+        for _ in range(clients):
+            rows, old_client, client_services, client_invoices = generator.client()
+            writer.writerows(rows)
+            old_clients.append(old_client)
+            services.extend(client_services)
+            invoices.extend(client_invoices)
+
+    export_store.write_export(old_clients, paths['old_clients'])
+    export_store.write_export(services, paths['services'])
+    export_store.write_export(invoices, paths['invoices'])
+
+    paths['counts'] = {'clients': len(old_clients), 'services': len(services), 'invoices': len(invoices)}
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic McBroad CSV and UISP JSON exports',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--clients', type=int, default=1000,
+                        help='Number of clients to generate')
+    parser.add_argument('--invoices-per-client', type=int, default=3,
+                        help='Monthly invoices per client')
+    parser.add_argument('--multi-service-ratio', type=float, default=0.04,
+                        help='Share of clients with 2-3 services')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed (same seed, same dataset)')
+    parser.add_argument('--output-dir', default='synthetic_dataset',
+                        help='Directory to write the files to')
+    parser.add_argument('--format', choices=export_store.EXPORT_FORMATS, default='json',
+                        help='Format for the JSON exports (parquet/feather need pyarrow)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.format in export_store.COLUMNAR_FORMATS and not export_store.columnar_available():
+        logger.error("pyarrow is required for parquet/feather exports (pip install pyarrow)")
+        sys.exit(1)
+
+    paths = generate_dataset(args.output_dir, clients=args.clients, seed=args.seed,
+                             invoices_per_client=args.invoices_per_client,
+                             multi_service_ratio=args.multi_service_ratio, fmt=args.format)
+
+    counts = paths['counts']
+    logger.info(f"Generated {counts['clients']} clients, {counts['services']} services, "
+                f"{counts['invoices']} invoices in {args.output_dir}/")
+    for key in ('csv', 'old_clients', 'services', 'invoices'):
+        size_mb = os.path.getsize(paths[key]) / 1024 / 1024
+        logger.info(f"  {paths[key]} ({size_mb:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -15,78 +15,53 @@ Options:
     --start N   Start importing from client number N (1-indexed)
     --limit N   Import only N clients
     --verbose   Show detailed progress
+    --dedupe flag|skip|merge  Handle duplicate clients in the CSV (default: flag = report only)
+    --estimate [N]  With --dry-run: probe the API with N reads (default: 20) and project the run time
+    --estimate-concurrency LIST  Concurrency levels to project (default: 1,2,4,8,16)
+    --priority  Import clients with active services first, then the most recent (see priority.py)
+    --retry-failed [all]  Replay clients/services from the retry queue instead of the CSV
+    --metrics-out FILE  Write per-endpoint request metrics (.json or .prom)
+    --profile [sample|cprofile]  Profile the run (phase table + flame graph stacks)
 """
 
 import argparse
 import csv
 import json
 import logging
+import re
 import sys
 import time
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
+from urllib.parse import quote
+
+import audit_log
+import client_dedupe
+import estimate
+import log_setup
+import metrics
+import payload_schema
+import priority
+import profiling
+import retry_queue
+import staging
+from report_stats import StatsAggregator
+from uisp_api import UISPApi, client_options
 
-import requests
-import urllib3
-
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(f'import_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Pause between records to avoid overwhelming the API (seconds)
+REQUEST_DELAY = 0.1
 
-class UISPClient:
+
+class UISPClient(UISPApi):
     """UISP CRM API Client"""
 
-    def __init__(self, base_url: str, api_token: str, verify_ssl: bool = False):
-        self.base_url = base_url.rstrip('/')
-        self.api_token = api_token
-        self.verify_ssl = verify_ssl
-        self.session = requests.Session()
-        self.session.headers.update({
-            'X-Auth-App-Key': api_token,
-            'Content-Type': 'application/json'
-        })
+    def __init__(self, base_url: str, api_token: str, verify_ssl: bool = False, **options):
+        super().__init__(base_url, api_token, verify_ssl, **options)
         self.service_plans = {}  # Cache for service plan mapping
 
-    def _request(self, method: str, endpoint: str, data: dict = None) -> dict:
-        """Make API request with error handling"""
-        url = f"{self.base_url}/crm/api/v1.0{endpoint}"
-        try:
-            response = self.session.request(
-                method,
-                url,
-                json=data,
-                verify=self.verify_ssl,
-                timeout=30
-            )
-
-            if response.status_code == 429:  # Rate limited
-                retry_after = int(response.headers.get('Retry-After', 60))
-                logger.warning(f"Rate limited. Waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                return self._request(method, endpoint, data)
-
-            response.raise_for_status()
-            return response.json() if response.text else {}
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API request failed: {method} {url}")
-            logger.error(f"Error: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Response: {e.response.text}")
-            raise
-
     def get_service_plans(self) -> dict:
         """Fetch all service plans and create name-to-period-id mapping"""
         if self.service_plans:
@@ -135,6 +110,11 @@ class UISPClient:
         logger.warning(f"No matching service plan found for: {service_name}")
         return None
 
+    def find_client_by_ident(self, user_ident: str) -> Optional[dict]:
+        """The client whose userIdent (original McBroad ID) is user_ident, if any"""
+        clients = self._request('GET', f'/clients?userIdent={quote(str(user_ident))}')
+        return clients[0] if clients else None
+
     def create_client(self, client_data: dict) -> dict:
         """Create a new client in UISP"""
         return self._request('POST', '/clients', client_data)
@@ -207,13 +187,13 @@ class CSVParser:
 
     def _parse_client_row(self, row: dict) -> dict:
         """Extract client data from CSV row"""
-        # Parse email (may be comma-separated)
-        emails = row.get('Emails', '').strip()
-        email = emails.split(',')[0].strip() if emails else ''
+        # Parse emails (may be comma-separated); the first is the contact email
+        emails = [e.strip() for e in row.get('Emails', '').split(',') if e.strip()]
+        email = emails[0] if emails else ''
 
-        # Parse phone (may have multiple separated by /)
-        phones = row.get('Phones', '').strip()
-        phone = phones.split('/')[0].strip() if phones else ''
+        # Parse phones (may have multiple separated by /)
+        phones = [p.strip() for p in row.get('Phones', '').split('/') if p.strip()]
+        phone = phones[0] if phones else ''
 
         # Parse coordinates
         lat = row.get('Client latitude', '').strip()
@@ -235,6 +215,9 @@ class CSVParser:
             'zipCode': row.get('ZIP code', '').strip(),
             'note': row.get('Note', '').strip(),
             'registrationDate': self._parse_date(row.get('Registration date', '')),
+            # All addresses/numbers, for duplicate detection
+            'emails': emails,
+            'phones': phones,
             # Custom attributes
             'attributes': {},
             'services': []
@@ -325,9 +308,11 @@ class CSVParser:
 
         date_str = date_str.strip()
 
-        # Try ISO format with timezone - keep as-is if already in correct format
+        # ISO format with timezone - UISP wants the offset as +0800, not +08:00 or Z
         if 'T' in date_str and ('+' in date_str or 'Z' in date_str):
-            return date_str
+            if date_str.endswith('Z'):
+                return date_str[:-1] + '+0000'
+            return re.sub(r'([+-]\d{2}):(\d{2})$', r'\1\2', date_str)
 
         # Try ISO format with timezone but extract and reformat
         if 'T' in date_str:
@@ -348,26 +333,76 @@ class CSVParser:
         return None
 
 
+class PreparedService:
+    """A parsed service with its plan period and checked payload"""
+
+    __slots__ = ('service', 'period_id', 'payload', 'errors')
+
+    def __init__(self, service, period_id, payload, errors):
+        self.service = service
+        self.period_id = period_id  # None when no UISP plan matches
+        self.payload = payload
+        self.errors = errors
+
+
+class PreparedClient:
+    """A parsed client with its checked payload and prepared services"""
+
+    __slots__ = ('client', 'payload', 'errors', 'services')
+
+    def __init__(self, client, payload, errors, services):
+        self.client = client
+        self.payload = payload
+        self.errors = errors
+        self.services = services
+
+
 class ClientImporter:
     """Orchestrates the import process"""
 
-    def __init__(self, uisp: UISPClient, parser: CSVParser):
+    def __init__(self, uisp: UISPClient, parser: CSVParser, queue: retry_queue.RetryQueue = None,
+                 stage: staging.StagingDB = None):
         self.uisp = uisp
         self.parser = parser
+        self.queue = queue  # failed records go here for --retry-failed
+        self.stage = stage  # parsed CSV, new IDs and per-record outcomes
         self.stats = {
             'clients_created': 0,
             'clients_failed': 0,
             'services_created': 0,
             'services_failed': 0,
-            'services_no_plan': 0
+            'services_no_plan': 0,
+            'clients_duplicate': 0,
+            'clients_invalid': 0,
+            'services_invalid': 0,
+            'clients_already_imported': 0
         }
         self.failed_clients = []
         self.plan_mismatches = set()
 
-    def run(self, dry_run: bool = False, start: int = 0, limit: int = None, verbose: bool = False):
+    def run(self, dry_run: bool = False, start: int = 0, limit: int = None, verbose: bool = False,
+            dedupe: str = 'flag', prioritize: bool = False,
+            status_order=priority.DEFAULT_SERVICE_STATUSES):
         """Run the import process"""
-        # Parse CSV
-        clients = self.parser.parse()
+        # Parse CSV (or reuse the staged parse of the same file)
+        with profiling.phase('parse'):
+            clients = self._parse()
+
+        # Find duplicates over the whole CSV, so batches (--start/--limit) agree
+        with profiling.phase('dedupe'):
+            self.duplicate_groups = client_dedupe.find_duplicates(clients)
+            client_dedupe.apply_dedupe(self.duplicate_groups, dedupe)
+        self._report_duplicates(dedupe, dry_run)
+        if self.stage and not dry_run:
+            # import_invoices.py maps skipped duplicates to their primary's new client
+            self.stage.replace_duplicates({c['original_id']: c['duplicateOf']
+                                           for c in clients if c.get('duplicateOf')})
+
+        # Most important clients first; start/limit then count in that order
+        if prioritize:
+            with profiling.phase('priority'):
+                clients = priority.order_clients(clients, priority.load_service_statuses(self.stage),
+                                                 status_order)
 
         # Apply start/limit
         if start > 0:
@@ -380,8 +415,9 @@ class ClientImporter:
 
         if dry_run:
             logger.info("DRY RUN MODE - No API calls will be made")
-            self._dry_run_report(clients)
-            return
+            # Plans are not fetched, so only plan-independent fields are checked
+            self._report_invalid(self._prepare(clients, resolve_plans=False))
+            return self._dry_run_report(clients)
 
         # Fetch service plans
         try:
@@ -391,34 +427,278 @@ class ClientImporter:
             logger.info("Available plans will need to be created in UISP first")
             return
 
-        # Import clients
-        for i, client in enumerate(clients, 1):
+        # Build and check every payload before the first request
+        prepared = self._prepare(clients)
+        self._report_invalid(prepared)
+        self._import_prepared(prepared, verbose)
+        self._print_summary()
+
+    def _parse(self) -> list:
+        """Parsed CSV clients, from the staging DB when it holds this exact file"""
+        csv_path = self.parser.csv_path
+        if self.stage and self.stage.csv_current(csv_path):
+            clients = self.stage.csv_clients()
+            logger.info(f"Loaded {len(clients)} parsed clients of {csv_path} from {self.stage.path}")
+            return clients
+        clients = self.parser.parse()
+        if self.stage:
+            self.stage.save_csv(csv_path, clients)
+        return clients
+
+    def retry_failed(self, mode: str = 'transient', verbose: bool = False):
+        """Replay queued clients and services (--retry-failed)"""
+        kinds = ('client', 'service')
+        entries = self.queue.due(kinds, mode)
+        retry_queue.log_replay_start(self.queue, entries, kinds, mode)
+        if not entries:
+            return
+
+        try:
+            self.uisp.get_service_plans()
+        except Exception as e:
+            logger.error(f"Failed to fetch service plans: {e}")
+            return
+
+        client_entries = [e for e in entries if e.kind == 'client']
+        if client_entries:
+            # A POST that timed out or got a 5xx may still have created the client
+            existing = {}
+            replayable = []
+            for entry in client_entries:
+                if entry.category in retry_queue.AMBIGUOUS:
+                    try:
+                        found = self.uisp.find_client_by_ident(entry.key)
+                    except Exception as e:
+                        # Can't tell whether it exists; leave it queued
+                        self.queue.add('client', entry.key, entry.record, e)
+                        continue
+                    if found:
+                        existing[entry.key] = found['id']
+                replayable.append(entry.record)
+            prepared = self._prepare(replayable)
+            self._report_invalid(prepared)
+            self._import_prepared(prepared, verbose, existing)
+
+        period_ids = set(self.uisp.service_plans.values())
+        for entry in entries:
+            if entry.kind != 'service':
+                continue
+            prepared_service = self._prepare_service(entry.record['service'], period_ids)
+            if self._create_service(entry.record['client_id'], prepared_service, verbose,
+                                    entry.record.get('original_id')):
+                self.queue.resolve('service', entry.key)
+
+        self._print_summary()
+
+    def _import_prepared(self, prepared: list, verbose: bool = False, existing: dict = None):
+        """Send prepared clients (and their services) in order.
+
+        existing maps original IDs to clients already in UISP (replay of a
+        request that may have succeeded); only their services are created.
+        """
+        total = len(prepared)
+        # Clients an earlier run created (replays decide that with existing instead)
+        done = self.stage.done_keys('client') if self.stage and existing is None else set()
+        for i, entry in enumerate(prepared, 1):
+            client = entry.client
+            original_id = client.get('original_id')
+            if str(original_id) in done:
+                self.stats['clients_already_imported'] += 1
+                if verbose:
+                    logger.info(f"Skipping client {original_id} (already imported)")
+                continue
+
+            if client.get('duplicateOf'):
+                self.stats['clients_duplicate'] += 1
+                audit_log.event('client_skipped', original_id=original_id,
+                                reason='duplicate', duplicate_of=client['duplicateOf'])
+                if verbose:
+                    logger.info(f"Skipping client {original_id} "
+                                f"(duplicate of {client['duplicateOf']})")
+                continue
+
+            if entry.errors:
+                self.stats['clients_invalid'] += 1
+                audit_log.event('client_invalid', original_id=original_id, errors=entry.errors)
+                self._record_failed_client(client, 'Invalid payload: ' + '; '.join(entry.errors), 'invalid')
+                continue
+
             try:
-                self._import_client(client, verbose)
+                self._import_client(entry, verbose, (existing or {}).get(original_id))
+                if self.queue and existing is not None:
+                    self.queue.resolve('client', original_id)
 
                 if i % 50 == 0:
-                    logger.info(f"Progress: {i}/{total} clients processed")
+                    logger.info(f"Progress: {i}/{total} clients processed | "
+                                f"API: {metrics.collector.progress_line()}")
 
             except KeyboardInterrupt:
                 logger.info("Import interrupted by user")
                 break
             except Exception as e:
-                logger.error(f"Failed to import client {client.get('original_id')}: {e}")
+                logger.error(f"Failed to import client {original_id}: {e}")
                 self.stats['clients_failed'] += 1
-                self.failed_clients.append({
-                    'original_id': client.get('original_id'),
-                    'name': f"{client.get('firstName')} {client.get('lastName')}",
-                    'error': str(e)
-                })
+                audit_log.event('client_failed', original_id=original_id, error=str(e)[:200])
+                self._record_failed_client(client, e)
 
             # Small delay to avoid overwhelming API
-            time.sleep(0.1)
-
-        self._print_summary()
+            with profiling.phase('throttle'):
+                time.sleep(REQUEST_DELAY)
+
+    def _record_failed_client(self, client: dict, error, category: str = None):
+        """Remember a failed client for the summary and queue it for --retry-failed"""
+        self.failed_clients.append({
+            'original_id': client.get('original_id'),
+            'name': f"{client.get('firstName')} {client.get('lastName')}",
+            'error': str(error)
+        })
+        if self.queue:
+            self.queue.add('client', client.get('original_id'), client, error, category)
+        if self.stage:
+            self.stage.record('client', client.get('original_id'), category or 'failed', error=error)
+
+    def _prepare(self, clients: list, resolve_plans: bool = True) -> list:
+        """Build and validate the client and service payloads of every client.
+
+        Runs entirely locally (plans are already cached), so a whole batch is
+        checked before the first POST and invalid records are never sent.
+        Duplicates skipped by --dedupe get no payload.
+        """
+        period_ids = set(self.uisp.service_plans.values()) if resolve_plans else None
+        prepared = []
+        for client in clients:
+            if client.get('duplicateOf'):
+                prepared.append(PreparedClient(client, None, [], []))
+                continue
+
+            with profiling.phase('payload_build'):
+                payload = self._build_client_payload(client)
+            with profiling.phase('validate'):
+                errors = payload_schema.validate_client(payload)
+
+            services = [self._prepare_service(service, period_ids, resolve_plans)
+                        for service in client.get('services', [])]
+            prepared.append(PreparedClient(client, payload, errors, services))
+        return prepared
+
+    def _prepare_service(self, service: dict, period_ids: set, resolve_plans: bool = True) -> PreparedService:
+        """Resolve the plan of a service and build and validate its payload"""
+        period_id = None
+        if resolve_plans:
+            with profiling.phase('plan_resolve'):
+                period_id = self.uisp.find_service_plan_period_id(service['name'])
+            if not period_id:
+                return PreparedService(service, None, None, [])
+        with profiling.phase('payload_build'):
+            payload = self._build_service_payload(service, period_id)
+        with profiling.phase('validate'):
+            errors = payload_schema.validate_service(payload, period_ids)
+        return PreparedService(service, period_id, payload, errors)
+
+    def _report_invalid(self, prepared: list):
+        """Log the payloads that failed validation (they will not be sent)"""
+        invalid_clients = [p for p in prepared if p.errors]
+        invalid_services = [(p, s) for p in prepared if not p.errors for s in p.services if s.errors]
+        if not invalid_clients and not invalid_services:
+            logger.info("Payload check: all client and service payloads are valid")
+            return
 
-    def _import_client(self, client: dict, verbose: bool = False):
+        logger.info(f"Payload check: {len(invalid_clients)} clients and {len(invalid_services)} "
+                    f"services have invalid payloads and will not be sent")
+        for p in invalid_clients[:10]:
+            logger.info(f"  Client {p.client.get('original_id')}: {'; '.join(p.errors)}")
+        for p, s in invalid_services[:10]:
+            logger.info(f"  Service '{s.service.get('name')}' of client "
+                        f"{p.client.get('original_id')}: {'; '.join(s.errors)}")
+        if len(invalid_clients) > 10 or len(invalid_services) > 10:
+            logger.info("  ... (every invalid record is in the audit log)")
+
+    def _import_client(self, prepared: PreparedClient, verbose: bool = False, existing_id: int = None):
         """Import a single client with their services"""
-        # Build client payload for UISP API
+        client = prepared.client
+
+        if existing_id:
+            new_client_id = existing_id
+            logger.info(f"Client {client.get('original_id')} already exists as {existing_id}; "
+                        f"creating its services only")
+            if self.stage:
+                self.stage.record('client', client.get('original_id'), 'created', existing_id)
+        else:
+            if verbose:
+                logger.info(f"Creating client: {client['firstName']} {client['lastName']}")
+
+            # Create client
+            response = self.uisp.create_client(prepared.payload)
+            new_client_id = response.get('id')
+
+            if not new_client_id:
+                raise Exception("No client ID returned from API")
+
+            self.stats['clients_created'] += 1
+            audit_log.event('client_created', original_id=client.get('original_id'), new_id=new_client_id)
+            if self.stage:
+                self.stage.record('client', client.get('original_id'), 'created', new_client_id)
+
+            if verbose:
+                logger.info(f"  Created client ID: {new_client_id}")
+
+        # Create services
+        for prepared_service in prepared.services:
+            self._create_service(new_client_id, prepared_service, verbose, client.get('original_id'))
+
+    def _create_service(self, client_id: int, prepared: PreparedService, verbose: bool = False,
+                        original_id: str = None) -> bool:
+        """Create a prepared service; a service that can't be created is queued"""
+        service = prepared.service
+        if not prepared.period_id:
+            self.stats['services_no_plan'] += 1
+            self.plan_mismatches.add(service['name'])
+            logger.warning(f"  No plan found for service: {service['name']}")
+            audit_log.event('service_skipped', client_id=client_id, name=service['name'],
+                            reason='no matching plan')
+            self._queue_service(client_id, original_id, service, 'No matching service plan', 'no_plan')
+            return False
+        if prepared.errors:
+            self.stats['services_invalid'] += 1
+            audit_log.event('service_invalid', client_id=client_id, name=service['name'],
+                            errors=prepared.errors)
+            self._queue_service(client_id, original_id, service, '; '.join(prepared.errors), 'invalid')
+            return False
+
+        try:
+            if verbose:
+                logger.info(f"  Creating service: {service['name']} (period ID: {prepared.period_id})")
+            response = self.uisp.create_service(client_id, prepared.payload)
+        except Exception as e:
+            logger.warning(f"  Failed to create service '{service.get('name')}': {e}")
+            self.stats['services_failed'] += 1
+            audit_log.event('service_failed', client_id=client_id,
+                            name=service.get('name'), error=str(e)[:200])
+            self._queue_service(client_id, original_id, service, e)
+            return False
+
+        self.stats['services_created'] += 1
+        audit_log.event('service_created', client_id=client_id, name=service['name'],
+                        new_id=response.get('id'))
+        if self.stage and response.get('id'):
+            self.stage.record('service', self._service_key(client_id, service), 'created', response['id'])
+            self.stage.add_new_services([dict(response, clientId=client_id)])
+        return True
+
+    @staticmethod
+    def _service_key(client_id: int, service: dict) -> str:
+        return f"{client_id}:{service.get('name')}:{service.get('activeFrom') or ''}"
+
+    def _queue_service(self, client_id: int, original_id: str, service: dict, error, category: str = None):
+        key = self._service_key(client_id, service)
+        if self.queue:
+            record = {'client_id': client_id, 'original_id': original_id, 'service': service}
+            self.queue.add('service', key, record, error, category)
+        if self.stage:
+            self.stage.record('service', key, category or 'failed', error=error)
+
+    def _build_client_payload(self, client: dict) -> dict:
+        """Build the UISP client payload from a parsed CSV client"""
         payload = {
             'firstName': client['firstName'],
             'lastName': client['lastName'],
@@ -455,39 +735,10 @@ class ClientImporter:
             pppoe_note = f"PPPoE: {pppoe_username}"
             payload['note'] = f"{existing_note}\n{pppoe_note}".strip() if existing_note else pppoe_note
 
-        if verbose:
-            logger.info(f"Creating client: {client['firstName']} {client['lastName']}")
-
-        # Create client
-        response = self.uisp.create_client(payload)
-        new_client_id = response.get('id')
-
-        if not new_client_id:
-            raise Exception("No client ID returned from API")
-
-        self.stats['clients_created'] += 1
-
-        if verbose:
-            logger.info(f"  Created client ID: {new_client_id}")
-
-        # Create services
-        for service in client.get('services', []):
-            try:
-                self._import_service(new_client_id, service, verbose)
-            except Exception as e:
-                logger.warning(f"  Failed to create service '{service.get('name')}': {e}")
-                self.stats['services_failed'] += 1
-
-    def _import_service(self, client_id: int, service: dict, verbose: bool = False):
-        """Import a service for a client"""
-        period_id = self.uisp.find_service_plan_period_id(service['name'])
-
-        if not period_id:
-            self.stats['services_no_plan'] += 1
-            self.plan_mismatches.add(service['name'])
-            logger.warning(f"  No plan found for service: {service['name']}")
-            return
+        return payload
 
+    def _build_service_payload(self, service: dict, period_id: int) -> dict:
+        """Build the UISP service payload for a parsed CSV service"""
         # UISP API requires servicePlanPeriodId (not servicePlanId)
         payload = {
             'servicePlanPeriodId': period_id,
@@ -505,22 +756,47 @@ class ClientImporter:
         if service.get('addressGpsLon'):
             payload['addressGpsLon'] = service['addressGpsLon']
 
-        if verbose:
-            logger.info(f"  Creating service: {service['name']} (period ID: {period_id})")
-
-        self.uisp.create_service(client_id, payload)
-        self.stats['services_created'] += 1
+        return payload
 
-    def _dry_run_report(self, clients: list):
-        """Generate report for dry run"""
-        services_by_plan = {}
-        total_services = 0
+    def _report_duplicates(self, action: str, dry_run: bool):
+        """Log duplicate groups and save them to duplicates_<timestamp>.json"""
+        groups = self.duplicate_groups
+        if not groups:
+            logger.info("Duplicate check: no duplicate clients found")
+            return
 
+        duplicates = sum(len(g.duplicates) for g in groups)
+        by_kind = StatsAggregator().count_by('kind', lambda kind: kind)
+        for group in groups:
+            by_kind.feed_many(group.matched_on)
+        verb = {'flag': 'flagged only, all will be imported',
+                'skip': 'will be skipped',
+                'merge': 'will be merged into their primary'}[action]
+        logger.info(f"Duplicate check: {duplicates} duplicate clients in {len(groups)} groups ({verb})")
+        logger.info("  Matched on: " + ', '.join(f"{kind} {count}" for kind, count in
+                                                 by_kind.counts('kind').most_common()))
+        for group in groups[:10]:
+            logger.info(f"  {group.primary.get('original_id')} <- "
+                        f"{', '.join(str(c.get('original_id')) for c in group.duplicates)} "
+                        f"({', '.join(group.matched_on)})")
+        if len(groups) > 10:
+            logger.info(f"  ... and {len(groups) - 10} more groups")
+
+        duplicates_file = f'duplicates_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+        with open(duplicates_file, 'w') as f:
+            json.dump([g.to_dict() for g in groups], f, indent=2)
+        logger.info(f"  Duplicate groups saved to: {duplicates_file}")
+        if action == 'flag' and not dry_run:
+            logger.info("  Use --dedupe skip or --dedupe merge to avoid creating duplicate accounts")
+
+    def _dry_run_report(self, clients: list) -> list:
+        """Generate report for dry run; returns the planned requests (estimate.Step list)"""
+        clients = [c for c in clients if not c.get('duplicateOf')]
+        plan_stats = StatsAggregator().count_by('plan', lambda s: s.get('name', 'Unknown'))
         for client in clients:
-            for service in client.get('services', []):
-                plan_name = service.get('name', 'Unknown')
-                services_by_plan[plan_name] = services_by_plan.get(plan_name, 0) + 1
-                total_services += 1
+            plan_stats.feed_many(client.get('services', []))
+        services_by_plan = plan_stats.counts('plan')
+        total_services = plan_stats.records
 
         logger.info("\n" + "="*60)
         logger.info("DRY RUN REPORT")
@@ -543,6 +819,11 @@ class ClientImporter:
             for svc in sample.get('services', []):
                 logger.info(f"    - {svc['name']}")
 
+        # One client at a time: POST /clients, a POST per service, then the pause
+        return [estimate.Step('clients', len(clients), records=len(clients), pause=REQUEST_DELAY,
+                              concurrent=False),
+                estimate.Step('services', total_services, concurrent=False)]
+
     def _print_summary(self):
         """Print import summary"""
         logger.info("\n" + "="*60)
@@ -553,6 +834,18 @@ class ClientImporter:
         logger.info(f"Services created:    {self.stats['services_created']}")
         logger.info(f"Services failed:     {self.stats['services_failed']}")
         logger.info(f"Services (no plan):  {self.stats['services_no_plan']}")
+        if self.stats['clients_invalid'] or self.stats['services_invalid']:
+            logger.info(f"Invalid (not sent):  {self.stats['clients_invalid']} clients, "
+                        f"{self.stats['services_invalid']} services")
+        if self.stats['clients_duplicate']:
+            logger.info(f"Duplicates skipped:  {self.stats['clients_duplicate']}")
+            if not self.stage:
+                logger.warning("  STAGING_DB is off: import_invoices.py cannot map the skipped duplicates "
+                               "to their primary, so their invoices will be skipped (no client)")
+        if self.stats['clients_already_imported']:
+            logger.info(f"Already imported:    {self.stats['clients_already_imported']} "
+                        f"(per {self.stage.path}; after resetting the new UISP run: "
+                        f"python staging.py --clear new)")
 
         if self.plan_mismatches:
             logger.info("\nUnmatched service plans (need to be created in UISP):")
@@ -566,15 +859,12 @@ class ClientImporter:
             if len(self.failed_clients) > 10:
                 logger.info(f"  ... and {len(self.failed_clients) - 10} more")
 
-        # Save failed clients to file
-        if self.failed_clients:
-            failed_file = f'failed_clients_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            with open(failed_file, 'w') as f:
-                json.dump(self.failed_clients, f, indent=2)
-            logger.info(f"\nFailed clients saved to: {failed_file}")
+        if self.queue:
+            self.queue.log_summary(('client', 'service'), 'import_clients.py')
 
 
 def main():
+    log_setup.start_run('import', audit=True)
     parser = argparse.ArgumentParser(
         description='Import clients from CSV to UISP CRM',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -592,8 +882,33 @@ def main():
                        help='Show detailed progress')
     parser.add_argument('--list-plans', action='store_true',
                        help='List available service plans and exit')
+    parser.add_argument('--dedupe', choices=client_dedupe.DEDUPE_ACTIONS, default='flag',
+                       help='Duplicate clients (same email/phone/PPPoE/name+address): '
+                            'flag (report only, default), skip, or merge into the first')
+    parser.add_argument('--retry-failed', nargs='?', const='transient', choices=retry_queue.REPLAY_MODES,
+                       help='Replay queued failures: transient ones that are due (default) or all')
+    parser.add_argument('--estimate', nargs='?', type=int, const=estimate.DEFAULT_SAMPLES, metavar='N',
+                       help='With --dry-run: time N read-only requests (default: 20) and project the '
+                            'import time')
+    parser.add_argument('--estimate-concurrency', type=estimate.levels_arg, default=estimate.DEFAULT_LEVELS,
+                       metavar='LIST', help='Concurrency levels to project (default: 1,2,4,8,16)')
+    parser.add_argument('--priority', action='store_true',
+                       help='Import clients with active services first, then the most recent '
+                            '(order set by PRIORITY_SERVICE_STATUSES)')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                       help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+
+    parser.add_argument('--profile', nargs='?', const='sample', choices=profiling.PROFILE_MODES,
+                       help='Profile the run: sample (flame graph stacks of every thread, default) or cprofile (main thread only)')
 
     args = parser.parse_args()
+    if args.estimate and not args.dry_run:
+        parser.error('--estimate projects a dry run: use it with --dry-run')
+    if args.retry_failed and args.dry_run:
+        parser.error('--retry-failed sends the queued requests: it cannot be combined with --dry-run')
+    metrics.write_summary_at_exit(args.metrics_out)
+    if args.profile:
+        profiling.start(args.profile, 'import_clients')
 
     # Load configuration
     try:
@@ -606,7 +921,8 @@ def main():
     uisp = UISPClient(
         base_url=config.UISP_BASE_URL,
         api_token=config.UISP_API_TOKEN,
-        verify_ssl=getattr(config, 'VERIFY_SSL', False)
+        verify_ssl=getattr(config, 'VERIFY_SSL', False),
+        **client_options(config)
     )
 
     # Test connection first (unless dry run)
@@ -627,7 +943,15 @@ def main():
     csv_parser = CSVParser(config.CSV_FILE_PATH)
 
     # Create importer
-    importer = ClientImporter(uisp, csv_parser)
+    queue = None if args.dry_run else retry_queue.open_queue(config)
+    stage = staging.open_staging(config)
+    if stage and stage.cleared_new:
+        logger.warning(f"UISP_BASE_URL changed: cleared the new-UISP tables of {stage.path}")
+    importer = ClientImporter(uisp, csv_parser, queue, stage)
+
+    if args.retry_failed:
+        importer.retry_failed(args.retry_failed, verbose=args.verbose)
+        return
 
     # Determine limit
     limit = args.limit
@@ -635,12 +959,17 @@ def main():
         limit = getattr(config, 'TEST_LIMIT', 10)
 
     # Run import
-    importer.run(
+    planned = importer.run(
         dry_run=args.dry_run,
         start=args.start,
         limit=limit,
-        verbose=args.verbose
+        verbose=args.verbose,
+        dedupe=args.dedupe,
+        prioritize=args.priority,
+        status_order=getattr(config, 'PRIORITY_SERVICE_STATUSES', priority.DEFAULT_SERVICE_STATUSES)
     )
+    if args.estimate:
+        estimate.log_estimate(uisp, planned, args.estimate, args.estimate_concurrency)
 
 
 if __name__ == '__main__':
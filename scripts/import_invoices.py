@@ -16,120 +16,112 @@ Options:
     --limit N       Import only N invoices
     --offset N      Start from invoice offset N (for resuming)
     --dry-run       Export invoices from old UISP without importing
+    --estimate [N]  With --dry-run: probe new UISP with N reads (default: 20) and project the import time
+    --estimate-concurrency LIST  Concurrency levels to project (default: 1,2,4,8,16)
     --export-only   Just export all invoices to JSON file, don't import
-    --import-from FILE  Import from previously exported JSON file
+    --import-from FILE  Import from previously exported JSON/NDJSON/Parquet/Feather file
+    --resume-from N Resume import from invoice index N (instant with an NDJSON export)
+    --only-clients ID,...  With --import-from: import only these old client IDs' invoices
+    --only-ids ID,...      With --import-from: import only these old invoice IDs
+    --format FMT    Export file format: json (default), ndjson (with offset index), parquet or feather
+    --delta         Export only invoices new or changed since the last export, and import only the new ones
+    --recheck N     With --delta: most recent invoices to re-read for changes (default: 2000)
+    --concurrency N Import N invoices in parallel (pair with UISP_TRANSPORT = 'httpx')
+    --retry-failed [all]  Replay invoices/payments from the retry queue (all = include permanent errors)
+    --export-mapping FILE  Write the new-UISP client ID mapping to FILE and exit
+    --client-mapping FILE  Use a mapping written by --export-mapping instead of crawling /clients
+    --refresh       Export invoices and crawl the client mapping again instead of using staging.db
+    --priority      Import unpaid/partial invoices first, newest first (see priority.py)
+    --stream        Import while reading old UISP (no export file); export and import overlap
+    --stream-buffer N  With --stream: pages of 500 invoices read ahead (default: 4)
+    --metrics-out FILE  Write per-endpoint request metrics (.json or .prom)
+    --profile [sample|cprofile]  Profile the run (phase table + flame graph stacks)
     --verbose       Show detailed progress
 """
 
 import argparse
-import json
 import logging
 import os
 import sys
 import time
-from datetime import datetime
-
-import requests
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Configure logging
-log_file = f'import_invoices_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(log_file)
-    ]
-)
+from collections.abc import Sequence
+from itertools import islice
+
+import audit_log
+import delta_export
+import estimate
+import export_store
+import json_codec
+import log_setup
+import metrics
+import payload_schema
+import priority
+import profiling
+import retry_queue
+import staging
+from report_stats import StatsAggregator
+from uisp_api import RecordStream, UISPApi, map_concurrent, client_options
+
 logger = logging.getLogger(__name__)
 
 # Default payment method for imported payments
 # Using "Cash" because "Custom" requires providerName/providerPaymentId fields
 DEFAULT_PAYMENT_METHOD_ID = "6efe0fa8-36b2-4dd1-b049-427bffc7d369"  # Cash
 
+# Pause between records to avoid overwhelming the API (seconds)
+REQUEST_DELAY = 0.05
 
-class UISPApi:
-    """Generic UISP CRM API client"""
-
-    def __init__(self, base_url, api_token, verify_ssl=False):
-        self.base_url = base_url.rstrip('/')
-        self.api_token = api_token
-        self.verify_ssl = verify_ssl
-        self.session = requests.Session()
-        self.session.headers.update({
-            'X-Auth-App-Key': api_token,
-            'Content-Type': 'application/json'
-        })
-
-    def _request(self, method, endpoint, data=None, retries=3):
-        url = f"{self.base_url}/crm/api/v1.0{endpoint}"
-        for attempt in range(retries):
-            try:
-                response = self.session.request(
-                    method, url, json=data,
-                    verify=self.verify_ssl, timeout=30
-                )
-
-                if response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 60))
-                    logger.warning(f"Rate limited. Waiting {retry_after}s...")
-                    time.sleep(retry_after)
-                    continue
+INVOICE_STATUS_NAMES = {0: 'Draft', 1: 'Unpaid', 2: 'Partial', 3: 'Paid', 4: 'Void'}
 
-                if response.status_code >= 400:
-                    error_text = response.text[:500]
-                    raise Exception(
-                        f"HTTP {response.status_code}: {error_text}"
-                    )
 
-                return response.json() if response.text else {}
+def invoice_stats():
+    """Aggregator behind the export and dry-run invoice reports"""
+    return (StatsAggregator()
+            .count_by('status', 'status')
+            .sum_of('total', 'total'))
 
-            except requests.exceptions.ConnectionError as e:
-                if attempt < retries - 1:
-                    wait = 5 * (attempt + 1)
-                    logger.warning(f"Connection error, retrying in {wait}s... ({e})")
-                    time.sleep(wait)
-                else:
-                    raise
 
-        raise Exception(f"Failed after {retries} retries")
+def log_dry_run_report(count, statuses, total_amount):
+    logger.info(f"\nDRY RUN: Would import {count} invoices")
+    logger.info(f"  Paid: {statuses.get(3, 0)}, Unpaid: {statuses.get(1, 0)}, "
+                f"Partial: {statuses.get(2, 0)}, Void (skip): {statuses.get(4, 0)}")
+    logger.info(f"  Total amount: ₱{total_amount:,.2f}")
 
-    def get(self, endpoint):
-        return self._request('GET', endpoint)
 
-    def post(self, endpoint, data):
-        return self._request('POST', endpoint, data)
+def planned_steps(count, statuses):
+    """Requests an import of these invoices would send (for --estimate): a POST per
+    non-void invoice, plus a payment POST per paid or partially paid one"""
+    invoices = count - statuses.get(4, 0)
+    return [estimate.Step('invoices', invoices, records=invoices, pause=REQUEST_DELAY),
+            estimate.Step('payments', statuses.get(2, 0) + statuses.get(3, 0))]
 
-    def delete(self, endpoint):
-        return self._request('DELETE', endpoint)
 
-    def test_connection(self):
-        try:
-            # Try /organizations first, fall back to /clients?limit=1
-            try:
-                orgs = self.get('/organizations')
-                logger.info(f"Connected to {self.base_url} ({len(orgs)} org(s))")
-                return True
-            except Exception:
-                clients = self.get('/clients?limit=1')
-                logger.info(f"Connected to {self.base_url} (verified via clients endpoint)")
-                return True
-        except Exception as e:
-            logger.error(f"Connection failed to {self.base_url}: {e}")
-            return False
+def log_estimate(config, steps, args):
+    """--dry-run --estimate: probe the new UISP and project the import time"""
+    new_api = UISPApi(config.UISP_BASE_URL, config.UISP_API_TOKEN,
+                      verify_ssl=getattr(config, 'VERIFY_SSL', False), **client_options(config))
+    estimate.log_estimate(new_api, steps, args.estimate, args.estimate_concurrency)
+
 
+def export_invoices(old_api, export_file='invoices_export.json', limit=None, offset=0, stats=None,
+                    stage=None):
+    """Export all invoices from old UISP to a JSON (or columnar) file.
 
-def export_invoices(old_api, export_file='invoices_export.json', limit=None, offset=0):
-    """Export all invoices from old UISP to a JSON file"""
+    Each fetched invoice is fed once into stats (an invoice_stats()
+    aggregator, created if not given) for the status report. A complete
+    export (no limit/offset, no failed page) also saves the delta state
+    used by --delta, and is staged in stage (a staging.StagingDB) if given.
+    """
     logger.info("=== Exporting invoices from old UISP ===")
 
+    if stats is None:
+        stats = invoice_stats()
+
     all_invoices = []
     page_size = 500
     current_offset = offset
     total_exported = 0
+    complete = not limit and not offset
 
     while True:
         if limit and total_exported >= limit:
@@ -143,12 +135,14 @@ def export_invoices(old_api, export_file='invoices_export.json', limit=None, off
         except Exception as e:
             logger.error(f"Failed to fetch at offset {current_offset}: {e}")
             logger.info(f"Saved {total_exported} invoices so far. You can resume with --offset {current_offset}")
+            complete = False
             break
 
         if not invoices:
             break
 
         all_invoices.extend(invoices)
+        stats.feed_many(invoices)
         total_exported += len(invoices)
         current_offset += len(invoices)
 
@@ -158,29 +152,38 @@ def export_invoices(old_api, export_file='invoices_export.json', limit=None, off
         if len(invoices) < batch_limit:
             break
 
-    # Save to file
-    with open(export_file, 'w') as f:
-        json.dump(all_invoices, f)
+    # Save to file (JSON array or columnar Parquet/Feather, by extension)
+    with profiling.phase('export_write'):
+        export_store.write_export(all_invoices, export_file)
+        if complete:
+            delta_export.save_state(export_file, all_invoices)
+            if stage:
+                stage.replace_old('invoice', all_invoices)
 
     file_size_mb = os.path.getsize(export_file) / 1024 / 1024
     logger.info(f"Exported {total_exported} invoices to {export_file} ({file_size_mb:.1f} MB)")
 
     # Print stats
-    statuses = {}
-    for inv in all_invoices:
-        s = inv.get('status', -1)
-        statuses[s] = statuses.get(s, 0) + 1
-
-    status_names = {0: 'Draft', 1: 'Unpaid', 2: 'Partial', 3: 'Paid', 4: 'Void'}
     logger.info("Status distribution:")
-    for s, count in sorted(statuses.items()):
-        logger.info(f"  {status_names.get(s, f'Unknown({s})')}: {count}")
+    for s, count in sorted(stats.counts('status').items()):
+        logger.info(f"  {INVOICE_STATUS_NAMES.get(s, f'Unknown({s})')}: {count}")
 
     return all_invoices
 
 
-def build_client_mapping(new_api):
-    """Build mapping from original client ID to new UISP client ID"""
+def build_client_mapping(new_api, stage=None, refresh=False):
+    """Build mapping from original client ID to new UISP client ID.
+
+    With stage (a staging.StagingDB), a mapping staged by an earlier crawl
+    (plus the clients imported since) is used unless refresh is set, and a
+    new crawl is staged.
+    """
+    if stage and not refresh and stage.dataset('new_client'):
+        mapping = stage.mapping('client')
+        logger.info(f"Client ID mapping from {stage.path}: {len(mapping)} clients "
+                    f"({stage.describe('new_client')}; --refresh to crawl again)")
+        return _map_duplicates(mapping, stage)
+
     logger.info("=== Building client ID mapping from new UISP ===")
 
     mapping = {}  # {original_client_id_str: new_client_id_int}
@@ -201,7 +204,23 @@ def build_client_mapping(new_api):
         if len(clients) < page_size:
             break
 
+    if stage:
+        stage.replace_mapping('client', mapping)
     logger.info(f"Built mapping for {len(mapping)} clients (userIdent → new ID)")
+    return _map_duplicates(mapping, stage)
+
+
+def _map_duplicates(mapping, stage):
+    """Map clients skipped by import_clients.py --dedupe skip/merge to their primary's new ID"""
+    if not stage:
+        return mapping
+    mapped = 0
+    for original_id, primary_id in stage.client_duplicates().items():
+        if original_id not in mapping and primary_id in mapping:
+            mapping[original_id] = mapping[primary_id]
+            mapped += 1
+    if mapped:
+        logger.info(f"  + {mapped} duplicate clients mapped to their primary's client")
     return mapping
 
 
@@ -233,142 +252,284 @@ def build_service_mapping(new_api):
     return mapping
 
 
-def import_invoices(new_api, invoices, client_mapping, resume_from=0, verbose=False):
-    """Import invoices into new UISP with linked payments for paid ones"""
+def build_invoice_payload(inv):
+    """Build the new-UISP invoice payload for an old invoice (None if it has no items)"""
+    items = []
+    for item in inv.get('items', []):
+        item_payload = {
+            'label': item.get('label', 'Imported item'),
+            'price': item.get('price', 0),
+            'quantity': item.get('quantity', 1),
+        }
+        if item.get('unit'):
+            item_payload['unit'] = item['unit']
+        items.append(item_payload)
+
+    if not items:
+        return None
+
+    invoice_payload = {
+        'number': str(inv.get('number', '?')),
+        'items': items,
+        'createdDate': inv.get('createdDate'),
+        'maturityDays': inv.get('maturityDays', 14),
+        'adminNotes': f"Imported from old UISP (ID: {inv.get('id', '?')})",
+    }
+
+    if inv.get('notes'):
+        invoice_payload['notes'] = inv['notes']
+
+    return invoice_payload
+
+
+def build_payment_payload(inv, new_client_id, new_inv_id=None):
+    """Payment linking a paid/partially paid invoice (None if nothing was paid).
+
+    Without new_inv_id (before the invoice exists) invoiceIds is left out.
+    """
+    if inv.get('status') not in (2, 3) or not inv.get('amountPaid', 0) > 0:
+        return None
+
+    # Use the first payment cover date if available, else invoice created date
+    payment_date = inv.get('createdDate')
+    covers = inv.get('paymentCovers', [])
+    if covers:
+        # We don't have the original payment date directly,
+        # but we can use the invoice's emailSentDate as an approximation
+        # or just the created date
+        pass
+
+    payment = {
+        'clientId': new_client_id,
+        'amount': inv['amountPaid'],
+        'currencyCode': inv.get('currencyCode', 'PHP'),
+        'methodId': DEFAULT_PAYMENT_METHOD_ID,
+        'createdDate': payment_date,
+        'note': f"Imported - Invoice #{inv.get('number', '?')}",
+    }
+    if new_inv_id is not None:
+        payment['invoiceIds'] = [new_inv_id]
+    return payment
+
+
+def import_invoices(new_api, invoices, client_mapping, resume_from=0, verbose=False,
+                    concurrency=1, queue=None, replay=False, stage=None):
+    """Import invoices into new UISP with linked payments for paid ones.
+
+    Invoice and payment payloads are built and validated locally before
+    they are queued (see payload_schema), so invalid ones cost no request.
+    With concurrency > 1, up to that many invoices (each invoice POST plus
+    its payment POST) are in flight at once; results are still handled in
+    input order.
+
+    Failed invoices and payments go to queue (a retry_queue.RetryQueue) when
+    given; with replay=True, invoices that now succeed are removed from it.
+
+    With stage (a staging.StagingDB) every outcome is recorded there, and
+    invoices it already has as created are skipped.
+
+    invoices can also be a live iterable (a uisp_api.RecordStream): its
+    invoices are then checked and sent as they arrive instead of all
+    payloads being checked up front.
+    """
     logger.info("=== Importing invoices into new UISP ===")
 
     stats = {
         'invoices_created': 0,
         'invoices_failed': 0,
+        'invoices_invalid': 0,
         'invoices_skipped_no_client': 0,
         'payments_created': 0,
         'payments_failed': 0,
+        'payments_invalid': 0,
         'void_skipped': 0,
+        'already_imported': 0,
     }
-    failed = []
 
-    total = len(invoices)
+    def record_failure(kind, inv, error, category=None, **record):
+        if queue:
+            queue.add(kind, inv.get('id', '?'), dict(record, invoice=inv) if record else inv, error, category)
+        if stage:
+            stage.record(kind, inv.get('id', '?'), category or 'failed', error=error)
+
+    done = stage.done_keys('invoice') if stage else set()
+    # Payments rolled back on their own (rollback.py --kinds payment): their
+    # invoices are still there, so only the payment is posted again
+    repost = stage.keys_with_status('payment', 'rolled_back') & done if stage else set()
+    invoice_ids = stage.mapping('invoice') if repost else {}
+
+    streaming = not isinstance(invoices, Sequence)
+    total = '?' if streaming else len(invoices)
     start_time = time.time()
 
-    for i, inv in enumerate(invoices):
-        if i < resume_from:
-            continue
+    def numbered():
+        if streaming:
+            return enumerate(islice(invoices, resume_from, None), resume_from)
+        # indexed NDJSON exports decode from resume_from on, not from the start
+        return ((i, invoices[i]) for i in range(resume_from, total))
+
+    def pending():
+        """Invoices to create, as (index, invoice, new client ID, invoice payload,
+        payment payload, payment errors, existing invoice ID)"""
+        for i, inv in numbered():
+
+            old_client_id = str(inv.get('clientId', ''))
+            inv_number = inv.get('number', '?')
+            inv_id = inv.get('id', '?')
+
+            # Skip void invoices
+            if inv.get('status') == 4:
+                stats['void_skipped'] += 1
+                continue
+
+            # Skip invoices an earlier run created (unless their payment was rolled back)
+            existing_inv_id = invoice_ids.get(str(inv_id)) if str(inv_id) in repost else None
+            if str(inv_id) in done and existing_inv_id is None:
+                stats['already_imported'] += 1
+                continue
+
+            # Look up new client ID
+            new_client_id = client_mapping.get(old_client_id)
+            if not new_client_id:
+                stats['invoices_skipped_no_client'] += 1
+                audit_log.event('invoice_skipped', old_id=inv_id, number=inv_number,
+                                client=old_client_id, reason='client not mapped')
+                if verbose:
+                    logger.warning(f"  [{i+1}/{total}] Skipped invoice {inv_number} - client {old_client_id} not found")
+                continue
+
+            invoice_payload = None
+            if existing_inv_id is None:
+                # Build invoice payload
+                with profiling.phase('payload_build'):
+                    invoice_payload = build_invoice_payload(inv)
+
+                if invoice_payload is None:
+                    stats['invoices_failed'] += 1
+                    record_failure('invoice', inv, 'No items', 'invalid')
+                    audit_log.event('invoice_failed', old_id=inv_id, number=inv_number,
+                                    client=old_client_id, error='No items')
+                    continue
+
+                with profiling.phase('validate'):
+                    errors = payload_schema.validate_invoice(invoice_payload)
+                if errors:
+                    stats['invoices_invalid'] += 1
+                    record_failure('invoice', inv, 'Invalid payload: ' + '; '.join(errors), 'invalid')
+                    audit_log.event('invoice_invalid', old_id=inv_id, number=inv_number,
+                                    client=old_client_id, errors=errors)
+                    if verbose:
+                        logger.warning(f"  [{i+1}/{total}] Invalid invoice {inv_number}: {'; '.join(errors)}")
+                    continue
 
+            # The payment is checked now too; its invoiceIds are filled in once
+            # the invoice exists
+            with profiling.phase('payload_build'):
+                payment_payload = build_payment_payload(inv, new_client_id)
+            payment_errors = []
+            if payment_payload:
+                with profiling.phase('validate'):
+                    payment_errors = payload_schema.validate_payment(payment_payload)
+                if payment_errors:
+                    payment_payload = None
+
+            yield i, inv, new_client_id, invoice_payload, payment_payload, payment_errors, existing_inv_id
+
+    def create(job):
+        """Create one invoice and its linked payment (runs on a worker thread)"""
+        i, inv, new_client_id, invoice_payload, payment_payload, _, new_inv_id = job
+        try:
+            if new_inv_id is None:
+                new_inv = new_api.post(f'/clients/{new_client_id}/invoices', invoice_payload)
+                new_inv_id = new_inv.get('id')
+
+            # Create linked payment for paid/partially paid invoices
+            new_payment = payment_error = None
+            if payment_payload:
+                payment_payload = dict(payment_payload, invoiceIds=[new_inv_id])
+                try:
+                    new_payment = new_api.post('/payments', payment_payload)
+                except Exception as e:
+                    payment_error = e
+            return new_inv_id, payment_payload, new_payment, payment_error
+        finally:
+            # Small delay between requests
+            with profiling.phase('throttle'):
+                time.sleep(REQUEST_DELAY)
+
+    if streaming:
+        # Checked as they arrive; map_concurrent pulls only a few batches ahead
+        jobs = pending()
+    else:
+        # Build and check every payload before the first request
+        jobs = list(pending())
+        logger.info(f"Payload check: {len(jobs)} invoices ready, {stats['invoices_invalid']} invalid "
+                    f"and {sum(1 for job in jobs if job[5])} payments invalid (not sent)")
+
+    for job, result, error in map_concurrent(create, jobs, concurrency):
+        i, inv, new_client_id, _, _, payment_errors, existing_inv_id = job
         old_client_id = str(inv.get('clientId', ''))
         inv_number = inv.get('number', '?')
         inv_id = inv.get('id', '?')
 
-        # Skip void invoices
-        if inv.get('status') == 4:
-            stats['void_skipped'] += 1
-            continue
-
-        # Look up new client ID
-        new_client_id = client_mapping.get(old_client_id)
-        if not new_client_id:
-            stats['invoices_skipped_no_client'] += 1
-            if verbose:
-                logger.warning(f"  [{i+1}/{total}] Skipped invoice {inv_number} - client {old_client_id} not found")
-            continue
-
-        # Build invoice payload
-        items = []
-        for item in inv.get('items', []):
-            item_payload = {
-                'label': item.get('label', 'Imported item'),
-                'price': item.get('price', 0),
-                'quantity': item.get('quantity', 1),
-            }
-            if item.get('unit'):
-                item_payload['unit'] = item['unit']
-            items.append(item_payload)
-
-        if not items:
+        if error is not None:
             stats['invoices_failed'] += 1
-            failed.append({
-                'old_id': inv_id, 'number': inv_number,
-                'error': 'No items'
-            })
+            record_failure('invoice', inv, error)
+            audit_log.event('invoice_failed', old_id=inv_id, number=inv_number,
+                            client=old_client_id, error=str(error)[:200])
+            if verbose:
+                logger.error(f"  [{i+1}/{total}] Failed invoice {inv_number}: {error}")
             continue
 
-        invoice_payload = {
-            'number': str(inv_number),
-            'items': items,
-            'createdDate': inv.get('createdDate'),
-            'maturityDays': inv.get('maturityDays', 14),
-            'adminNotes': f"Imported from old UISP (ID: {inv_id})",
-        }
-
-        if inv.get('notes'):
-            invoice_payload['notes'] = inv['notes']
-
-        # Create invoice
-        try:
-            new_inv = new_api.post(f'/clients/{new_client_id}/invoices', invoice_payload)
-            new_inv_id = new_inv.get('id')
+        new_inv_id, payment_payload, new_payment, payment_error = result
+        if existing_inv_id is None:
             stats['invoices_created'] += 1
-
+            if replay:
+                queue.resolve('invoice', inv_id)
+            if stage:
+                stage.record('invoice', inv_id, 'created', new_inv_id)
+            audit_log.event('invoice_created', old_id=inv_id, number=inv_number,
+                            client=old_client_id, new_client_id=new_client_id, new_id=new_inv_id)
             if verbose:
                 logger.info(f"  [{i+1}/{total}] Invoice {inv_number} → new ID {new_inv_id}")
 
-        except Exception as e:
-            stats['invoices_failed'] += 1
-            failed.append({
-                'old_id': inv_id, 'number': inv_number,
-                'client': old_client_id, 'error': str(e)[:200]
-            })
+        if payment_errors:
+            stats['payments_invalid'] += 1
+            record_failure('payment', inv, 'Invalid payload: ' + '; '.join(payment_errors), 'invalid',
+                           new_client_id=new_client_id, new_invoice_id=new_inv_id)
+            audit_log.event('payment_invalid', old_invoice_id=inv_id, new_invoice_id=new_inv_id,
+                            errors=payment_errors)
             if verbose:
-                logger.error(f"  [{i+1}/{total}] Failed invoice {inv_number}: {e}")
-            time.sleep(0.05)
-            continue
-
-        # Create linked payment for paid/partially paid invoices
-        if inv.get('status') in (2, 3) and inv.get('amountPaid', 0) > 0:
-            amount_paid = inv['amountPaid']
-
-            # Use the first payment cover date if available, else invoice created date
-            payment_date = inv.get('createdDate')
-            covers = inv.get('paymentCovers', [])
-            if covers:
-                # We don't have the original payment date directly,
-                # but we can use the invoice's emailSentDate as an approximation
-                # or just the created date
-                pass
-
-            payment_payload = {
-                'clientId': new_client_id,
-                'amount': amount_paid,
-                'currencyCode': inv.get('currencyCode', 'PHP'),
-                'methodId': DEFAULT_PAYMENT_METHOD_ID,
-                'createdDate': payment_date,
-                'note': f"Imported - Invoice #{inv_number}",
-                'invoiceIds': [new_inv_id],
-            }
-
-            try:
-                new_api.post('/payments', payment_payload)
-                stats['payments_created'] += 1
-            except Exception as e:
-                stats['payments_failed'] += 1
-                if verbose:
-                    logger.error(f"    Payment failed for invoice {inv_number}: {e}")
+                logger.warning(f"    Payment not sent for invoice {inv_number}: {'; '.join(payment_errors)}")
+        elif payment_error is not None:
+            stats['payments_failed'] += 1
+            record_failure('payment', inv, payment_error,
+                           new_client_id=new_client_id, new_invoice_id=new_inv_id)
+            audit_log.event('payment_failed', old_invoice_id=inv_id, new_invoice_id=new_inv_id,
+                            error=str(payment_error)[:200])
+            if verbose:
+                logger.error(f"    Payment failed for invoice {inv_number}: {payment_error}")
+        elif payment_payload:
+            stats['payments_created'] += 1
+            if stage:
+                stage.record('payment', inv_id, 'created', new_payment.get('id'))
+            audit_log.event('payment_created', old_invoice_id=inv_id, new_invoice_id=new_inv_id,
+                            new_id=new_payment.get('id'), amount=payment_payload.get('amount'))
 
         # Progress logging
         if (i + 1) % 500 == 0:
             elapsed = time.time() - start_time
             rate = (i + 1 - resume_from) / elapsed if elapsed > 0 else 0
-            remaining = (total - i - 1) / rate if rate > 0 else 0
+            eta = f"{(total - i - 1) / rate / 3600:.1f}h" if rate > 0 and not streaming else '?'
             logger.info(
                 f"Progress: {i+1}/{total} | "
                 f"Created: {stats['invoices_created']} inv + {stats['payments_created']} pay | "
                 f"Failed: {stats['invoices_failed']} | "
                 f"Rate: {rate:.1f}/s | "
-                f"ETA: {remaining/3600:.1f}h"
+                f"ETA: {eta} | "
+                f"API: {metrics.collector.progress_line()}"
             )
 
-        # Small delay between requests
-        time.sleep(0.05)
-
     # Final summary
     elapsed = time.time() - start_time
     logger.info("\n" + "=" * 60)
@@ -376,24 +537,156 @@ def import_invoices(new_api, invoices, client_mapping, resume_from=0, verbose=Fa
     logger.info("=" * 60)
     logger.info(f"Invoices created:           {stats['invoices_created']}")
     logger.info(f"Invoices failed:            {stats['invoices_failed']}")
+    logger.info(f"Invoices invalid (not sent): {stats['invoices_invalid']}")
     logger.info(f"Invoices skipped (no client): {stats['invoices_skipped_no_client']}")
     logger.info(f"Void invoices skipped:      {stats['void_skipped']}")
+    if stats['already_imported']:
+        logger.info(f"Already imported (staging): {stats['already_imported']}")
     logger.info(f"Payments created:           {stats['payments_created']}")
     logger.info(f"Payments failed:            {stats['payments_failed']}")
+    logger.info(f"Payments invalid (not sent): {stats['payments_invalid']}")
     logger.info(f"Total time:                 {elapsed/3600:.1f} hours")
     logger.info("=" * 60)
 
-    # Save failed invoices
-    if failed:
-        failed_file = f'failed_invoices_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        with open(failed_file, 'w') as f:
-            json.dump(failed, f, indent=2)
-        logger.info(f"Failed invoices saved to: {failed_file}")
+    if queue and not replay:
+        queue.log_summary(('invoice', 'payment'), 'import_invoices.py')
 
     return stats
 
 
+def find_imported_invoice(new_api, client_mapping, inv):
+    """The new-UISP invoice created from inv, if there is one (matched by number)"""
+    new_client_id = client_mapping.get(str(inv.get('clientId', '')))
+    if not new_client_id:
+        return None
+    number = str(inv.get('number', '?'))
+    for new_inv in new_api.get(f'/invoices?clientId={new_client_id}'):
+        if str(new_inv.get('number')) == number:
+            return new_inv
+    return None
+
+
+def replay_payments(new_api, jobs, queue, verbose=False, concurrency=1, stage=None):
+    """Create queued payments for invoices that already exist in new UISP.
+
+    jobs are retry-queue records: {'invoice', 'new_client_id', 'new_invoice_id'}.
+    """
+    payloads = []
+    for job in jobs:
+        inv = job['invoice']
+        payload = build_payment_payload(inv, job['new_client_id'], job['new_invoice_id'])
+        errors = payload_schema.validate_payment(payload) if payload else ['nothing was paid']
+        if errors:
+            queue.add('payment', inv.get('id', '?'), job, 'Invalid payload: ' + '; '.join(errors), 'invalid')
+            continue
+        payloads.append((job, payload))
+
+    created = 0
+    for (job, payload), new_payment, error in map_concurrent(
+            lambda item: new_api.post('/payments', item[1]), payloads, concurrency):
+        inv = job['invoice']
+        if error is not None:
+            queue.add('payment', inv.get('id', '?'), job, error)
+            audit_log.event('payment_failed', old_invoice_id=inv.get('id'),
+                            new_invoice_id=job['new_invoice_id'], error=str(error)[:200])
+            if verbose:
+                logger.error(f"  Payment failed for invoice {inv.get('number', '?')}: {error}")
+            continue
+        created += 1
+        queue.resolve('payment', inv.get('id', '?'))
+        if stage:
+            stage.record('payment', inv.get('id', '?'), 'created', new_payment.get('id'))
+        audit_log.event('payment_created', old_invoice_id=inv.get('id'), new_invoice_id=job['new_invoice_id'],
+                        new_id=new_payment.get('id'), amount=payload.get('amount'))
+    logger.info(f"Payments replayed: {created} created, {len(jobs) - created} still failing")
+
+
+def retry_failed(new_api, queue, mode='transient', verbose=False, concurrency=1, stage=None):
+    """Replay queued invoices and payments (--retry-failed)"""
+    kinds = ('invoice', 'payment')
+    entries = queue.due(kinds, mode)
+    retry_queue.log_replay_start(queue, entries, kinds, mode)
+    if not entries:
+        return
+
+    payment_jobs = [e.record for e in entries if e.kind == 'payment']
+    invoice_entries = [e for e in entries if e.kind == 'invoice']
+    if invoice_entries:
+        client_mapping = build_client_mapping(new_api, stage)
+        invoices = []
+        for entry in invoice_entries:
+            inv = entry.record
+            if entry.category in retry_queue.AMBIGUOUS:
+                # The POST that timed out or got a 5xx may have created it anyway
+                try:
+                    existing = find_imported_invoice(new_api, client_mapping, inv)
+                except Exception as e:
+                    # Can't tell whether it exists; leave it queued
+                    queue.add('invoice', entry.key, inv, e)
+                    continue
+                if existing:
+                    logger.info(f"Invoice {inv.get('number', '?')} already exists as {existing['id']}")
+                    queue.resolve('invoice', entry.key)
+                    if stage:
+                        stage.record('invoice', entry.key, 'created', existing['id'])
+                    if not existing.get('amountPaid') and build_payment_payload(inv, existing['clientId']):
+                        payment_jobs.append({'invoice': inv, 'new_client_id': existing['clientId'],
+                                             'new_invoice_id': existing['id']})
+                    continue
+            invoices.append(inv)
+        if invoices:
+            import_invoices(new_api, invoices, client_mapping, verbose=verbose,
+                            concurrency=concurrency, queue=queue, replay=True, stage=stage)
+
+    if payment_jobs:
+        replay_payments(new_api, payment_jobs, queue, verbose, concurrency, stage)
+    queue.log_summary(kinds, 'import_invoices.py')
+
+
+def order_by_priority(invoices, config):
+    """Invoices in priority order (--priority); --resume-from counts positions in it"""
+    with profiling.phase('priority'):
+        return priority.order_invoices(
+            invoices, getattr(config, 'PRIORITY_INVOICE_STATUSES', priority.DEFAULT_INVOICE_STATUSES),
+            INVOICE_STATUS_NAMES)
+
+
+def id_list(value):
+    """argparse type for comma-separated record IDs"""
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+def load_invoices(path, only_clients=None, only_ids=None):
+    """Invoices from an export file, optionally only some clients' or IDs'.
+
+    An NDJSON export is opened through its offset index: the result is a
+    lazy sequence (nothing decoded until used) or, when filtered, only the
+    matching records are read. Other formats are parsed in full.
+    """
+    if export_store.format_from_path(path) == 'ndjson':
+        export = export_store.open_indexed(path)
+        if not only_clients and not only_ids:
+            return export
+        found = [inv for client_id in only_clients or [] for inv in export.by_client(client_id)]
+        found.extend(inv for inv in map(export.by_id, only_ids or []) if inv is not None)
+        export.close()
+    else:
+        clients, ids = set(only_clients or []), set(only_ids or [])
+        found = export_store.load_records(path)
+        if not clients and not ids:
+            return found
+        found = [inv for inv in found if inv.get('clientId') in clients or inv.get('id') in ids]
+
+    # An invoice can match both filters; keep the first copy
+    seen = set()
+    invoices = [inv for inv in found if not (inv.get('id') in seen or seen.add(inv.get('id')))]
+    logger.info(f"Selected {len(invoices)} invoices for {len(only_clients or [])} clients / "
+                f"{len(only_ids or [])} invoice IDs")
+    return invoices
+
+
 def main():
+    log_file = log_setup.start_run('import_invoices', audit=True)
     parser = argparse.ArgumentParser(
         description='Import invoices from old UISP to new UISP',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -409,14 +702,66 @@ def main():
                         help='Resume import from invoice index N (skip first N)')
     parser.add_argument('--dry-run', action='store_true',
                         help='Export and show stats without importing')
+    parser.add_argument('--estimate', nargs='?', type=int, const=estimate.DEFAULT_SAMPLES, metavar='N',
+                        help='With --dry-run: time N read-only requests to new UISP (default: 20) and '
+                             'project the import time')
+    parser.add_argument('--estimate-concurrency', type=estimate.levels_arg, default=estimate.DEFAULT_LEVELS,
+                        metavar='LIST', help='Concurrency levels to project (default: 1,2,4,8,16)')
     parser.add_argument('--export-only', action='store_true',
                         help='Just export invoices to JSON file')
     parser.add_argument('--import-from', type=str, default=None,
-                        help='Import from previously exported JSON file')
+                        help='Import from previously exported JSON/NDJSON/Parquet/Feather file')
+    parser.add_argument('--only-clients', type=id_list, default=None, metavar='ID,...',
+                        help='With --import-from: import only the invoices of these old client IDs')
+    parser.add_argument('--only-ids', type=id_list, default=None, metavar='ID,...',
+                        help='With --import-from: import only these old invoice IDs')
+    parser.add_argument('--format', choices=export_store.EXPORT_FORMATS, default='json',
+                        help='Export file format (parquet/feather need pyarrow)')
+    parser.add_argument('--delta', action='store_true',
+                        help='Export only invoices new or changed since the last complete export '
+                             '(and import only the new ones)')
+    parser.add_argument('--recheck', type=int, default=delta_export.DEFAULT_RECHECK,
+                        help='With --delta: most recent invoices to re-read for changes')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                        help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Invoices to import in parallel (default: 1, or UISP_MAX_CONNECTIONS with '
+                             '--retry-failed; best with UISP_TRANSPORT = "httpx")')
+    parser.add_argument('--retry-failed', nargs='?', const='transient', choices=retry_queue.REPLAY_MODES,
+                        help='Replay queued failures: transient ones that are due (default) or all')
+    parser.add_argument('--export-mapping', type=str, default=None, metavar='FILE',
+                        help='Write the client ID mapping (userIdent -> new client ID) to FILE and exit')
+    parser.add_argument('--client-mapping', type=str, default=None, metavar='FILE',
+                        help='Client ID mapping written by --export-mapping (skips the /clients crawl)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Fetch invoices and the client mapping again instead of using staged copies')
+    parser.add_argument('--priority', action='store_true',
+                        help='Import unpaid and partial invoices first, newest first '
+                             '(order set by PRIORITY_INVOICE_STATUSES)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Import invoices while they are read from old UISP, with no export file')
+    parser.add_argument('--stream-buffer', type=int, default=4, metavar='PAGES',
+                        help='With --stream: pages (of 500 invoices) read ahead of the import (default: 4)')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Show detailed progress')
 
+    parser.add_argument('--profile', nargs='?', const='sample', choices=profiling.PROFILE_MODES,
+                        help='Profile the run: sample (flame graph stacks of every thread, default) or cprofile (main thread only)')
+
     args = parser.parse_args()
+    if args.stream and (args.import_from or args.export_only or args.dry_run or args.delta):
+        parser.error('--stream reads old UISP directly: it cannot be combined with '
+                     '--import-from, --export-only, --dry-run or --delta')
+    if args.estimate and not args.dry_run:
+        parser.error('--estimate projects a dry run: use it with --dry-run')
+    if args.retry_failed and args.dry_run:
+        parser.error('--retry-failed sends the queued requests: it cannot be combined with --dry-run')
+    if args.stream and args.priority:
+        parser.error('--priority needs every invoice before the first import: it cannot be '
+                     'combined with --stream')
+    metrics.write_summary_at_exit(args.metrics_out)
+    if args.profile:
+        profiling.start(args.profile, 'import_invoices')
 
     # Load config
     try:
@@ -426,6 +771,21 @@ def main():
         logger.error("config.py not found. Ensure it exists in the scripts directory.")
         sys.exit(1)
 
+    stage = staging.open_staging(config)
+    if stage and stage.cleared_new:
+        logger.warning(f"UISP_BASE_URL changed: cleared the new-UISP tables of {stage.path}")
+
+    if args.export_mapping:
+        new_api = UISPApi(config.UISP_BASE_URL, config.UISP_API_TOKEN,
+                          verify_ssl=getattr(config, 'VERIFY_SSL', False), **client_options(config))
+        if not new_api.test_connection():
+            logger.error("Cannot connect to new UISP.")
+            sys.exit(1)
+        client_mapping = build_client_mapping(new_api, stage, args.refresh)
+        json_codec.dump(client_mapping, args.export_mapping)
+        logger.info(f"Saved client mapping to {args.export_mapping}")
+        sys.exit(0)
+
     # Check required config
     old_url = getattr(config, 'OLD_UISP_BASE_URL', None)
     old_token = getattr(config, 'OLD_UISP_API_KEY', None)
@@ -433,65 +793,145 @@ def main():
         logger.error("OLD_UISP_BASE_URL and OLD_UISP_API_KEY must be set in config.py")
         sys.exit(1)
 
+    columnar_in = args.import_from and export_store.is_columnar(args.import_from)
+    if (args.format in export_store.COLUMNAR_FORMATS or columnar_in) and not export_store.columnar_available():
+        logger.error("pyarrow is required for parquet/feather exports (pip install pyarrow)")
+        sys.exit(1)
+
     limit = args.limit
     if args.test:
         limit = 10
 
+    if args.retry_failed:
+        new_api = UISPApi(config.UISP_BASE_URL, config.UISP_API_TOKEN,
+                          verify_ssl=getattr(config, 'VERIFY_SSL', False), **client_options(config))
+        if not new_api.test_connection():
+            logger.error("Cannot connect to new UISP.")
+            sys.exit(1)
+        # Replays are small and already throttled by backoff: use the whole pool
+        concurrency = args.concurrency or getattr(config, 'UISP_MAX_CONNECTIONS', 10)
+        retry_failed(new_api, retry_queue.open_queue(config), args.retry_failed,
+                     verbose=args.verbose, concurrency=concurrency, stage=stage)
+        sys.exit(0)
+
     # Step 1: Get invoices (from export or API)
+    if args.import_from and columnar_in and args.dry_run:
+        # Dry run over a columnar export: aggregate columns, no record decoding
+        table = export_store.read_table(args.import_from)
+        if limit:
+            table = table.slice(0, limit)
+        statuses = export_store.value_counts(table, 'status')
+        log_dry_run_report(table.num_rows, statuses, export_store.column_sum(table, 'total'))
+        if args.estimate:
+            log_estimate(config, planned_steps(table.num_rows, statuses), args)
+        sys.exit(0)
+
+    stats = invoice_stats()
+
     if args.import_from:
         logger.info(f"Loading invoices from {args.import_from}...")
-        with open(args.import_from, 'r') as f:
-            invoices = json.load(f)
+        with profiling.phase('parse'):
+            invoices = load_invoices(args.import_from, args.only_clients, args.only_ids)
         logger.info(f"Loaded {len(invoices)} invoices from file")
+        if args.priority:
+            # Before --limit, so a limited run takes the most important invoices
+            invoices = order_by_priority(invoices, config)
         if limit:
             invoices = invoices[:limit]
+        if args.dry_run:
+            stats.feed_many(invoices)
+    elif args.stream:
+        old_api = UISPApi(old_url, old_token, verify_ssl=False, **client_options(config))
+        if not old_api.test_connection():
+            logger.error("Cannot connect to old UISP. Check OLD_UISP_BASE_URL and OLD_UISP_API_KEY.")
+            sys.exit(1)
+        # Pages are fetched on a background thread once the import starts
+        invoices = RecordStream(old_api, '/invoices', offset=args.offset, limit=limit,
+                                buffer_pages=args.stream_buffer)
+    elif (stage and stage.dataset('old_invoice') and not limit and not args.offset
+          and not (args.refresh or args.delta or args.export_only)):
+        # The last complete export is staged: no need to read old UISP again
+        invoices = stage.old_records('invoice')
+        logger.info(f"Loaded {len(invoices)} invoices from {stage.path} "
+                    f"({stage.describe('old_invoice')}; --refresh to export again)")
+        stats.feed_many(invoices)
     else:
         # Connect to old UISP
-        old_api = UISPApi(old_url, old_token, verify_ssl=False)
+        old_api = UISPApi(old_url, old_token, verify_ssl=False, **client_options(config))
         if not old_api.test_connection():
             logger.error("Cannot connect to old UISP. Check OLD_UISP_BASE_URL and OLD_UISP_API_KEY.")
             sys.exit(1)
 
-        # Export invoices
-        export_file = 'invoices_export.json'
-        invoices = export_invoices(old_api, export_file, limit=limit, offset=args.offset)
+        # Export invoices (or only what changed since the last export)
+        export_file = export_store.export_path('invoices_export.json', args.format)
+        state = delta_export.load_state(export_file) if args.delta else None
+        if state:
+            invoices, new, changed = delta_export.delta_export(old_api, '/invoices', export_file, state,
+                                                               recheck=args.recheck)
+            if stage:
+                stage.replace_old('invoice', invoices)
+            stats.feed_many(invoices)
+            if not args.export_only and not args.dry_run:
+                # Earlier invoices were imported by the earlier run
+                if changed:
+                    logger.warning(f"{len(changed)} already exported invoices changed (e.g. paid since); "
+                                   f"the export is updated but they are not imported again")
+                invoices = new
+        else:
+            if args.delta:
+                logger.info(f"No previous export of {export_file} to update: doing a full export")
+            invoices = export_invoices(old_api, export_file, limit=limit, offset=args.offset,
+                                       stats=stats, stage=stage)
 
         if args.export_only:
             logger.info("Export complete. Use --import-from to import later.")
             sys.exit(0)
 
     if args.dry_run:
-        logger.info(f"\nDRY RUN: Would import {len(invoices)} invoices")
-        paid = sum(1 for inv in invoices if inv.get('status') == 3)
-        unpaid = sum(1 for inv in invoices if inv.get('status') == 1)
-        partial = sum(1 for inv in invoices if inv.get('status') == 2)
-        void = sum(1 for inv in invoices if inv.get('status') == 4)
-        logger.info(f"  Paid: {paid}, Unpaid: {unpaid}, Partial: {partial}, Void (skip): {void}")
-        total_amount = sum(inv.get('total', 0) for inv in invoices)
-        logger.info(f"  Total amount: ₱{total_amount:,.2f}")
+        log_dry_run_report(stats.records, stats.counts('status'), stats.total('total'))
+        if args.estimate:
+            log_estimate(config, planned_steps(stats.records, stats.counts('status')), args)
         sys.exit(0)
 
     # Step 2: Connect to new UISP
     new_api = UISPApi(
         config.UISP_BASE_URL,
         config.UISP_API_TOKEN,
-        verify_ssl=getattr(config, 'VERIFY_SSL', False)
+        verify_ssl=getattr(config, 'VERIFY_SSL', False),
+        **client_options(config)
     )
     if not new_api.test_connection():
         logger.error("Cannot connect to new UISP.")
         sys.exit(1)
 
-    # Step 3: Build client ID mapping
-    client_mapping = build_client_mapping(new_api)
+    # Step 3: Build client ID mapping (or load the one saved by --export-mapping)
+    if args.client_mapping:
+        client_mapping = json_codec.load(args.client_mapping)
+        logger.info(f"Loaded mapping for {len(client_mapping)} clients from {args.client_mapping}")
+    else:
+        client_mapping = build_client_mapping(new_api, stage, args.refresh)
     if not client_mapping:
         logger.error("No client mapping found. Run client import first.")
         sys.exit(1)
 
     # Step 4: Import invoices
-    logger.info(f"\nStarting import of {len(invoices)} invoices...")
+    if args.priority and not args.import_from:
+        invoices = order_by_priority(invoices, config)
+    if args.stream:
+        logger.info("\nStarting streaming import from old UISP...")
+    else:
+        logger.info(f"\nStarting import of {len(invoices)} invoices...")
     logger.info(f"Log file: {log_file}")
     import_invoices(new_api, invoices, client_mapping,
-                    resume_from=args.resume_from, verbose=args.verbose)
+                    resume_from=args.resume_from, verbose=args.verbose,
+                    concurrency=args.concurrency or 1, queue=retry_queue.open_queue(config), stage=stage)
+
+    if args.stream:
+        invoices.log_summary()
+        if invoices.error is not None:
+            logger.error(f"Reading old UISP failed at offset {invoices.next_offset}: {invoices.error}")
+            logger.info(f"Resume with: python import_invoices.py --stream --offset {invoices.next_offset}")
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -11,6 +11,14 @@ Usage:
     3. python3 import_pppoe.py --dry-run       # Show what would be updated
     4. python3 import_pppoe.py                 # Full import
     5. python3 import_pppoe.py --resume-from N # Resume from index N
+    6. python3 import_pppoe.py --metrics-out pppoe_metrics.prom  # Per-endpoint request metrics
+    7. python3 import_pppoe.py --profile       # Phase timing + flame graph stacks
+    8. python3 import_pppoe.py --concurrency 8 # Parallel PATCHes (best with UISP_TRANSPORT = 'httpx')
+    9. python3 import_pppoe.py --retry-failed  # Replay failed PATCHes from the retry queue
+   10. python3 import_pppoe.py --export-only   # Save old-UISP PPPoE usernames to pppoe_export.json
+   11. python3 import_pppoe.py --import-from pppoe_export.json --client-mapping client_mapping.json
+   12. python3 import_pppoe.py --refresh       # Crawl both UISPs again instead of using staging.db
+   13. python3 import_pppoe.py --dry-run --estimate  # Also project the PATCH time at 1-16 workers
 
 Flow:
     Old UISP clients (pppoeUsername attr) → mapping via userIdent →
@@ -18,97 +26,31 @@ Flow:
 """
 
 import argparse
-import json
 import logging
 import os
 import sys
 import time
-from datetime import datetime
-
-import requests
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Configure logging
-log_file = f'import_pppoe_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(log_file)
-    ]
-)
+
+import audit_log
+import estimate
+import json_codec
+import log_setup
+import metrics
+import profiling
+import retry_queue
+import staging
+from uisp_api import UISPApi, map_concurrent, client_options
+
 logger = logging.getLogger(__name__)
 
 # PPPoE username custom attribute ID on new UISP (service-level)
 PPPOE_ATTR_ID = 2
 
+# Old-UISP PPPoE usernames saved by --export-only
+PPPOE_EXPORT_FILE = 'pppoe_export.json'
 
-class UISPApi:
-    """Generic UISP CRM API client"""
-
-    def __init__(self, base_url, api_token, verify_ssl=False):
-        self.base_url = base_url.rstrip('/')
-        self.api_token = api_token
-        self.verify_ssl = verify_ssl
-        self.session = requests.Session()
-        self.session.headers.update({
-            'X-Auth-App-Key': api_token,
-            'Content-Type': 'application/json'
-        })
-
-    def _request(self, method, endpoint, data=None, retries=3):
-        url = f"{self.base_url}/crm/api/v1.0{endpoint}"
-        for attempt in range(retries):
-            try:
-                response = self.session.request(
-                    method, url, json=data,
-                    verify=self.verify_ssl, timeout=30
-                )
-
-                if response.status_code == 429:
-                    retry_after = int(response.headers.get('Retry-After', 60))
-                    logger.warning(f"Rate limited. Waiting {retry_after}s...")
-                    time.sleep(retry_after)
-                    continue
-
-                if response.status_code >= 400:
-                    error_text = response.text[:500]
-                    raise Exception(
-                        f"HTTP {response.status_code}: {error_text}"
-                    )
-
-                return response.json() if response.text else {}
-
-            except requests.exceptions.ConnectionError as e:
-                if attempt < retries - 1:
-                    wait = 5 * (attempt + 1)
-                    logger.warning(f"Connection error, retrying in {wait}s... ({e})")
-                    time.sleep(wait)
-                else:
-                    raise
-
-        raise Exception(f"Failed after {retries} retries")
-
-    def get(self, endpoint):
-        return self._request('GET', endpoint)
-
-    def patch(self, endpoint, data):
-        return self._request('PATCH', endpoint, data)
-
-    def test_connection(self):
-        try:
-            try:
-                self.get('/organizations')
-            except Exception:
-                self.get('/clients?limit=1')
-            logger.info(f"Connected to {self.base_url}")
-            return True
-        except Exception as e:
-            logger.error(f"Connection failed to {self.base_url}: {e}")
-            return False
+# Pause between records to avoid overwhelming the API (seconds)
+REQUEST_DELAY = 0.05
 
 
 def fetch_all_paginated(api, endpoint, page_size=10000):
@@ -126,9 +68,18 @@ def fetch_all_paginated(api, endpoint, page_size=10000):
     return all_records
 
 
-def build_pppoe_mapping(old_api):
+def build_pppoe_mapping(old_api, stage=None, refresh=False):
     """Extract PPPoE usernames from old UISP client attributes.
-    Returns {old_client_id_str: pppoe_username}"""
+    Returns {old_client_id_str: pppoe_username}
+
+    With stage (a staging.StagingDB), the staged usernames are used unless
+    refresh is set, and a new crawl is staged.
+    """
+    if stage and not refresh and stage.dataset('old_pppoe'):
+        mapping = stage.pppoe_mapping()
+        logger.info(f"PPPoE usernames from {stage.path}: {len(mapping)} ({stage.describe('old_pppoe')})")
+        return mapping
+
     logger.info("=== Step 1: Fetching PPPoE usernames from old UISP ===")
 
     clients = fetch_all_paginated(old_api, '/clients')
@@ -142,13 +93,21 @@ def build_pppoe_mapping(old_api):
                 mapping[client_id] = attr['value'].strip()
                 break
 
+    if stage:
+        stage.replace_pppoe(mapping)
     logger.info(f"Found {len(mapping)} clients with PPPoE usernames")
     return mapping
 
 
-def build_client_id_mapping(new_api):
+def build_client_id_mapping(new_api, stage=None, refresh=False):
     """Map original client ID → new UISP client ID via userIdent.
     Returns {old_client_id_str: new_client_id_int}"""
+    if stage and not refresh and stage.dataset('new_client'):
+        mapping = stage.mapping('client')
+        logger.info(f"Client ID mapping from {stage.path}: {len(mapping)} clients "
+                    f"({stage.describe('new_client')})")
+        return mapping
+
     logger.info("=== Step 2: Building client ID mapping from new UISP ===")
 
     clients = fetch_all_paginated(new_api, '/clients')
@@ -160,17 +119,27 @@ def build_client_id_mapping(new_api):
         if user_ident:
             mapping[str(user_ident)] = c['id']
 
+    if stage:
+        stage.replace_mapping('client', mapping)
     logger.info(f"Built mapping for {len(mapping)} clients (userIdent → new ID)")
     return mapping
 
 
-def build_service_mapping(new_api):
+def build_service_mapping(new_api, stage=None, refresh=False):
     """Map new client ID → service ID(s) on new UISP.
     Returns {new_client_id: [service_ids]}"""
+    if stage and not refresh and stage.dataset('new_service'):
+        mapping = stage.service_mapping()
+        logger.info(f"Service mapping from {stage.path}: {len(mapping)} clients "
+                    f"({stage.describe('new_service')})")
+        return mapping
+
     logger.info("=== Step 3: Building service mapping from new UISP ===")
 
     services = fetch_all_paginated(new_api, '/clients/services')
     logger.info(f"Fetched {len(services)} services from new UISP")
+    if stage:
+        stage.replace_new_services(services)
 
     mapping = {}
     for s in services:
@@ -190,8 +159,13 @@ def build_service_mapping(new_api):
 
 
 def import_pppoe(new_api, pppoe_map, client_map, service_map,
-                 dry_run=False, limit=None, resume_from=0, verbose=False):
-    """Set PPPoE usernames on new UISP services"""
+                 dry_run=False, limit=None, resume_from=0, verbose=False, concurrency=1, queue=None,
+                 stage=None):
+    """Set PPPoE usernames on new UISP services (up to concurrency PATCHes in flight).
+
+    Services stage (a staging.StagingDB) has as updated count as already set:
+    their staged attributes predate the PATCH.
+    """
     logger.info("=== Step 4: Importing PPPoE usernames ===")
     if dry_run:
         logger.info("DRY RUN — no changes will be made")
@@ -202,6 +176,7 @@ def import_pppoe(new_api, pppoe_map, client_map, service_map,
     skipped_no_service = 0
     skipped_already_set = 0
     multi_service_clients = 0
+    updated = stage.done_keys('pppoe') if stage else set()
 
     for old_client_id, pppoe_username in pppoe_map.items():
         new_client_id = client_map.get(old_client_id)
@@ -225,7 +200,7 @@ def import_pppoe(new_api, pppoe_map, client_map, service_map,
                     existing_pppoe = attr.get('value')
                     break
 
-            if existing_pppoe:
+            if existing_pppoe or str(svc['id']) in updated:
                 skipped_already_set += 1
                 continue
 
@@ -251,38 +226,58 @@ def import_pppoe(new_api, pppoe_map, client_map, service_map,
         logger.info(f"\nTotal: {len(work)} services would be updated")
         return {'would_update': len(work)}
 
-    # Execute updates
+    return apply_updates(new_api, work, resume_from, verbose, concurrency, queue, stage=stage)
+
+
+def apply_updates(new_api, work, resume_from=0, verbose=False, concurrency=1, queue=None, replay=False,
+                  stage=None):
+    """PATCH each (service_id, pppoe_username, old_client_id, service_name) in work.
+
+    Failures go to queue (a retry_queue.RetryQueue) when given; with
+    replay=True, services that now succeed are removed from it. Outcomes are
+    recorded in stage (a staging.StagingDB) when given.
+    """
     stats = {'updated': 0, 'failed': 0}
-    failed = []
     start_time = time.time()
 
-    for i, (svc_id, pppoe_username, old_client_id, svc_name) in enumerate(work):
-        if i < resume_from:
-            continue
-
+    def update(i):
+        svc_id, pppoe_username = work[i][:2]
         payload = {
             'attributes': [
                 {'customAttributeId': PPPOE_ATTR_ID, 'value': pppoe_username}
             ]
         }
-
         try:
-            new_api.patch(f'/clients/services/{svc_id}', payload)
+            return new_api.patch(f'/clients/services/{svc_id}', payload)
+        finally:
+            with profiling.phase('throttle'):
+                time.sleep(REQUEST_DELAY)
+
+    for i, _, error in map_concurrent(update, range(resume_from, len(work)), concurrency):
+        svc_id, pppoe_username, old_client_id, svc_name = work[i]
+
+        if error is None:
             stats['updated'] += 1
+            audit_log.event('pppoe_updated', service_id=svc_id, pppoe=pppoe_username,
+                            old_client_id=old_client_id)
+            if replay:
+                queue.resolve('pppoe', svc_id)
+            if stage:
+                stage.record('pppoe', svc_id, 'updated')
 
             if verbose or (i + 1) % 500 == 0:
                 logger.info(f"  [{i+1}/{len(work)}] Service {svc_id}: pppoeusername = '{pppoe_username}'")
 
-        except Exception as e:
+        else:
             stats['failed'] += 1
-            failed.append({
-                'service_id': svc_id,
-                'pppoe': pppoe_username,
-                'old_client_id': old_client_id,
-                'error': str(e)[:200]
-            })
+            if queue:
+                queue.add('pppoe', svc_id, work[i], error)
+            if stage:
+                stage.record('pppoe', svc_id, 'failed', error=error)
+            audit_log.event('pppoe_failed', service_id=svc_id, pppoe=pppoe_username,
+                            old_client_id=old_client_id, error=str(error)[:200])
             if verbose:
-                logger.error(f"  [{i+1}/{len(work)}] Failed service {svc_id}: {e}")
+                logger.error(f"  [{i+1}/{len(work)}] Failed service {svc_id}: {error}")
 
         # Progress every 500
         if (i + 1) % 500 == 0:
@@ -293,11 +288,10 @@ def import_pppoe(new_api, pppoe_map, client_map, service_map,
             logger.info(
                 f"Progress: {i+1}/{len(work)} | "
                 f"Updated: {stats['updated']} | Failed: {stats['failed']} | "
-                f"Rate: {rate:.1f}/s | ETA: {remaining/60:.0f}min"
+                f"Rate: {rate:.1f}/s | ETA: {remaining/60:.0f}min | "
+                f"API: {metrics.collector.progress_line()}"
             )
 
-        time.sleep(0.05)
-
     # Summary
     elapsed = time.time() - start_time
     logger.info("\n" + "=" * 60)
@@ -308,16 +302,14 @@ def import_pppoe(new_api, pppoe_map, client_map, service_map,
     logger.info(f"Total time:        {elapsed/60:.1f} minutes")
     logger.info("=" * 60)
 
-    if failed:
-        failed_file = f'failed_pppoe_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        with open(failed_file, 'w') as f:
-            json.dump(failed, f, indent=2)
-        logger.info(f"Failed records saved to: {failed_file}")
+    if queue:
+        queue.log_summary(('pppoe',), 'import_pppoe.py')
 
     return stats
 
 
 def main():
+    log_file = log_setup.start_run('import_pppoe', audit=True)
     parser = argparse.ArgumentParser(
         description='Import PPPoE usernames from old UISP to new UISP services',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -331,10 +323,39 @@ def main():
                         help='Resume from work item index N')
     parser.add_argument('--dry-run', action='store_true',
                         help='Show what would be updated without making changes')
+    parser.add_argument('--estimate', nargs='?', type=int, const=estimate.DEFAULT_SAMPLES, metavar='N',
+                        help='With --dry-run: time N read-only requests (default: 20) and project the '
+                             'update time')
+    parser.add_argument('--estimate-concurrency', type=estimate.levels_arg, default=estimate.DEFAULT_LEVELS,
+                        metavar='LIST', help='Concurrency levels to project (default: 1,2,4,8,16)')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                        help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Services to update in parallel (default: 1, or UISP_MAX_CONNECTIONS with '
+                             '--retry-failed; best with UISP_TRANSPORT = "httpx")')
+    parser.add_argument('--retry-failed', nargs='?', const='transient', choices=retry_queue.REPLAY_MODES,
+                        help='Replay queued failures: transient ones that are due (default) or all')
+    parser.add_argument('--export-only', action='store_true',
+                        help=f'Save PPPoE usernames from old UISP to {PPPOE_EXPORT_FILE} and exit')
+    parser.add_argument('--import-from', type=str, default=None, metavar='FILE',
+                        help='Use PPPoE usernames saved by --export-only instead of reading old UISP')
+    parser.add_argument('--client-mapping', type=str, default=None, metavar='FILE',
+                        help='Client ID mapping from import_invoices.py --export-mapping '
+                             '(skips the /clients crawl)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Crawl old and new UISP again instead of using the staged copies')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Log each update')
 
+    parser.add_argument('--profile', nargs='?', const='sample', choices=profiling.PROFILE_MODES,
+                        help='Profile the run: sample (flame graph stacks of every thread, default) or cprofile (main thread only)')
+
     args = parser.parse_args()
+    if args.estimate and not args.dry_run:
+        parser.error('--estimate projects a dry run: use it with --dry-run')
+    metrics.write_summary_at_exit(args.metrics_out)
+    if args.profile:
+        profiling.start(args.profile, 'import_pppoe')
 
     # Load config
     try:
@@ -354,10 +375,38 @@ def main():
         sys.exit(1)
 
     # Connect to both
-    old_api = UISPApi(old_url, old_token, verify_ssl=False)
-    new_api = UISPApi(new_url, new_token, verify_ssl=False)
-
-    if not old_api.test_connection():
+    old_api = UISPApi(old_url, old_token, verify_ssl=False, **client_options(config))
+    stage = staging.open_staging(config)
+    if stage and stage.cleared_new:
+        logger.warning(f"UISP_BASE_URL changed: cleared the new-UISP tables of {stage.path}")
+
+    if args.export_only:
+        if not old_api.test_connection():
+            logger.error("Cannot connect to old UISP.")
+            sys.exit(1)
+        json_codec.dump(build_pppoe_mapping(old_api, stage, refresh=True), PPPOE_EXPORT_FILE)
+        logger.info(f"Saved PPPoE usernames to {PPPOE_EXPORT_FILE}. Use --import-from to import later.")
+        sys.exit(0)
+
+    new_api = UISPApi(new_url, new_token, verify_ssl=False, **client_options(config))
+    queue = retry_queue.open_queue(config)
+
+    if args.retry_failed:
+        # PATCHes are idempotent, so every due entry is simply sent again
+        if not new_api.test_connection():
+            logger.error("Cannot connect to new UISP.")
+            sys.exit(1)
+        entries = queue.due(('pppoe',), args.retry_failed)
+        retry_queue.log_replay_start(queue, entries, ('pppoe',), args.retry_failed)
+        if entries:
+            apply_updates(new_api, [tuple(e.record) for e in entries], verbose=args.verbose,
+                          concurrency=args.concurrency or getattr(config, 'UISP_MAX_CONNECTIONS', 10),
+                          queue=queue, replay=True, stage=stage)
+        sys.exit(0)
+
+    # Old UISP is only read when the usernames are neither in a file nor staged
+    staged_pppoe = stage and not args.refresh and stage.dataset('old_pppoe')
+    if not args.import_from and not staged_pppoe and not old_api.test_connection():
         logger.error("Cannot connect to old UISP.")
         sys.exit(1)
     if not new_api.test_connection():
@@ -368,19 +417,32 @@ def main():
     if args.test:
         limit = 5
 
-    # Step 1: Get PPPoE usernames from old UISP
-    pppoe_map = build_pppoe_mapping(old_api)
+    # Step 1: Get PPPoE usernames from old UISP (or the --export-only file)
+    if args.import_from:
+        pppoe_map = json_codec.load(args.import_from)
+        logger.info(f"Loaded {len(pppoe_map)} PPPoE usernames from {args.import_from}")
+    else:
+        pppoe_map = build_pppoe_mapping(old_api, stage, args.refresh)
 
-    # Step 2: Build client ID mapping from new UISP
-    client_map = build_client_id_mapping(new_api)
+    # Step 2: Build client ID mapping from new UISP (or load a saved one)
+    if args.client_mapping:
+        client_map = json_codec.load(args.client_mapping)
+        logger.info(f"Loaded mapping for {len(client_map)} clients from {args.client_mapping}")
+    else:
+        client_map = build_client_id_mapping(new_api, stage, args.refresh)
 
     # Step 3: Build service mapping from new UISP
-    service_map = build_service_mapping(new_api)
+    service_map = build_service_mapping(new_api, stage, args.refresh)
 
     # Step 4: Import
-    import_pppoe(new_api, pppoe_map, client_map, service_map,
+    result = import_pppoe(new_api, pppoe_map, client_map, service_map,
                  dry_run=args.dry_run, limit=limit,
-                 resume_from=args.resume_from, verbose=args.verbose)
+                 resume_from=args.resume_from, verbose=args.verbose,
+                 concurrency=args.concurrency or 1, queue=None if args.dry_run else queue, stage=stage)
+    if args.estimate:
+        estimate.log_estimate(new_api, [estimate.Step('pppoe', result['would_update'],
+                                                      records=result['would_update'], pause=REQUEST_DELAY)],
+                              args.estimate, args.estimate_concurrency)
 
     logger.info(f"\nLog file: {log_file}")
 
@@ -0,0 +1,53 @@
+"""
+JSON encode/decode for API payloads and export files
+
+Uses orjson when it is installed (pip install orjson) and the standard
+library otherwise. orjson decodes straight from the response bytes and
+encodes to bytes, skipping the intermediate str, which matters for the
+10,000-record /clients and /clients/services pages and for large exports.
+
+Both backends produce the same Python objects, so files written by one can
+be read by the other.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional dependency - stdlib json is used instead
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def loads(data):
+    """Decode JSON from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    """Encode obj as UTF-8 JSON bytes (compact, or 2-space indented)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def dumps_text(obj):
+    """Encode obj as a compact JSON str"""
+    return dumps(obj).decode('utf-8')
+
+
+def load(path):
+    """Read a JSON file"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def dump(obj, path, indent=False):
+    """Write obj to a JSON file"""
+    with open(path, 'wb') as f:
+        f.write(dumps(obj, indent=indent))
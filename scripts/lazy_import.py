@@ -0,0 +1,33 @@
+"""
+Deferred imports of heavy optional packages
+
+pandas, pyarrow, requests and httpx take tens to hundreds of milliseconds
+to import. Modules bind them with lazy_import() instead, so importing a
+script (to reuse CSVParser, UISPApi, the export helpers, ...) costs nothing
+until the package is actually used:
+
+    pd = lazy_import('pandas')    # None if pandas is not installed
+    ...
+    pd.DataFrame(...)             # pandas is imported here, on first use
+
+Only top-level packages can be deferred this way: submodules such as
+pyarrow.parquet are imported where they are used.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Module name, imported on first attribute access; None if it is not installed"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,117 @@
+"""
+Non-blocking logging for the migration scripts
+
+The scripts log from tight per-record loops. Instead of writing to the
+console and log file synchronously, the root logger gets a QueueHandler and
+a background QueueListener does the formatting and I/O. The log file is
+flushed at most once a second (and on exit), so --verbose costs little more
+than putting a record on a queue.
+
+Structured per-record events go through audit_log to a separate NDJSON file
+on their own queue.
+"""
+
+import atexit
+import logging
+import queue
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listeners = []
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread.
+
+    Only the message arguments are resolved on the calling thread (so later
+    changes to them don't leak into the log); no copy of the record and no
+    timestamp formatting happens in the hot loop.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that flushes at most every flush_interval seconds"""
+
+    def __init__(self, filename, mode='a', encoding='utf-8', delay=False, flush_interval=1.0):
+        super().__init__(filename, mode=mode, encoding=encoding, delay=delay)
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            super().flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.flush()
+        finally:
+            self.release()
+        super().close()
+
+
+def start_queue_logger(logger, handlers):
+    """Route logger through a queue to handlers served by a background thread"""
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    _listeners.append((listener, handlers))
+    return listener
+
+
+def setup_logging(log_file=None, audit_file=None, level=logging.INFO):
+    """Configure queued console + file logging, and the NDJSON audit log.
+
+    Replaces logging.basicConfig(handlers=[StreamHandler(), FileHandler(...)]).
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(BufferedFileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    start_queue_logger(root, handlers)
+
+    if audit_file:
+        import audit_log
+        audit_log.open_audit_file(audit_file)
+
+
+def start_run(name, audit=False):
+    """Log one script run to the console and name_YYYYMMDD_HHMMSS.log (plus
+    name_YYYYMMDD_HHMMSS_audit.ndjson with audit); returns the log file name.
+
+    Called from each script's main(), so importing a script sets up nothing.
+    """
+    log_file = f'{name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
+    audit_file = log_file[:-len('.log')] + '_audit.ndjson' if audit else None
+    setup_logging(log_file, audit_file)
+    return log_file
+
+
+def stop_logging():
+    """Drain the queues and close the handlers (runs automatically at exit)"""
+    while _listeners:
+        listener, handlers = _listeners.pop()
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,219 @@
+"""
+Request metrics for the UISP migration scripts
+
+Every API call made through UISPApi is recorded here (endpoint, method,
+status, bytes and duration). The collector keeps per-endpoint latency
+histograms, renders a one-line live progress summary, and writes a
+machine-readable summary as JSON or Prometheus text format at exit.
+
+Endpoints are grouped by path with numeric IDs collapsed, so
+POST /clients/123/invoices and POST /clients/456/invoices both count as
+POST /clients/{id}/invoices.
+"""
+
+import atexit
+import json
+import logging
+import re
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds (Prometheus style, +Inf implied)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint_key(method, endpoint):
+    """Normalize 'GET /clients/12/services?limit=5' to 'GET /clients/{id}/services'"""
+    path = endpoint.split('?', 1)[0]
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', path)
+    return f"{method.upper()} {path}"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class EndpointStats:
+    """Counters and latency samples for one METHOD /path"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.durations = array('d')
+
+    def add(self, status, bytes_sent, bytes_received, duration):
+        self.count += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.total_seconds += duration
+        self.durations.append(duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def summary(self):
+        ordered = sorted(self.durations)
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'statuses': {str(k): v for k, v in self.statuses.items()},
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'total_seconds': round(self.total_seconds, 3),
+            'mean_ms': round(self.total_seconds / self.count * 1000, 2) if self.count else None,
+            'p50_ms': round(percentile(ordered, 50) * 1000, 2) if ordered else None,
+            'p95_ms': round(percentile(ordered, 95) * 1000, 2) if ordered else None,
+            'p99_ms': round(percentile(ordered, 99) * 1000, 2) if ordered else None,
+            'max_ms': round(ordered[-1] * 1000, 2) if ordered else None,
+        }
+
+
+class MetricsCollector:
+    """Thread-safe per-endpoint request metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+
+    def record(self, method, endpoint, status, bytes_sent, bytes_received, duration):
+        """Record one HTTP attempt. status is the HTTP code or an error name."""
+        key = endpoint_key(method, endpoint)
+        with self._lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.add(status, bytes_sent, bytes_received, duration)
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.endpoints = {}
+
+    @property
+    def total_requests(self):
+        return sum(s.count for s in self.endpoints.values())
+
+    def summary(self):
+        with self._lock:
+            endpoints = {key: stats.summary() for key, stats in sorted(self.endpoints.items())}
+        elapsed = time.time() - self.started
+        total = sum(e['count'] for e in endpoints.values())
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'total_requests': total,
+            'total_errors': sum(e['errors'] for e in endpoints.values()),
+            'requests_per_second': round(total / elapsed, 2) if elapsed > 0 else None,
+            'endpoints': endpoints,
+        }
+
+    def progress_line(self):
+        """Compact live status: overall rate plus the slowest endpoint by time spent"""
+        with self._lock:
+            items = list(self.endpoints.items())
+        if not items:
+            return "no requests yet"
+        elapsed = time.time() - self.started
+        total = sum(s.count for _, s in items)
+        errors = sum(s.errors for _, s in items)
+        key, slowest = max(items, key=lambda item: item[1].total_seconds)
+        mean_ms = slowest.total_seconds / slowest.count * 1000
+        return (f"{total} req ({total / elapsed if elapsed > 0 else 0:.1f}/s), {errors} err | "
+                f"most time: {key} {slowest.count}x avg {mean_ms:.0f}ms")
+
+    def to_prometheus(self):
+        """Render the metrics in Prometheus text exposition format"""
+        lines = [
+            '# HELP uisp_request_duration_seconds UISP API request latency',
+            '# TYPE uisp_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            items = sorted(self.endpoints.items())
+        for key, stats in items:
+            method, path = key.split(' ', 1)
+            labels = f'method="{method}",endpoint="{path}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'uisp_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'uisp_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f'uisp_request_duration_seconds_sum{{{labels}}} {stats.total_seconds:.6f}')
+            lines.append(f'uisp_request_duration_seconds_count{{{labels}}} {stats.count}')
+
+        lines += ['# HELP uisp_requests_total UISP API requests by status',
+                  '# TYPE uisp_requests_total counter']
+        for key, stats in items:
+            method, path = key.split(' ', 1)
+            for status, count in sorted(stats.statuses.items(), key=lambda x: str(x[0])):
+                lines.append(f'uisp_requests_total{{method="{method}",endpoint="{path}",status="{status}"}} {count}')
+
+        lines += ['# HELP uisp_response_bytes_total Response body bytes received',
+                  '# TYPE uisp_response_bytes_total counter']
+        for key, stats in items:
+            method, path = key.split(' ', 1)
+            lines.append(f'uisp_response_bytes_total{{method="{method}",endpoint="{path}"}} {stats.bytes_received}')
+
+        lines += ['# HELP uisp_request_bytes_total Request body bytes sent',
+                  '# TYPE uisp_request_bytes_total counter']
+        for key, stats in items:
+            method, path = key.split(' ', 1)
+            lines.append(f'uisp_request_bytes_total{{method="{method}",endpoint="{path}"}} {stats.bytes_sent}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the summary to path: Prometheus text for .prom/.txt, JSON otherwise"""
+        if path.endswith(('.prom', '.txt')):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def log_summary(self):
+        """Log a per-endpoint table, slowest endpoints (by total time) first"""
+        summary = self.summary()
+        if not summary['total_requests']:
+            return
+        logger.info("\n" + "=" * 60)
+        logger.info("API REQUEST METRICS")
+        logger.info("=" * 60)
+        logger.info(f"Requests: {summary['total_requests']} in {summary['elapsed_seconds']:.1f}s "
+                    f"({summary['requests_per_second']}/s), errors: {summary['total_errors']}")
+        ordered = sorted(summary['endpoints'].items(), key=lambda x: -x[1]['total_seconds'])
+        for key, e in ordered:
+            logger.info(f"  {key:40} {e['count']:>7}x  p50 {e['p50_ms']:>8}ms  p99 {e['p99_ms']:>8}ms  "
+                        f"total {e['total_seconds']:>8.1f}s  err {e['errors']}")
+
+
+# Shared by every UISPApi instance unless one is passed explicitly
+collector = MetricsCollector()
+
+
+def write_summary_at_exit(path=None, metrics=None):
+    """Log the metrics table (and write it to path) when the script exits"""
+    metrics = metrics or collector
+
+    def _finish():
+        metrics.log_summary()
+        if path:
+            metrics.write(path)
+            logger.info(f"Request metrics written to {path}")
+
+    atexit.register(_finish)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+UISP Migration Orchestrator
+
+Runs the whole cutover as one dependency graph instead of export_services.py,
+import_clients.py, import_pppoe.py and import_invoices.py by hand in a fixed
+order. Every step is one of those scripts in its own process; a step starts
+as soon as the steps it needs are done, so the old-UISP exports run while
+the clients are imported:
+
+    step              runs                                    writes                     after
+    export_plans      export_services.py --plans-only         service_plans_export.json  -
+    export_services   export_services.py --skip-plans         services_export.json       -
+    export_invoices   import_invoices.py --export-only        invoices_export.json       -
+    export_pppoe      import_pppoe.py --export-only           pppoe_export.json          -
+    import_clients    import_clients.py                       (new UISP)                 -
+    client_mapping    import_invoices.py --export-mapping     client_mapping.json        import_clients
+    import_pppoe      import_pppoe.py --import-from ...       (new UISP)                 export_pppoe, client_mapping
+    import_invoices   import_invoices.py --import-from ...    (new UISP)                 export_invoices, client_mapping
+
+The new-UISP /clients crawl happens once (client_mapping) instead of once
+per importer, and the old UISP is only read by the export steps.
+
+Finished steps are recorded in migrate_state.json. A re-run skips a step
+when it finished with the same arguments (--concurrency and --priority aside), its output
+files still exist and none of the steps it depends on has run since;
+everything else (and everything after it) runs again. The exception is
+import_clients and import_invoices: they create records, so once done they
+are only repeated with --force. Records that fail inside a step go to the
+retry queue as usual (see retry_queue.py) and do not fail the step.
+
+Usage:
+    python migrate.py                          # Run every step that is not done yet
+    python migrate.py --plan                   # Show the steps and which would run
+    python migrate.py --steps client_mapping   # One step (and the steps it needs)
+    python migrate.py --force import_invoices  # Re-run a step and the steps after it
+    python migrate.py --test                   # Trial run: --test for every step
+
+Options:
+    --plan              Show the steps, their status and what would run, then exit
+    --steps A,B         Run only these steps and the unfinished steps they depend on
+    --force A,B|all     Re-run these steps (and their dependents) even if done
+    --jobs N            Steps to run at the same time (default: every step that is ready)
+    --concurrency N     Passed to import_pppoe.py and import_invoices.py
+    --priority          Import active clients and unpaid invoices first (import_clients
+                        then also waits for export_services, to rank by service status)
+    --format FMT        Services/invoices export format: json (default), parquet or feather
+    --test              Pass --test to every step
+    --state FILE        Step state file (default: migrate_state.json)
+"""
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import export_store
+import json_codec
+import log_setup
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_FILE = 'migrate_state.json'
+CLIENT_MAPPING_FILE = 'client_mapping.json'
+PPPOE_EXPORT_FILE = 'pppoe_export.json'
+
+_print_lock = threading.Lock()
+
+
+class Step:
+    """One script run in the migration graph.
+
+    tuning args (e.g. --concurrency) don't change what a step produces, so
+    they are not part of its identity. A step that creates records in the
+    new UISP is never repeated on its own, since that would create them again.
+    """
+
+    __slots__ = ('name', 'script', 'args', 'outputs', 'deps', 'tuning', 'creates')
+
+    def __init__(self, name, script, args=(), outputs=(), deps=(), tuning=(), creates=False):
+        self.name = name
+        self.script = script
+        self.args = list(args)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.tuning = list(tuning)
+        self.creates = creates
+
+    @property
+    def identity(self):
+        """What a finished run is recorded as: script and arguments, minus tuning"""
+        return [self.script] + self.args
+
+    @property
+    def command(self):
+        return [self.script] + self.args + self.tuning
+
+
+def build_steps(fmt='json', test=False, concurrency=None, prioritize=False):
+    """The migration steps in dependency (topological) order"""
+    services_file = export_store.export_path('services_export.json', fmt)
+    invoices_file = export_store.export_path('invoices_export.json', fmt)
+    common = ['--test'] if test else []
+    parallel = ['--concurrency', str(concurrency)] if concurrency else []
+    ordering = ['--priority'] if prioritize else []
+
+    return [
+        Step('export_plans', 'export_services.py', ['--plans-only'] + common,
+             outputs=['service_plans_export.json']),
+        Step('export_services', 'export_services.py', ['--skip-plans', '--format', fmt] + common,
+             outputs=[services_file]),
+        Step('export_invoices', 'import_invoices.py', ['--export-only', '--format', fmt] + common,
+             outputs=[invoices_file]),
+        Step('export_pppoe', 'import_pppoe.py', ['--export-only'] + common,
+             outputs=[PPPOE_EXPORT_FILE]),
+        Step('import_clients', 'import_clients.py', common,
+             deps=['export_services'] if prioritize else [], tuning=ordering, creates=True),
+        Step('client_mapping', 'import_invoices.py', ['--export-mapping', CLIENT_MAPPING_FILE],
+             outputs=[CLIENT_MAPPING_FILE], deps=['import_clients']),
+        Step('import_pppoe', 'import_pppoe.py',
+             ['--import-from', PPPOE_EXPORT_FILE, '--client-mapping', CLIENT_MAPPING_FILE] + common,
+             deps=['export_pppoe', 'client_mapping'], tuning=parallel),
+        Step('import_invoices', 'import_invoices.py',
+             ['--import-from', invoices_file, '--client-mapping', CLIENT_MAPPING_FILE] + common,
+             deps=['export_invoices', 'client_mapping'], tuning=parallel + ordering, creates=True),
+    ]
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    return json_codec.load(path)
+
+
+def save_state(state, path):
+    """Write the state file atomically, so an interrupted run never leaves half of it"""
+    tmp_path = path + '.tmp'
+    json_codec.dump(state, tmp_path, indent=True)
+    os.replace(tmp_path, path)
+
+
+def is_done(step, state):
+    """Did step finish with these arguments and are its outputs still there?
+    (For steps that don't create records: and no dependency ran after it started?)"""
+    record = state.get(step.name)
+    if not record or record.get('status') != 'done' or record.get('command') != step.identity:
+        return False
+    if not all(os.path.exists(path) for path in step.outputs):
+        return False
+    return step.creates or all(state.get(dep, {}).get('finished', 0) <= record['started']
+                               for dep in step.deps)
+
+
+def plan_run(steps, state, targets=None, force=()):
+    """Names of the steps to run, in order.
+
+    A step runs when it is not done, is forced, or depends on a step that
+    runs (unless it creates records and is done: that needs --force). With
+    targets, only those steps and their dependencies are considered.
+    """
+    by_name = {step.name: step for step in steps}
+    wanted = set(by_name)
+    if targets:
+        wanted = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in wanted:
+                wanted.add(name)
+                todo.extend(by_name[name].deps)
+
+    stale = set()
+    for step in steps:
+        if step.name not in wanted:
+            continue
+        if step.name in force or 'all' in force or not is_done(step, state):
+            stale.add(step.name)
+            continue
+        started = state[step.name]['started']
+        newer = [dep for dep in step.deps
+                 if dep in stale or state.get(dep, {}).get('finished', 0) > started]
+        if newer and not step.creates:
+            stale.add(step.name)
+        elif newer:
+            logger.warning(f"{step.name} is done and is not repeated after {', '.join(newer)} "
+                           f"(it would create the records again); use --force {step.name} for that")
+    return [step.name for step in steps if step.name in stale]
+
+
+def run_step(step):
+    """Run one step's script; its output goes to the console prefixed with the step name"""
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, step.script)] + step.args + step.tuning
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, bufsize=1)
+    for line in proc.stdout:
+        with _print_lock:
+            sys.stdout.write(f"[{step.name}] {line}")
+    return proc.wait()
+
+
+def run_graph(steps, to_run, state, state_file, jobs=None):
+    """Run the steps in to_run as their dependencies finish.
+
+    Steps not in to_run are taken as done. When a step fails, the steps
+    that depend on it are not started; independent steps carry on.
+    Returns {step name: 'done' | 'failed' | 'blocked'}.
+    """
+    by_name = {step.name: step for step in steps}
+    pending = list(to_run)
+    results = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs or len(to_run) or 1, thread_name_prefix='step') as pool:
+        while pending or running:
+            for name in list(pending):
+                deps = by_name[name].deps
+                if any(results.get(dep) in ('failed', 'blocked') for dep in deps):
+                    logger.warning(f"Not running {name}: a step it depends on failed")
+                    results[name] = 'blocked'
+                    pending.remove(name)
+                elif all(dep not in pending and dep not in running.values() for dep in deps) \
+                        and len(running) < (jobs or len(to_run)):
+                    step = by_name[name]
+                    logger.info(f"Starting {name}: {' '.join(step.command)}")
+                    state[name] = {'command': step.identity, 'started': time.time(), 'status': 'running'}
+                    running[pool.submit(run_step, step)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                record = state[name]
+                record['finished'] = time.time()
+                record['duration'] = round(record['finished'] - record['started'], 3)
+                try:
+                    returncode = future.result()
+                except OSError as e:
+                    logger.error(f"{name} could not be started: {e}")
+                    returncode = -1
+                record['status'] = results[name] = 'done' if returncode == 0 else 'failed'
+                if returncode == 0:
+                    logger.info(f"Finished {name} in {record['duration']:.1f}s")
+                else:
+                    logger.error(f"{name} failed (exit code {returncode}) after {record['duration']:.1f}s")
+                save_state(state, state_file)
+    return results
+
+
+def critical_path(steps, state):
+    """(step names, seconds) of the longest chain of recorded step durations"""
+    longest = {}  # name -> (seconds, chain)
+    for step in steps:
+        duration = state.get(step.name, {}).get('duration', 0)
+        before = max((longest[dep] for dep in step.deps), default=(0, []))
+        longest[step.name] = (before[0] + duration, before[1] + [step.name])
+    seconds, chain = max(longest.values(), default=(0, []))
+    return chain, seconds
+
+
+def log_plan(steps, state, to_run):
+    logger.info(f"{'step':16} {'status':8} {'last run':>9}  after")
+    for step in steps:
+        record = state.get(step.name, {})
+        if step.name in to_run:
+            status = 'run'
+        else:
+            status = 'done' if is_done(step, state) else 'skip'
+        last = f"{record['duration']:.1f}s" if 'duration' in record else '-'
+        logger.info(f"{step.name:16} {status:8} {last:>9}  {', '.join(step.deps) or '-'}")
+
+
+def main():
+    log_file = log_setup.start_run('migrate')
+    parser = argparse.ArgumentParser(
+        description='Run the UISP migration steps as a dependency graph',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--plan', action='store_true',
+                        help='Show the steps and which would run, then exit')
+    parser.add_argument('--steps', type=str, default=None,
+                        help='Comma-separated steps to run (plus the unfinished steps they need)')
+    parser.add_argument('--force', type=str, default='',
+                        help='Comma-separated steps to re-run even if done, or "all"')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Steps to run at the same time (default: all that are ready)')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Passed to import_pppoe.py and import_invoices.py')
+    parser.add_argument('--priority', action='store_true',
+                        help='Import active clients and unpaid invoices first (passed to '
+                             'import_clients.py and import_invoices.py)')
+    parser.add_argument('--format', choices=export_store.EXPORT_FORMATS, default='json',
+                        help='Services/invoices export file format (parquet/feather need pyarrow)')
+    parser.add_argument('--test', action='store_true',
+                        help='Pass --test to every step')
+    parser.add_argument('--state', type=str, default=DEFAULT_STATE_FILE,
+                        help='Step state file')
+    args = parser.parse_args()
+
+    steps = build_steps(args.format, args.test, args.concurrency, args.priority)
+    names = [step.name for step in steps]
+    targets = [name for name in args.steps.split(',') if name] if args.steps else None
+    force = [name for name in args.force.split(',') if name]
+    unknown = [name for name in (targets or []) + force if name not in names and name != 'all']
+    if unknown:
+        parser.error(f"unknown step(s): {', '.join(unknown)} (steps: {', '.join(names)})")
+
+    state = load_state(args.state)
+    to_run = plan_run(steps, state, targets, force)
+    log_plan(steps, state, to_run)
+    if args.plan:
+        return
+    if not to_run:
+        logger.info("Nothing to do: every step is done (use --force to re-run)")
+        return
+
+    start = time.time()
+    results = run_graph(steps, to_run, state, args.state, args.jobs)
+    elapsed = time.time() - start
+
+    chain, seconds = critical_path(steps, state)
+    total = sum(state.get(name, {}).get('duration', 0) for name in names)
+    logger.info(f"\nRan {len(results)} steps in {elapsed:.1f}s ({total:.1f}s of step time overall)")
+    logger.info(f"Critical path: {' -> '.join(chain)} ({seconds:.1f}s)")
+    logger.info(f"Log file: {log_file}")
+
+    not_done = [name for name, result in results.items() if result != 'done']
+    if not_done:
+        logger.error(f"Not finished: {', '.join(not_done)}. Fix the cause and run migrate.py again.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
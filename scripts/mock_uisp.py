@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+"""
+Mock UISP CRM API Server
+
+Local stand-in for the UISP CRM endpoints the migration scripts use, so the
+importers can be exercised and load tested without a real UISP instance.
+Data is kept in memory and can be seeded from export files.
+
+Usage:
+    python mock_uisp.py --port 8080
+    python mock_uisp.py --port 8080 --latency-ms 40 --jitter-ms 20 --rate-limit 0.02
+    python mock_uisp.py --clients old_clients.json --services services_export.json \\
+                        --invoices invoices_export.json
+
+    Then point config.py at it, e.g.
+        UISP_BASE_URL = "http://127.0.0.1:8080"
+        OLD_UISP_BASE_URL = "http://127.0.0.1:8081"
+
+Endpoints (under /crm/api/v1.0):
+    GET    /organizations
+    GET    /service-plans
+    GET    /clients                 POST   /clients        DELETE /clients/{id}
+    GET    /clients/services        POST   /clients/{id}/services
+    PATCH  /clients/services/{id}   DELETE /clients/services/{id}
+    GET    /invoices                POST   /clients/{id}/invoices
+    DELETE /invoices/{id}
+    GET    /payments                POST   /payments       DELETE /payments/{id}
+
+    GET    /_mock/stats             Request counters (not part of UISP)
+
+    GET responses carry an ETag; a matching If-None-Match gets 304 Not Modified.
+
+Options:
+    --latency-ms N     Base latency added to every request
+    --jitter-ms N      Random extra latency (0..N ms)
+    --rate-limit P     Probability (0-1) of answering 429 Too Many Requests
+    --retry-after N    Retry-After seconds sent with injected 429s
+    --error-rate P     Probability (0-1) of answering 503 Service Unavailable
+    --max-page-size N  Cap on limit= for paginated GETs (0 = no cap)
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/crm/api/v1.0'
+PPPOE_ATTR_ID = 2  # Service-level pppoeusername attribute on new UISP
+
+DEFAULT_PLANS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'service_plans_export.json')
+
+
+class MockError(Exception):
+    """Error answered to the client with an HTTP status code"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class MockUISPState:
+    """In-memory UISP CRM data"""
+
+    def __init__(self, plans=None, clients=None, services=None, invoices=None, payments=None):
+        self.lock = threading.Lock()
+        self.organizations = [{'id': 1, 'name': 'Mock Organization', 'currencyCode': 'PHP'}]
+        self.plans = list(plans or [])
+        self.clients = {c['id']: c for c in clients or []}
+        self.services = {s['id']: s for s in services or []}
+        self.invoices = {i['id']: i for i in invoices or []}
+        self.payments = {p['id']: p for p in payments or []}
+        self._next_ids = {
+            'clients': max(self.clients, default=0) + 1,
+            'services': max(self.services, default=0) + 1,
+            'invoices': max(self.invoices, default=0) + 1,
+            'payments': max(self.payments, default=0) + 1,
+        }
+
+        # servicePlanPeriodId -> (plan, period)
+        self.periods = {}
+        for plan in self.plans:
+            for period in plan.get('periods', []):
+                self.periods[period['id']] = (plan, period)
+
+    def next_id(self, kind):
+        new_id = self._next_ids[kind]
+        self._next_ids[kind] += 1
+        return new_id
+
+    # --- clients -------------------------------------------------------
+
+    def create_client(self, data):
+        if not (data.get('companyName') or (data.get('firstName') and data.get('lastName'))):
+            raise MockError(422, 'firstName and lastName (or companyName) are required')
+        if not data.get('countryId'):
+            raise MockError(422, 'countryId is required')
+        with self.lock:
+            client = dict(data, id=self.next_id('clients'), attributes=data.get('attributes', []))
+            self.clients[client['id']] = client
+        return client
+
+    def delete_client(self, client_id):
+        with self.lock:
+            if self.clients.pop(client_id, None) is None:
+                raise MockError(404, f'Client {client_id} not found')
+            for service_id in [s['id'] for s in self.services.values() if s['clientId'] == client_id]:
+                del self.services[service_id]
+        return {}
+
+    # --- services ------------------------------------------------------
+
+    def create_service(self, client_id, data):
+        if client_id not in self.clients:
+            raise MockError(404, f'Client {client_id} not found')
+        period_id = data.get('servicePlanPeriodId')
+        if period_id not in self.periods:
+            raise MockError(422, f'servicePlanPeriodId {period_id} is not valid')
+        plan, period = self.periods[period_id]
+        with self.lock:
+            service = dict(data,
+                           id=self.next_id('services'),
+                           clientId=client_id,
+                           servicePlanId=plan['id'],
+                           servicePlanName=plan['name'],
+                           name=plan['name'],
+                           price=period.get('price'),
+                           status=1,
+                           attributes=data.get('attributes', []))
+            self.services[service['id']] = service
+        return service
+
+    def patch_service(self, service_id, data):
+        with self.lock:
+            service = self.services.get(service_id)
+            if service is None:
+                raise MockError(404, f'Service {service_id} not found')
+            for attr in data.get('attributes', []):
+                attrs = [a for a in service['attributes']
+                         if a.get('customAttributeId') != attr.get('customAttributeId')]
+                attrs.append({'customAttributeId': attr.get('customAttributeId'),
+                              'value': attr.get('value')})
+                service['attributes'] = attrs
+            service.update({k: v for k, v in data.items() if k != 'attributes'})
+        return service
+
+    def delete_service(self, service_id):
+        with self.lock:
+            if self.services.pop(service_id, None) is None:
+                raise MockError(404, f'Service {service_id} not found')
+        return {}
+
+    # --- invoices and payments -----------------------------------------
+
+    def create_invoice(self, client_id, data):
+        if client_id not in self.clients:
+            raise MockError(404, f'Client {client_id} not found')
+        items = data.get('items') or []
+        if not items:
+            raise MockError(422, 'items must not be empty')
+        total = round(sum((i.get('price') or 0) * (i.get('quantity') or 1) for i in items), 2)
+        with self.lock:
+            invoice = dict(data,
+                           id=self.next_id('invoices'),
+                           clientId=client_id,
+                           total=total,
+                           amountPaid=0,
+                           status=1,
+                           currencyCode='PHP',
+                           createdDate=data.get('createdDate') or datetime.now().strftime('%Y-%m-%dT%H:%M:%S+0800'))
+            self.invoices[invoice['id']] = invoice
+        return invoice
+
+    def delete_invoice(self, invoice_id):
+        with self.lock:
+            if self.invoices.pop(invoice_id, None) is None:
+                raise MockError(404, f'Invoice {invoice_id} not found')
+        return {}
+
+    def create_payment(self, data):
+        for field in ('clientId', 'amount', 'methodId'):
+            if data.get(field) in (None, ''):
+                raise MockError(422, f'{field} is required')
+        if data['clientId'] not in self.clients:
+            raise MockError(422, f"Client {data['clientId']} not found")
+        with self.lock:
+            payment = dict(data, id=self.next_id('payments'))
+            self.payments[payment['id']] = payment
+            remaining = data['amount']
+            for invoice_id in data.get('invoiceIds') or []:
+                invoice = self.invoices.get(invoice_id)
+                if invoice is None or remaining <= 0:
+                    continue
+                applied = min(remaining, invoice['total'] - invoice['amountPaid'])
+                invoice['amountPaid'] = round(invoice['amountPaid'] + applied, 2)
+                invoice['status'] = 3 if invoice['amountPaid'] >= invoice['total'] else 2
+                remaining -= applied
+        return payment
+
+    def delete_payment(self, payment_id):
+        with self.lock:
+            if self.payments.pop(payment_id, None) is None:
+                raise MockError(404, f'Payment {payment_id} not found')
+        return {}
+
+
+class MockUISPHandler(BaseHTTPRequestHandler):
+    """Routes UISP CRM API requests to MockUISPState"""
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like a real nginx front end
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes
+
+    ROUTES = [
+        ('GET', r'/organizations', 'list_organizations'),
+        ('GET', r'/service-plans', 'list_plans'),
+        ('GET', r'/clients', 'list_clients'),
+        ('POST', r'/clients', 'create_client'),
+        ('DELETE', r'/clients/(\d+)', 'delete_client'),
+        ('GET', r'/clients/services', 'list_services'),
+        ('POST', r'/clients/(\d+)/services', 'create_service'),
+        ('PATCH', r'/clients/services/(\d+)', 'patch_service'),
+        ('DELETE', r'/clients/services/(\d+)', 'delete_service'),
+        ('GET', r'/invoices', 'list_invoices'),
+        ('POST', r'/clients/(\d+)/invoices', 'create_invoice'),
+        ('DELETE', r'/invoices/(\d+)', 'delete_invoice'),
+        ('GET', r'/payments', 'list_payments'),
+        ('POST', r'/payments', 'create_payment'),
+        ('DELETE', r'/payments/(\d+)', 'delete_payment'),
+    ]
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _dispatch(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        body = self._read_body()
+
+        if url.path == '/_mock/stats':
+            return self._send(200, server.stats_snapshot())
+
+        server.count_request(method, url.path)
+
+        if server.api_key and self.headers.get('X-Auth-App-Key') != server.api_key:
+            return self._send(401, {'code': 401, 'message': 'Invalid App Key'})
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            server.count_server_error()
+            return self._send(503, {'code': 503, 'message': 'Service Unavailable'})
+
+        if server.rate_limit and random.random() < server.rate_limit:
+            server.count_rate_limited()
+            return self._send(429, {'code': 429, 'message': 'Too Many Requests'},
+                              headers={'Retry-After': str(server.retry_after)})
+
+        if not url.path.startswith(API_PREFIX):
+            return self._send(404, {'code': 404, 'message': 'Not found'})
+        path = url.path[len(API_PREFIX):].rstrip('/') or '/'
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        for route_method, pattern, handler_name in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                args = [int(g) for g in match.groups()]
+                try:
+                    if method in ('POST', 'PATCH'):
+                        if not isinstance(body, dict):
+                            raise MockError(400, 'Request body must be a JSON object')
+                        args.append(body)
+                    handler = getattr(self, handler_name, None)
+                    if handler is not None:
+                        result = handler(query) if method == 'GET' else handler(*args)
+                    else:
+                        result = getattr(self.state, handler_name)(*args)
+                except MockError as e:
+                    return self._send(e.status, {'code': e.status, 'message': e.message})
+                except Exception as e:
+                    # Answer like a failing server instead of dropping the connection
+                    logger.exception(f"{method} {path} failed")
+                    return self._send(500, {'code': 500, 'message': f'Internal error: {e}'})
+                status = 201 if method == 'POST' else 200
+                return self._send(status, result, conditional=method == 'GET')
+
+        self._send(404, {'code': 404, 'message': f'No route for {method} {path}'})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        raw = self.rfile.read(length)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def _send(self, status, payload, headers=None, conditional=False):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        if conditional:
+            # ETag over the body; If-None-Match with the same tag gets a 304
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                self.server.count_not_modified()
+                status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _paginate(self, records, query):
+        offset = int(query.get('offset', 0) or 0)
+        limit = int(query.get('limit', 0) or 0) or len(records)
+        if self.server.max_page_size:
+            limit = min(limit, self.server.max_page_size)
+        return records[offset:offset + limit]
+
+    # --- collection GETs -------------------------------------------------
+
+    def list_organizations(self, query):
+        return self.state.organizations
+
+    def list_plans(self, query):
+        return self.state.plans
+
+    def list_clients(self, query):
+        with self.state.lock:
+            clients = sorted(self.state.clients.values(), key=lambda c: c['id'])
+        if query.get('userIdent'):
+            clients = [c for c in clients if str(c.get('userIdent')) == query['userIdent']]
+        return self._paginate(clients, query)
+
+    def list_services(self, query):
+        with self.state.lock:
+            services = sorted(self.state.services.values(), key=lambda s: s['id'])
+        if query.get('clientId'):
+            services = [s for s in services if str(s['clientId']) == query['clientId']]
+        return self._paginate(services, query)
+
+    def list_invoices(self, query):
+        with self.state.lock:
+            invoices = sorted(self.state.invoices.values(), key=lambda i: i['id'])
+        if query.get('clientId'):
+            invoices = [i for i in invoices if str(i['clientId']) == query['clientId']]
+        return self._paginate(invoices, query)
+
+    def list_payments(self, query):
+        with self.state.lock:
+            payments = sorted(self.state.payments.values(), key=lambda p: p['id'])
+        return self._paginate(payments, query)
+
+
+class MockUISPServer(ThreadingHTTPServer):
+    """Threaded mock UISP server with latency, 429 and 503 injection"""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), state=None, latency_ms=0, jitter_ms=0,
+                 rate_limit=0.0, retry_after=1, max_page_size=0, api_key=None, error_rate=0.0):
+        super().__init__(address, MockUISPHandler)
+        self.state = state or MockUISPState()
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.max_page_size = max_page_size
+        self.api_key = api_key
+        self._stats_lock = threading.Lock()
+        self._requests = Counter()
+        self._rate_limited = 0
+        self._server_errors = 0
+        self._not_modified = 0
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self, method, path):
+        # Collapse numeric IDs so counters group by endpoint
+        endpoint = re.sub(r'/\d+', '/{id}', path[len(API_PREFIX):] if path.startswith(API_PREFIX) else path)
+        with self._stats_lock:
+            self._requests[f"{method} {endpoint}"] += 1
+
+    def count_rate_limited(self):
+        with self._stats_lock:
+            self._rate_limited += 1
+
+    def count_server_error(self):
+        with self._stats_lock:
+            self._server_errors += 1
+
+    def count_not_modified(self):
+        with self._stats_lock:
+            self._not_modified += 1
+
+    def stats_snapshot(self):
+        with self._stats_lock:
+            return {
+                'requests': dict(self._requests),
+                'total_requests': sum(self._requests.values()),
+                'rate_limited': self._rate_limited,
+                'server_errors': self._server_errors,
+                'not_modified': self._not_modified,
+                'clients': len(self.state.clients),
+                'services': len(self.state.services),
+                'invoices': len(self.state.invoices),
+                'payments': len(self.state.payments),
+            }
+
+    def start(self):
+        """Serve in a background thread (for benchmarks and scripted runs)"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def load_json(path):
+    if not path:
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a local mock UISP CRM API server',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Base latency per request in milliseconds')
+    parser.add_argument('--jitter-ms', type=float, default=0,
+                        help='Random extra latency per request in milliseconds')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='Probability of answering 429 (0-1)')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds for injected 429s')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability (0-1) of answering 503 Service Unavailable')
+    parser.add_argument('--max-page-size', type=int, default=0,
+                        help='Cap limit= on paginated GETs (0 = no cap)')
+    parser.add_argument('--api-key', default=None,
+                        help='Require this X-Auth-App-Key (default: accept any)')
+    parser.add_argument('--plans', default=DEFAULT_PLANS_FILE,
+                        help='Service plans JSON to serve')
+    parser.add_argument('--clients', default=None,
+                        help='Seed clients from a JSON array')
+    parser.add_argument('--services', default=None,
+                        help='Seed services from a JSON array')
+    parser.add_argument('--invoices', default=None,
+                        help='Seed invoices from a JSON array')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Log every request')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    state = MockUISPState(
+        plans=load_json(args.plans),
+        clients=load_json(args.clients),
+        services=load_json(args.services),
+        invoices=load_json(args.invoices),
+    )
+    server = MockUISPServer(
+        (args.host, args.port), state,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        rate_limit=args.rate_limit, retry_after=args.retry_after,
+        max_page_size=args.max_page_size, api_key=args.api_key,
+        error_rate=args.error_rate
+    )
+
+    logger.info(f"Mock UISP listening on {server.base_url} "
+                f"({len(state.plans)} plans, {len(state.clients)} clients, "
+                f"{len(state.services)} services, {len(state.invoices)} invoices)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        logger.info(f"Request stats: {json.dumps(server.stats_snapshot())}")
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
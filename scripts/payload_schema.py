@@ -0,0 +1,207 @@
+"""
+Local validation of the payloads the import scripts send to UISP
+
+import_clients.py and import_invoices.py build every client, service,
+invoice and payment payload up front and check it against the schemas
+below before the first request, so a record UISP would reject with a 4xx
+(no name, missing countryId, unknown servicePlanPeriodId, a date without
+the +0800 offset, an empty invoice) is reported without a round trip and
+never reaches the sender.
+
+The schemas cover only the fields these scripts send; they are not a
+complete description of the UISP CRM API.
+"""
+
+import re
+from datetime import datetime
+
+# UISP's date format: 2024-01-31T00:00:00+0800 (offset without a colon)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{4}$')
+_EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+class Field:
+    """One payload field: accepted types, whether it is required, extra check"""
+
+    __slots__ = ('types', 'required', 'check')
+
+    def __init__(self, types, required=False, check=None):
+        self.types = types
+        self.required = required
+        self.check = check  # value -> error message or None
+
+
+def check_date(value):
+    if not _ISO_DATE.match(value):
+        return f"'{value}' is not a UISP date (YYYY-MM-DDTHH:MM:SS+0800)"
+    try:
+        datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        return f"'{value}' is not a valid date"
+    return None
+
+
+def check_range(low, high):
+    def check(value):
+        if not low <= value <= high:
+            return f"{value} is outside {low}..{high}"
+        return None
+    return check
+
+
+def check_positive(value):
+    return None if value > 0 else f"{value} must be greater than 0"
+
+
+def check_not_negative(value):
+    return None if value >= 0 else f"{value} must not be negative"
+
+
+def check_not_blank(value):
+    return None if value.strip() else "must not be blank"
+
+
+def check_currency(value):
+    return None if re.match(r'^[A-Z]{3}$', value) else f"'{value}' is not a currency code"
+
+
+def check_contacts(contacts):
+    for contact in contacts:
+        if not isinstance(contact, dict):
+            return "each contact must be an object"
+        email = contact.get('email')
+        if email and not _EMAIL.match(email):
+            return f"'{email}' is not a valid email address"
+    return None
+
+
+def check_items(items):
+    if not items:
+        return "must not be empty"
+    for n, item in enumerate(items, 1):
+        errors = validate(item, INVOICE_ITEM_SCHEMA) if isinstance(item, dict) else ['must be an object']
+        if errors:
+            return f"item {n}: {errors[0]}"
+    return None
+
+
+def check_ids(ids):
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return "must contain only integer IDs"
+    return None
+
+
+NUMBER = (int, float)
+
+CLIENT_SCHEMA = {
+    'firstName': Field(str),
+    'lastName': Field(str),
+    'companyName': Field(str),
+    'isLead': Field(bool),
+    'street1': Field(str),
+    'street2': Field(str),
+    'city': Field(str),
+    'countryId': Field(int, required=True, check=check_positive),
+    'zipCode': Field(str),
+    'userIdent': Field(str),
+    'note': Field(str),
+    'addressGpsLat': Field(NUMBER, check=check_range(-90, 90)),
+    'addressGpsLon': Field(NUMBER, check=check_range(-180, 180)),
+    'contacts': Field(list, check=check_contacts),
+}
+
+SERVICE_SCHEMA = {
+    'servicePlanPeriodId': Field(int, required=True, check=check_positive),
+    'activeFrom': Field(str, check=check_date),
+    'activeTo': Field(str, check=check_date),
+    'note': Field(str),
+    'addressGpsLat': Field(NUMBER, check=check_range(-90, 90)),
+    'addressGpsLon': Field(NUMBER, check=check_range(-180, 180)),
+}
+
+INVOICE_ITEM_SCHEMA = {
+    'label': Field(str, required=True, check=check_not_blank),
+    'price': Field(NUMBER, required=True),
+    'quantity': Field(NUMBER, required=True, check=check_positive),
+    'unit': Field(str),
+}
+
+INVOICE_SCHEMA = {
+    'number': Field(str, required=True, check=check_not_blank),
+    'items': Field(list, required=True, check=check_items),
+    'createdDate': Field(str, check=check_date),
+    'maturityDays': Field(int, check=check_not_negative),
+    'adminNotes': Field(str),
+    'notes': Field(str),
+}
+
+PAYMENT_SCHEMA = {
+    'clientId': Field(int, required=True, check=check_positive),
+    'amount': Field(NUMBER, required=True, check=check_positive),
+    'currencyCode': Field(str, check=check_currency),
+    'methodId': Field(str, required=True, check=check_not_blank),
+    'createdDate': Field(str, check=check_date),
+    'note': Field(str),
+    'invoiceIds': Field(list, check=check_ids),
+}
+
+
+def validate(payload, schema, skip=()):
+    """List of 'field: problem' messages for payload (empty when it is valid).
+
+    None counts as absent. Fields not in the schema are reported, since
+    they would only be sent by mistake.
+    """
+    errors = []
+    for name, field in schema.items():
+        if name in skip:
+            continue
+        value = payload.get(name)
+        if value is None:
+            if field.required:
+                errors.append(f"{name}: is required")
+            continue
+        # bool is an int subclass, but True is never a valid ID or amount
+        if not isinstance(value, field.types) or (isinstance(value, bool) and field.types is not bool):
+            errors.append(f"{name}: has type {type(value).__name__}")
+            continue
+        if field.check:
+            problem = field.check(value)
+            if problem:
+                errors.append(f"{name}: {problem}")
+    for name in payload:
+        if name not in schema:
+            errors.append(f"{name}: is not a field UISP accepts here")
+    return errors
+
+
+def validate_client(payload):
+    errors = validate(payload, CLIENT_SCHEMA)
+    if not (payload.get('companyName') or (payload.get('firstName') and payload.get('lastName'))):
+        errors.append("firstName and lastName (or companyName) are required")
+    return errors
+
+
+def validate_service(payload, period_ids=None):
+    """period_ids: the plan periods that exist in UISP (None = not known, e.g. dry run)"""
+    if period_ids is None:
+        errors = validate(payload, SERVICE_SCHEMA, skip=('servicePlanPeriodId',))
+    else:
+        errors = validate(payload, SERVICE_SCHEMA)
+        period_id = payload.get('servicePlanPeriodId')
+        if isinstance(period_id, int) and period_id not in period_ids:
+            errors.append(f"servicePlanPeriodId: {period_id} is not a plan period in UISP")
+    if not errors and payload.get('activeFrom') and payload.get('activeTo'):
+        if (datetime.strptime(payload['activeTo'], DATE_FORMAT)
+                < datetime.strptime(payload['activeFrom'], DATE_FORMAT)):
+            errors.append("activeTo: is before activeFrom")
+    return errors
+
+
+def validate_invoice(payload):
+    return validate(payload, INVOICE_SCHEMA)
+
+
+def validate_payment(payload):
+    return validate(payload, PAYMENT_SCHEMA)
@@ -0,0 +1,126 @@
+"""
+Priority order for client and invoice imports
+
+By default clients and invoices are imported in CSV/export order. With
+--priority the records billing depends on go first, so a time-boxed cutover
+run that is cut short has already done what matters:
+
+    clients   by the best status among their services (Active first), then
+              the most recently started service (or registration) first
+    invoices  by status (Unpaid and Partial first), then newest first
+
+Client service statuses come from the old-UISP services export (staged in
+staging.db, else services_export.*), matched on the client ID. Clients the
+export does not cover are ranked from their CSV services: Ended if the
+service's activeTo date has passed, Active otherwise.
+
+The status orders can be changed in config.py; statuses not listed go after
+the listed ones, clients without services last:
+
+    PRIORITY_SERVICE_STATUSES = [1, 2, 8, 0, 3, 7, 5, 4, 6]
+    PRIORITY_INVOICE_STATUSES = [1, 2, 0, 3, 4]
+
+The sort is stable, so equal records keep file order and the same input
+always gives the same order: --start, --limit and --resume-from count
+positions in the priority order.
+"""
+
+import logging
+import os
+from collections import Counter
+from datetime import date
+
+import export_store
+from export_services import SERVICE_STATUS_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Active, Suspended, Suspended (going to end), Prepared, Prepared blocked,
+# Deferred, Quoted, Ended, Obsolete
+DEFAULT_SERVICE_STATUSES = (1, 2, 8, 0, 3, 7, 5, 4, 6)
+
+# Unpaid, Partial, Draft, Paid, Void
+DEFAULT_INVOICE_STATUSES = (1, 2, 0, 3, 4)
+
+ACTIVE = 1
+ENDED = 4
+
+
+def _timestamp(value):
+    """Sortable form of a UISP/CSV date ('' when missing, which sorts oldest)"""
+    return (value or '')[:19]
+
+
+def _sorted(records, rank, recency):
+    """Newest first within each rank; stable, so ties keep their order"""
+    return sorted(sorted(records, key=recency, reverse=True), key=rank)
+
+
+def load_service_statuses(stage=None, services_file='services_export.json'):
+    """{old client ID (str): [service status, ...]} from the old-UISP services
+    export, or None when there is none yet"""
+    services = None
+    if stage and stage.dataset('old_service'):
+        services = stage.old_records('service')
+        source = stage.path
+    else:
+        for fmt in export_store.EXPORT_FORMATS:
+            path = export_store.export_path(services_file, fmt)
+            if os.path.exists(path):
+                services = export_store.load_records(path)
+                source = path
+                break
+    if services is None:
+        logger.info("No services export found: ranking clients by their CSV service dates")
+        return None
+
+    statuses = {}
+    for service in services:
+        statuses.setdefault(str(service.get('clientId')), []).append(service.get('status'))
+    logger.info(f"Ranking clients by the status of {len(services)} exported services ({source})")
+    return statuses
+
+
+def _csv_statuses(client, today):
+    return [ENDED if service.get('activeTo') and service['activeTo'][:10] < today else ACTIVE
+            for service in client.get('services', [])]
+
+
+def order_clients(clients, service_statuses=None, status_order=DEFAULT_SERVICE_STATUSES):
+    """Clients ordered by the best status of their services, then recency"""
+    ranks = {status: n for n, status in enumerate(status_order)}
+    today = date.today().isoformat()
+    best = {}
+
+    def rank(client):
+        statuses = (service_statuses or {}).get(client['original_id']) or _csv_statuses(client, today)
+        if not statuses:
+            best[id(client)] = None
+            return len(ranks) + 1
+        status = min(statuses, key=lambda s: ranks.get(s, len(ranks)))
+        best[id(client)] = status
+        return ranks.get(status, len(ranks))
+
+    def recency(client):
+        dates = [_timestamp(s.get('activeFrom')) for s in client.get('services', [])]
+        return max(dates + [_timestamp(client.get('registrationDate'))])
+
+    ordered = _sorted(clients, rank, recency)
+    counts = Counter(best[id(client)] for client in ordered)
+    logger.info("Priority order: " + ', '.join(
+        f"{'no services' if s is None else SERVICE_STATUS_NAMES.get(s, f'Unknown({s})')} {n}"
+        for s, n in counts.items()))
+    return ordered
+
+
+def order_invoices(invoices, status_order=DEFAULT_INVOICE_STATUSES, status_names=None):
+    """Invoices ordered by status (Unpaid/Partial first), then newest first"""
+    ranks = {status: n for n, status in enumerate(status_order)}
+    ordered = _sorted(invoices,
+                      lambda inv: ranks.get(inv.get('status'), len(ranks)),
+                      lambda inv: (_timestamp(inv.get('createdDate')), inv.get('id') or 0))
+    counts = Counter(inv.get('status') for inv in ordered)
+    names = status_names or {}
+    logger.info("Priority order: " + ', '.join(f"{names.get(s, f'Unknown({s})')} {n}"
+                                               for s, n in counts.items()))
+    return ordered
@@ -0,0 +1,208 @@
+"""
+Profiling hooks for the migration scripts (--profile)
+
+Two complementary views of a run:
+
+* Phase timing - hot code is wrapped in phase('name') blocks (parse,
+  plan_resolve, payload_build, validate, network_wait, json_decode,
+  retry_wait, logging, ...).
+  Time is exclusive: a JSON decode inside a request does not count twice.
+  The table logged at exit shows whether client CPU or waiting on UISP
+  dominates.
+
+* Stack profile - either a built-in sampling profiler (default) that writes
+  collapsed stacks ("a;b;c 42" lines, readable by flamegraph.pl, speedscope
+  and inferno) of every thread, rooted at the thread and its active phase
+  (thread:uisp;phase:network_wait;... for the --concurrency workers), or
+  cProfile (--profile cprofile) writing a .prof file for pstats/snakeviz.
+  cProfile only sees the main thread.
+
+When profiling is off, phase() returns a shared no-op context manager.
+"""
+
+import atexit
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+_NULL_PHASE = nullcontext()
+_active = None
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit()
+        return False
+
+
+class PhaseProfiler:
+    """Exclusive wall time per named phase, per thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.totals = Counter()
+        self.counts = Counter()
+        self.current = {}  # thread id -> innermost phase name (read by the sampler)
+        self.started = time.perf_counter()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        self._stack().append([name, time.perf_counter(), 0.0])
+        self.current[threading.get_ident()] = name
+
+    def _exit(self):
+        stack = self._stack()
+        name, start, child_time = stack.pop()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.totals[name] += elapsed - child_time
+            self.counts[name] += 1
+        if stack:
+            stack[-1][2] += elapsed
+            self.current[threading.get_ident()] = stack[-1][0]
+        else:
+            self.current.pop(threading.get_ident(), None)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def log_summary(self):
+        wall = time.perf_counter() - self.started
+        logger.info("\n" + "=" * 60)
+        logger.info("PROFILE: TIME BY PHASE (exclusive, all threads)")
+        logger.info("=" * 60)
+        accounted = 0.0
+        for name, seconds in self.totals.most_common():
+            accounted += seconds
+            logger.info(f"  {name:15} {seconds:>9.2f}s {seconds / wall * 100:>6.1f}%  ({self.counts[name]} calls)")
+        other = max(wall - accounted, 0.0)
+        logger.info(f"  {'other':15} {other:>9.2f}s {other / wall * 100 if wall else 0:>6.1f}%")
+        logger.info(f"  {'wall clock':15} {wall:>9.2f}s")
+
+
+def _thread_label(name):
+    """Pool workers share one root: 'uisp_3' -> 'uisp'"""
+    prefix, _, index = name.rpartition('_')
+    return prefix if prefix and index.isdigit() else name
+
+
+class StackSampler(threading.Thread):
+    """Samples the Python stack of every thread at a fixed interval"""
+
+    def __init__(self, phases, interval=0.005):
+        super().__init__(daemon=True, name='stack-sampler')
+        self.phases = phases
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            labels = {t.ident: _thread_label(t.name) for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                names.reverse()
+                thread = labels.get(thread_id, thread_id)
+                phase = self.phases.current.get(thread_id, 'other')
+                self.stacks[f"thread:{thread};phase:{phase};" + ';'.join(names)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _time_logging_handlers(profiler):
+    """Account time spent in log handlers (console/file writes) to 'logging'"""
+    for handler in logging.getLogger().handlers:
+        emit = handler.emit
+
+        def timed_emit(record, _emit=emit):
+            with profiler.phase('logging'):
+                _emit(record)
+
+        handler.emit = timed_emit
+
+
+def phase(name):
+    """Context manager timing a block as phase name (no-op unless profiling)"""
+    if _active is None:
+        return _NULL_PHASE
+    return _active.phase(name)
+
+
+def start(mode, script_name, output_dir='.'):
+    """Enable profiling for this run; results are written at exit.
+
+    mode is 'sample' (collapsed stacks for flame graphs) or 'cprofile'.
+    """
+    global _active
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode}")
+
+    _active = PhaseProfiler()
+    _time_logging_handlers(_active)
+
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    base = os.path.join(output_dir, f'profile_{script_name}_{stamp}')
+
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        sampler = None
+    else:
+        profile = None
+        sampler = StackSampler(_active)
+        sampler.start()
+
+    def _finish():
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(base + '.prof')
+            logger.info(f"cProfile stats written to {base}.prof (view with: python -m pstats / snakeviz)")
+        if sampler is not None:
+            sampler.stop()
+            sampler.write_collapsed(base + '.collapsed')
+            logger.info(f"Collapsed stacks written to {base}.collapsed "
+                        f"({sum(sampler.stacks.values())} samples; flamegraph.pl or speedscope)")
+        _active.log_summary()
+
+    atexit.register(_finish)
+    logger.info(f"Profiling enabled ({mode})")
+    return _active
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+UISP Old-vs-New Reconciliation
+
+Checks a finished migration by comparing what the old UISP holds with what
+the new UISP now holds, per client (old client ID = new userIdent):
+
+    clients     every old client exists once in the new UISP
+    services    number of services per client
+    invoices    number of invoices and their total per client
+                (void and item-less invoices are not imported, so not expected)
+    payments    amount paid per client (old invoices' amountPaid vs new payments)
+    pppoe       each new service carries the old client's PPPoE username
+
+Both sides are fetched at the same time (every endpoint crawled in parallel,
+10,000 records per page), turned into pandas frames, and compared with
+group-bys and joins, so 100K invoices take a few page fetches and a
+fraction of a second of comparison, not a record-by-record walk.
+
+Mismatches are logged (a few per check) and all of them written to
+reconcile_YYYYMMDD_HHMMSS.csv. The exit status is 1 when anything differs.
+
+Usage:
+    python reconcile.py                                   # Fetch both sides and compare
+    python reconcile.py --invoices-from invoices_export.json  # Old invoices from an export
+    python reconcile.py --checks clients,invoices         # Only some checks
+
+Options:
+    --checks A,B          Checks to run (default: all)
+    --invoices-from FILE  Old invoices from an export file instead of the old UISP
+    --services-from FILE  Old services from an export file instead of the old UISP
+    --out FILE            Mismatch report (default: reconcile_YYYYMMDD_HHMMSS.csv)
+    --show N              Mismatches to log per check (default: 5)
+    --metrics-out FILE    Write per-endpoint request metrics (.json or .prom)
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+import export_store
+import log_setup
+import metrics
+import profiling
+from lazy_import import lazy_import
+from uisp_api import UISPApi, map_concurrent, client_options
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+CHECKS = ('clients', 'services', 'invoices', 'payments', 'pppoe')
+
+# Custom attribute IDs: PPPoE username on old clients / on new services
+OLD_PPPOE_ATTR_ID = 1
+NEW_PPPOE_ATTR_ID = 2
+
+VOID_STATUS = 4
+PAID_STATUSES = (2, 3)
+
+# Amounts closer than this are equal (rounding to centavos)
+MONEY_TOLERANCE = 0.005
+
+PAGE_SIZE = 10000
+
+# What each check needs from each side: (side, endpoint)
+SOURCES = {
+    'clients': [('old', '/clients'), ('new', '/clients')],
+    'services': [('old', '/clients/services'), ('new', '/clients/services')],
+    'invoices': [('old', '/invoices'), ('new', '/invoices')],
+    'payments': [('old', '/invoices'), ('new', '/payments')],
+    'pppoe': [('old', '/clients'), ('new', '/clients/services')],
+}
+
+
+def fetch_all(api, endpoint):
+    """Every record of a paginated collection"""
+    records = []
+    while True:
+        page = api.get(f'{endpoint}?limit={PAGE_SIZE}&offset={len(records)}')
+        records.extend(page)
+        if len(page) < PAGE_SIZE:
+            return records
+
+
+def fetch_sources(apis, sources, preloaded):
+    """{(side, endpoint): records}, crawling all endpoints concurrently"""
+    data = dict(preloaded)
+    jobs = [source for source in sources if source not in data]
+
+    def fetch(source):
+        side, endpoint = source
+        start = time.perf_counter()
+        records = fetch_all(apis[side], endpoint)
+        logger.info(f"Fetched {len(records)} records from {side} {endpoint} in {time.perf_counter() - start:.1f}s")
+        return records
+
+    for source, records, error in map_concurrent(fetch, jobs, workers=len(jobs)):
+        if error is not None:
+            raise RuntimeError(f"Fetching {source[0]} {source[1]} failed: {error}") from error
+        data[source] = records
+    return data
+
+
+def attribute_value(record, attribute_id):
+    for attr in record.get('attributes') or []:
+        if attr.get('customAttributeId') == attribute_id and attr.get('value'):
+            return attr['value'].strip()
+    return None
+
+
+# --- frames: one row per record, only the columns the checks use ----------
+
+def client_frame(old_clients, new_clients):
+    """(old clients: client, pppoe), (new clients: new_id, client) with client = old ID as str"""
+    old = pd.DataFrame({
+        'client': [str(c.get('id')) for c in old_clients],
+        'pppoe': [attribute_value(c, OLD_PPPOE_ATTR_ID) for c in old_clients],
+    })
+    new = pd.DataFrame({
+        'new_id': [c.get('id') for c in new_clients],
+        'client': [str(c['userIdent']) if c.get('userIdent') else None for c in new_clients],
+    })
+    return old, new
+
+
+def map_new_clients(frame, new_clients):
+    """Add the old client ID (client column) to a new-side frame keyed by new client ID"""
+    mapping = new_clients.dropna(subset=['client']).drop_duplicates('new_id')
+    return frame.merge(mapping, how='left', left_on='clientId', right_on='new_id').drop(columns='new_id')
+
+
+def service_frame(services, with_pppoe=False):
+    frame = pd.DataFrame({
+        'id': [s.get('id') for s in services],
+        'clientId': [s.get('clientId') for s in services],
+    })
+    if with_pppoe:
+        frame['pppoe'] = [attribute_value(s, NEW_PPPOE_ATTR_ID) for s in services]
+    return frame
+
+
+def invoice_frame(invoices):
+    return pd.DataFrame({
+        'clientId': [inv.get('clientId') for inv in invoices],
+        'status': [inv.get('status') for inv in invoices],
+        'total': [inv.get('total') or 0 for inv in invoices],
+        'amountPaid': [inv.get('amountPaid') or 0 for inv in invoices],
+        'has_items': [bool(inv.get('items', True)) for inv in invoices],
+    })
+
+
+def payment_frame(payments):
+    return pd.DataFrame({
+        'clientId': [p.get('clientId') for p in payments],
+        'amount': [p.get('amount') or 0 for p in payments],
+    })
+
+
+# --- checks: each returns (summary dict, mismatch frame) -------------------
+
+def _mismatches(check, frame, old_column, new_column, problem):
+    """Report rows: check, client, problem, old, new"""
+    return pd.DataFrame({
+        'check': check,
+        'client': frame['client'].astype(str),
+        'problem': problem,
+        # object columns, so counts stay integers next to amounts in the combined report
+        'old': frame[old_column].astype(object),
+        'new': frame[new_column].astype(object),
+    })
+
+
+def compare_per_client(check, problem, old, new, money=False):
+    """Outer-join two per-client series and report the clients that differ"""
+    joined = pd.concat([old.rename('old'), new.rename('new')], axis=1).fillna(0).reset_index()
+    joined = joined.rename(columns={joined.columns[0]: 'client'})
+    if money:
+        differs = (joined['old'] - joined['new']).abs() > MONEY_TOLERANCE
+    else:
+        joined[['old', 'new']] = joined[['old', 'new']].astype(int)
+        differs = joined['old'] != joined['new']
+    bad = joined[differs]
+    summary = {'old': old.sum(), 'new': new.sum(), 'clients': len(joined), 'mismatched': len(bad)}
+    return summary, _mismatches(check, bad, 'old', 'new', problem)
+
+
+def check_clients(old_clients, new_clients):
+    old_ids = pd.Index(old_clients['client'])
+    counts = new_clients['client'].value_counts()
+    missing = old_ids.difference(counts.index)
+    extra = counts.index.difference(old_ids)
+    duplicated = counts[counts > 1]
+    no_ident = int(new_clients['client'].isna().sum())
+
+    report = pd.concat([
+        pd.DataFrame({'check': 'clients', 'client': missing, 'problem': 'missing in new', 'old': 1, 'new': 0}),
+        pd.DataFrame({'check': 'clients', 'client': extra, 'problem': 'not in old', 'old': 0,
+                      'new': counts[extra].values}),
+        pd.DataFrame({'check': 'clients', 'client': duplicated.index, 'problem': 'duplicated in new',
+                      'old': 1, 'new': duplicated.values}),
+    ], ignore_index=True)
+    if no_ident:
+        report.loc[len(report)] = ['clients', '', 'new clients without userIdent', 0, no_ident]
+    summary = {'old': len(old_ids), 'new': len(new_clients), 'clients': len(old_ids),
+               'mismatched': len(report)}
+    return summary, report
+
+
+def check_services(old_services, new_services, new_clients):
+    old_counts = old_services.assign(client=old_services['clientId'].astype(str)).groupby('client').size()
+    new_counts = map_new_clients(new_services, new_clients).groupby('client').size()
+    return compare_per_client('services', 'service count', old_counts, new_counts)
+
+
+def expected_invoices(old_invoices):
+    """Old invoices the importer creates in the new UISP"""
+    kept = old_invoices[(old_invoices['status'] != VOID_STATUS) & old_invoices['has_items']]
+    return kept.assign(client=kept['clientId'].astype(str))
+
+
+def check_invoices(old_invoices, new_invoices, new_clients):
+    old = expected_invoices(old_invoices).groupby('client').agg(count=('total', 'size'), total=('total', 'sum'))
+    new = map_new_clients(new_invoices, new_clients).groupby('client').agg(
+        count=('total', 'size'), total=('total', 'sum'))
+    count_summary, count_report = compare_per_client('invoices', 'invoice count', old['count'], new['count'])
+    total_summary, total_report = compare_per_client('invoices', 'invoice total', old['total'], new['total'],
+                                                     money=True)
+    report = pd.concat([count_report, total_report], ignore_index=True)
+    summary = dict(count_summary, old_total=total_summary['old'], new_total=total_summary['new'],
+                   mismatched=report['client'].nunique())
+    return summary, report
+
+
+def check_payments(old_invoices, new_payments, new_clients):
+    paid = expected_invoices(old_invoices)
+    paid = paid[paid['status'].isin(PAID_STATUSES) & (paid['amountPaid'] > 0)]
+    old = paid.groupby('client')['amountPaid'].sum()
+    new = map_new_clients(new_payments, new_clients).groupby('client')['amount'].sum()
+    return compare_per_client('payments', 'amount paid', old, new, money=True)
+
+
+def check_pppoe(old_clients, new_services, new_clients):
+    expected = old_clients.dropna(subset=['pppoe'])
+    services = map_new_clients(new_services, new_clients)
+    joined = services.merge(expected, how='inner', on='client', suffixes=('_new', '_old'))
+    bad = joined[joined['pppoe_new'] != joined['pppoe_old']]
+    report = pd.DataFrame({
+        'check': 'pppoe',
+        'client': bad['client'],
+        'problem': 'service ' + bad['id'].astype(str),
+        'old': bad['pppoe_old'],
+        'new': bad['pppoe_new'],
+    })
+    summary = {'old': len(expected), 'new': int(services['pppoe'].notna().sum()),
+               'clients': joined['client'].nunique(), 'mismatched': len(report)}
+    return summary, report
+
+
+def run_checks(checks, data):
+    old_clients, new_clients = client_frame(data.get(('old', '/clients'), []),
+                                            data.get(('new', '/clients'), []))
+    frames = {}
+    if 'services' in checks:
+        frames['old_services'] = service_frame(data[('old', '/clients/services')])
+    if 'services' in checks or 'pppoe' in checks:
+        frames['new_services'] = service_frame(data[('new', '/clients/services')], with_pppoe=True)
+    if 'invoices' in checks or 'payments' in checks:
+        frames['old_invoices'] = invoice_frame(data[('old', '/invoices')])
+    if 'invoices' in checks:
+        frames['new_invoices'] = invoice_frame(data[('new', '/invoices')])
+    if 'payments' in checks:
+        frames['new_payments'] = payment_frame(data[('new', '/payments')])
+
+    results = {}
+    if 'clients' in checks:
+        results['clients'] = check_clients(old_clients, new_clients)
+    if 'services' in checks:
+        results['services'] = check_services(frames['old_services'], frames['new_services'], new_clients)
+    if 'invoices' in checks:
+        results['invoices'] = check_invoices(frames['old_invoices'], frames['new_invoices'], new_clients)
+    if 'payments' in checks:
+        results['payments'] = check_payments(frames['old_invoices'], frames['new_payments'], new_clients)
+    if 'pppoe' in checks:
+        results['pppoe'] = check_pppoe(old_clients, frames['new_services'], new_clients)
+    return results
+
+
+def log_report(results, show):
+    logger.info("\n" + "=" * 60)
+    logger.info("RECONCILIATION")
+    logger.info("=" * 60)
+    logger.info(f"{'check':10} {'old':>12} {'new':>12} {'clients':>9} {'mismatched':>11}")
+    for check, (summary, _) in results.items():
+        number = ',.2f' if isinstance(summary['old'], float) else ','
+        logger.info(f"{check:10} {summary['old']:>12{number}} {summary['new']:>12{number}} "
+                    f"{summary['clients']:>9,} {summary['mismatched']:>11,}")
+        if 'old_total' in summary:
+            logger.info(f"{'  total':10} {summary['old_total']:>12,.2f} {summary['new_total']:>12,.2f}")
+    for check, (_, report) in results.items():
+        if len(report):
+            logger.info(f"\n{check}: {len(report)} mismatches, e.g.")
+            for row in report.head(show).itertuples(index=False):
+                logger.info(f"  client {row.client:>10}  {row.problem:28} old={row.old}  new={row.new}")
+    logger.info("=" * 60)
+
+
+def main():
+    log_file = log_setup.start_run('reconcile')
+    parser = argparse.ArgumentParser(
+        description='Compare the old and new UISP after a migration',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--checks', type=str, default=','.join(CHECKS),
+                        help=f"Comma-separated checks ({', '.join(CHECKS)})")
+    parser.add_argument('--invoices-from', type=str, default=None,
+                        help='Old invoices from an export file (JSON/Parquet/Feather)')
+    parser.add_argument('--services-from', type=str, default=None,
+                        help='Old services from an export file (JSON/Parquet/Feather)')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Mismatch report CSV (default: reconcile_YYYYMMDD_HHMMSS.csv)')
+    parser.add_argument('--show', type=int, default=5,
+                        help='Mismatches to log per check')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                        help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+    args = parser.parse_args()
+    metrics.write_summary_at_exit(args.metrics_out)
+
+    checks = [c for c in args.checks.split(',') if c]
+    unknown = [c for c in checks if c not in CHECKS]
+    if unknown:
+        parser.error(f"unknown check(s): {', '.join(unknown)} (checks: {', '.join(CHECKS)})")
+    if pd is None:
+        parser.error("reconcile.py needs pandas (pip install pandas)")
+
+    # Load config
+    try:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import config
+    except ImportError:
+        logger.error("config.py not found. Ensure it exists in the scripts directory.")
+        sys.exit(1)
+
+    old_url = getattr(config, 'OLD_UISP_BASE_URL', None)
+    old_token = getattr(config, 'OLD_UISP_API_KEY', None)
+    if not old_url or not old_token:
+        logger.error("OLD_UISP_BASE_URL and OLD_UISP_API_KEY must be set in config.py")
+        sys.exit(1)
+
+    apis = {
+        'old': UISPApi(old_url, old_token, verify_ssl=False, **client_options(config)),
+        'new': UISPApi(config.UISP_BASE_URL, config.UISP_API_TOKEN,
+                       verify_ssl=getattr(config, 'VERIFY_SSL', False), **client_options(config)),
+    }
+    for side, api in apis.items():
+        if not api.test_connection():
+            logger.error(f"Cannot connect to {side} UISP.")
+            sys.exit(1)
+
+    # The client lists are always needed: they map new client IDs to old ones
+    sources = [('old', '/clients'), ('new', '/clients')]
+    for check in checks:
+        sources += [source for source in SOURCES[check] if source not in sources]
+
+    preloaded = {}
+    for source, path in ((('old', '/invoices'), args.invoices_from),
+                         (('old', '/clients/services'), args.services_from)):
+        if path and source in sources:
+            with profiling.phase('parse'):
+                preloaded[source] = export_store.load_records(path)
+            logger.info(f"Loaded {len(preloaded[source])} records from {path}")
+
+    start = time.perf_counter()
+    try:
+        data = fetch_sources(apis, sources, preloaded)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    fetched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = run_checks(checks, data)
+    compared = time.perf_counter() - start
+    log_report(results, args.show)
+    logger.info(f"Fetched in {fetched:.1f}s, compared in {compared:.2f}s")
+
+    report = pd.concat([r for _, r in results.values()], ignore_index=True)
+    if len(report):
+        out = args.out or f'reconcile_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+        report.to_csv(out, index=False)
+        logger.info(f"{len(report)} mismatches written to {out}")
+        logger.info(f"Log file: {log_file}")
+        sys.exit(1)
+    logger.info("No mismatches: the new UISP matches the old one")
+    logger.info(f"Log file: {log_file}")
+
+
+if __name__ == '__main__':
+    main()
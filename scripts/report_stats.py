@@ -0,0 +1,113 @@
+"""
+Single-pass statistics for export and dry-run reports
+
+A StatsAggregator is configured once with the counters, sums, group-bys and
+first-seen labels a report needs, then fed each record exactly once (while
+paging an export, or while loading a file). Every summary is read back from
+the aggregator afterwards, so no report re-scans the record list.
+
+Example:
+    agg = StatsAggregator()
+    agg.count_by('status', 'status')
+    agg.sum_of('total', 'total')
+    agg.first_label('plan', 'servicePlanId', lambda s: s.get('servicePlanName'))
+    agg.feed_many(records)
+    agg.counts('status')      # Counter({3: 120, 1: 14, ...})
+"""
+
+from collections import Counter, defaultdict
+
+
+def _getter(field, missing=-1):
+    """Accept a field name or a callable and return a record -> value function.
+
+    Records without the field give `missing`: -1 for keys (its own group in
+    count_by), 0 for summed values.
+    """
+    if callable(field):
+        return field
+    return lambda record: record.get(field, missing)
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+class StatsAggregator:
+    """Streaming counters, sums, group-bys and first-seen labels"""
+
+    def __init__(self):
+        self.records = 0
+        self._counters = {}     # name -> (key_fn, Counter)
+        self._conditions = {}   # name -> (predicate, [count])
+        self._sums = {}         # name -> (value_fn, [total])
+        self._group_sums = {}   # name -> (key_fn, value_fn, defaultdict(float))
+        self._labels = {}       # name -> (key_fn, label_fn, {key: label})
+
+    # --- configuration -------------------------------------------------
+
+    def count_by(self, name, key):
+        """Count records per value of key (field name or callable)"""
+        self._counters[name] = (_getter(key), Counter())
+        return self
+
+    def count_if(self, name, predicate):
+        """Count records for which predicate(record) is truthy"""
+        self._conditions[name] = (predicate, [0])
+        return self
+
+    def sum_of(self, name, value):
+        """Sum a numeric field (or callable) over all records"""
+        self._sums[name] = (_getter(value, 0), [0])
+        return self
+
+    def sum_by(self, name, key, value):
+        """Sum a numeric field per group key"""
+        self._group_sums[name] = (_getter(key), _getter(value, 0), defaultdict(float))
+        return self
+
+    def first_label(self, name, key, label):
+        """Remember the label of the first record seen for each key"""
+        self._labels[name] = (_getter(key), _getter(label), {})
+        return self
+
+    # --- feeding -------------------------------------------------------
+
+    def feed(self, record):
+        """Update every configured statistic with one record"""
+        self.records += 1
+        for key_fn, counter in self._counters.values():
+            counter[key_fn(record)] += 1
+        for predicate, count in self._conditions.values():
+            if predicate(record):
+                count[0] += 1
+        for value_fn, total in self._sums.values():
+            total[0] += _number(value_fn(record))
+        for key_fn, value_fn, groups in self._group_sums.values():
+            groups[key_fn(record)] += _number(value_fn(record))
+        for key_fn, label_fn, labels in self._labels.values():
+            key = key_fn(record)
+            if key not in labels:
+                labels[key] = label_fn(record)
+
+    def feed_many(self, records):
+        for record in records:
+            self.feed(record)
+        return self
+
+    # --- results -------------------------------------------------------
+
+    def counts(self, name):
+        return self._counters[name][1]
+
+    def count(self, name):
+        return self._conditions[name][1][0]
+
+    def total(self, name):
+        return self._sums[name][1][0]
+
+    def group_totals(self, name):
+        return dict(self._group_sums[name][2])
+
+    def labels(self, name):
+        return self._labels[name][2]
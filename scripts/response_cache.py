@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+On-disk cache for UISP API GET responses
+
+UISPApi consults this cache for every GET when UISP_CACHE_TTL is set in
+config.py:
+
+* Fresh entries (younger than the TTL) are returned without a request.
+* Stale entries that carry an ETag or Last-Modified are revalidated with
+  If-None-Match / If-Modified-Since; a 304 reuses the cached body.
+* Any POST/PATCH/DELETE drops the cached GETs it can affect (same top-level
+  resource, plus related ones, e.g. a payment invalidates /invoices and
+  /clients), so a script never reads back its own stale data.
+
+Entries are raw response bytes (decoded by json_codec like a live response),
+one file per URL under <cache dir>/<host>/, so all scripts share them.
+
+Invalidation works across processes and threads through a generation token
+per resource (<cache dir>/<host>/.generations/<resource>). A write replaces
+the token; an entry is stamped with the token read before its GET was sent,
+and get() drops entries whose token is no longer current. So an entry that
+another process stored while a write was in flight is never served after it.
+
+Usage:
+    python response_cache.py --stats      # Entries and size per host
+    python response_cache.py --clear      # Delete all cached responses
+
+Options:
+    --dir DIR   Cache directory (default: UISP_CACHE_DIR from config.py, or .uisp_cache)
+    --stats     Show what is cached
+    --clear     Delete the cache
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '.uisp_cache'
+
+# Writes to the key resource also change what GETs of these resources return
+RELATED_RESOURCES = {
+    'payments': ('invoices', 'clients'),
+    'invoices': ('clients', 'payments'),
+}
+
+
+def resource_of(endpoint):
+    """Top-level resource of an endpoint: '/clients/5/services?x=1' -> 'clients'"""
+    path = endpoint.split('?', 1)[0].strip('/')
+    return path.split('/', 1)[0] or 'root'
+
+
+def affected_resources(endpoint):
+    """Resources whose cached GETs a write to endpoint can change"""
+    path = endpoint.split('?', 1)[0].strip('/')
+    names = {part for part in path.split('/') if part and not part.isdigit()}
+    for name in list(names):
+        names.update(RELATED_RESOURCES.get(name, ()))
+    return names or {'root'}
+
+
+class CacheEntry:
+    __slots__ = ('path', 'stored_at', 'etag', 'last_modified', 'body')
+
+    def __init__(self, path, stored_at, etag, last_modified, body):
+        self.path = path
+        self.stored_at = stored_at
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+
+    def age(self):
+        return time.time() - self.stored_at
+
+    def validators(self):
+        """Conditional request headers for revalidating this entry"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """GET response cache for one UISP base URL"""
+
+    def __init__(self, base_url, cache_dir=DEFAULT_CACHE_DIR, ttl=300):
+        host = urlparse(base_url).netloc or base_url
+        self.dir = os.path.join(cache_dir, re.sub(r'[^\w.-]', '_', host))
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._generations_dir = os.path.join(self.dir, '.generations')
+        os.makedirs(self._generations_dir, exist_ok=True)
+
+    def _path(self, endpoint):
+        digest = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.dir, f"{resource_of(endpoint)}__{digest}")
+
+    def generation(self, endpoint):
+        """Current generation token of endpoint's resource ('' if never written)"""
+        try:
+            with open(os.path.join(self._generations_dir, resource_of(endpoint)), 'rb') as f:
+                return f.read().decode('ascii')
+        except OSError:
+            return ''
+
+    def get(self, endpoint):
+        """Cached entry for endpoint, or None"""
+        path = self._path(endpoint)
+        try:
+            with open(path, 'rb') as f:
+                header = json_codec.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if header.get('endpoint') != endpoint:
+            return None
+        if header.get('generation', '') != self.generation(endpoint):
+            # Stored before the latest write to its resource
+            try:
+                os.remove(path)
+                self.invalidated += 1
+            except FileNotFoundError:
+                pass
+            return None
+        return CacheEntry(path, header['stored_at'], header.get('etag'),
+                          header.get('last_modified'), body)
+
+    def is_fresh(self, entry):
+        return entry.age() < self.ttl
+
+    def put(self, endpoint, response, generation):
+        """Store a 200 response body with its validators.
+
+        generation is the token read (generation()) before the GET was sent.
+        """
+        header = {
+            'endpoint': endpoint,
+            'stored_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'generation': generation,
+        }
+        self._write(self._path(endpoint), header, response.content)
+
+    def touch(self, endpoint, entry, generation):
+        """Mark an entry fresh again after a 304 Not Modified"""
+        entry.stored_at = time.time()
+        header = {
+            'endpoint': endpoint,
+            'stored_at': entry.stored_at,
+            'etag': entry.etag,
+            'last_modified': entry.last_modified,
+            'generation': generation,
+        }
+        self._write(entry.path, header, entry.body)
+
+    def _write(self, path, header, body):
+        # Write-then-rename so a concurrent reader never sees a partial entry
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json_codec.dumps(header))
+            f.write(b'\n')
+            f.write(body)
+        os.replace(tmp, path)
+
+    def invalidate(self, endpoint):
+        """Drop cached GETs a write to endpoint may have changed.
+
+        Gives each affected resource a new generation token (unique, so two
+        processes invalidating at once never reuse one); get() then drops
+        the entries stamped with an older token.
+        """
+        token = f"{time.time_ns()}.{os.getpid()}.{threading.get_ident()}".encode('ascii')
+        for resource in affected_resources(endpoint):
+            path = os.path.join(self._generations_dir, resource)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(token)
+            os.replace(tmp, path)
+
+    def log_summary(self):
+        if self.hits or self.revalidated or self.misses:
+            logger.info(f"Response cache ({self.dir}): {self.hits} hits, "
+                        f"{self.revalidated} revalidated (304), {self.misses} fetched, "
+                        f"{self.invalidated} invalidated")
+
+
+def cache_options(config):
+    """(cache_dir, ttl) from config.py; ttl None means caching is off"""
+    ttl = getattr(config, 'UISP_CACHE_TTL', None)
+    return getattr(config, 'UISP_CACHE_DIR', DEFAULT_CACHE_DIR), ttl
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspect or clear the UISP API response cache',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--dir', default=None, help='Cache directory')
+    parser.add_argument('--stats', action='store_true', help='Show cached entries per host')
+    parser.add_argument('--clear', action='store_true', help='Delete all cached responses')
+    args = parser.parse_args()
+
+    cache_dir = args.dir
+    if cache_dir is None:
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import config
+            cache_dir = getattr(config, 'UISP_CACHE_DIR', DEFAULT_CACHE_DIR)
+        except ImportError:
+            cache_dir = DEFAULT_CACHE_DIR
+
+    if not os.path.isdir(cache_dir):
+        print(f"No cache at {cache_dir}")
+        return
+
+    if args.clear:
+        shutil.rmtree(cache_dir)
+        print(f"Cleared {cache_dir}")
+        return
+
+    for host in sorted(os.listdir(cache_dir)):
+        host_dir = os.path.join(cache_dir, host)
+        names = [n for n in os.listdir(host_dir) if not n.startswith('.')]
+        size = sum(os.path.getsize(os.path.join(host_dir, n)) for n in names)
+        print(f"{host}: {len(names)} entries, {size / 1024 / 1024:.1f} MB")
+        by_resource = {}
+        for name in names:
+            resource = name.split('__', 1)[0]
+            by_resource[resource] = by_resource.get(resource, 0) + 1
+        for resource, count in sorted(by_resource.items()):
+            print(f"  {resource:20} {count}")
+
+
+if __name__ == '__main__':
+    main()
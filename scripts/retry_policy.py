@@ -0,0 +1,180 @@
+"""
+Timeout and retry policy for UISP API requests
+
+One RetryPolicy per UISPApi (i.e. per UISP host) decides, for every
+failed attempt, whether to try again and how long to wait:
+
+* Timeouts - separate connect and read timeouts, so a dead host fails in
+  seconds while a slow /clients page still gets its full read time.
+* Retries - 429s, connection failures before the request was sent, and, for
+  idempotent methods only, 5xx answers and timeouts. A POST that timed out
+  or got a 5xx may have been applied, so it is not resent here; the
+  importers queue it for --retry-failed, which checks first.
+* Backoff - exponential with full jitter (a random wait in 0..base*2^n), so
+  concurrent workers don't retry in lockstep. A 429's Retry-After is honored
+  up to max_retry_after.
+* Retry budget - retries may add at most budget_ratio of the requests sent
+  (plus a small floor), so a UISP box that fails everything gets roughly one
+  extra request per five instead of max_retries extra.
+* Circuit breaker - after breaker_threshold consecutive failures (5xx,
+  timeouts, connection errors) requests fail immediately for
+  breaker_cooldown seconds; then one probe request decides whether to close
+  it again.
+
+Settings come from config.py (UISP_CONNECT_TIMEOUT, UISP_READ_TIMEOUT,
+UISP_MAX_RETRIES, UISP_RETRY_BUDGET, UISP_BREAKER_THRESHOLD,
+UISP_BREAKER_COOLDOWN); the defaults below apply when they are unset.
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+MAX_RETRY_AFTER = 60
+RETRY_BUDGET = 0.2
+BUDGET_FLOOR = 10
+BREAKER_THRESHOLD = 10
+BREAKER_COOLDOWN = 30
+
+# Methods that can be resent after an unknown outcome. PATCH is not
+# idempotent in general, but the scripts' PATCHes only set attribute values.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'PATCH')
+
+
+class RetryBudget:
+    """Caps retries at a fraction of the requests sent"""
+
+    def __init__(self, ratio=RETRY_BUDGET, floor=BUDGET_FLOOR):
+        self.ratio = ratio
+        self.floor = floor
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_spend(self):
+        """Reserve one retry; False when the budget is used up"""
+        with self._lock:
+            if self.retries >= self.floor + self.ratio * self.requests:
+                self.exhausted += 1
+                return False
+            self.retries += 1
+            return True
+
+
+class CircuitBreaker:
+    """Fails requests fast while a UISP host keeps failing"""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """May a request be sent now? In half-open state only one probe may."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                logger.info("Circuit breaker half-open: sending a probe request")
+                return True
+            self.rejected += 1
+            return False
+
+    def seconds_until_retry(self):
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker closed: UISP is answering again")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.warning(f"Circuit breaker open after {self.failures} consecutive failures: "
+                               f"failing requests fast for {self.cooldown}s")
+
+
+class RetryPolicy:
+    """Timeouts, retry decisions and backoff for one UISP host"""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 max_retry_after=MAX_RETRY_AFTER, budget_ratio=RETRY_BUDGET,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_cooldown=BREAKER_COOLDOWN):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.budget = RetryBudget(budget_ratio)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+    def should_retry(self, method, attempt, status=None, not_sent=False):
+        """Retry attempt (0-based) that failed with HTTP status, or with a
+        transport error (status None; not_sent when it never reached UISP)?"""
+        if attempt >= self.max_retries:
+            return False
+        if status == 429 or not_sent:
+            retryable = True  # UISP did not process the request
+        else:
+            retryable = method in IDEMPOTENT_METHODS and (status is None or status >= 500)
+        return retryable and self.budget.try_spend()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff before retry number attempt + 1"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retry_after(self, response, attempt):
+        """Wait for a 429: Retry-After (capped) if sent, else the backoff"""
+        try:
+            return min(float(response.headers.get('Retry-After')), self.max_retry_after)
+        except (TypeError, ValueError):
+            return self.backoff(attempt)
+
+    def log_summary(self):
+        budget, breaker = self.budget, self.breaker
+        if budget.retries or budget.exhausted or breaker.times_opened:
+            logger.info(f"Retry policy: {budget.retries} retries for {budget.requests} requests, "
+                        f"{budget.exhausted} not retried (budget used up), breaker opened "
+                        f"{breaker.times_opened}x ({breaker.rejected} requests failed fast)")
+
+
+def policy_from_config(config):
+    """A RetryPolicy with the UISP_* retry settings from config.py"""
+    return RetryPolicy(
+        connect_timeout=getattr(config, 'UISP_CONNECT_TIMEOUT', CONNECT_TIMEOUT),
+        read_timeout=getattr(config, 'UISP_READ_TIMEOUT', READ_TIMEOUT),
+        max_retries=getattr(config, 'UISP_MAX_RETRIES', MAX_RETRIES),
+        budget_ratio=getattr(config, 'UISP_RETRY_BUDGET', RETRY_BUDGET),
+        breaker_threshold=getattr(config, 'UISP_BREAKER_THRESHOLD', BREAKER_THRESHOLD),
+        breaker_cooldown=getattr(config, 'UISP_BREAKER_COOLDOWN', BREAKER_COOLDOWN),
+    )
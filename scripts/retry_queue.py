@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Durable retry queue for records the import scripts could not write
+
+import_clients.py, import_invoices.py and import_pppoe.py put every record
+that fails into one SQLite file (RETRY_QUEUE_FILE in config.py, default
+retry_queue.db), with what is needed to send it again and why it failed.
+Errors are categorized:
+
+    transient   timeout, connection, server_error (5xx), rate_limited (429)
+    permanent   invalid (failed the payload check), no_plan (no UISP service plan),
+                rejected (other 4xx), auth (401/403), not_found (404), error (anything else)
+
+A transient entry becomes due again after an exponential backoff
+(1, 2, 4, ... minutes after each failed attempt, at most an hour). A
+permanent entry waits until the data or UISP setup is fixed.
+
+Each importer's --retry-failed replays its due transient entries at full
+concurrency (--retry-failed all also replays permanent ones and ignores the
+backoff). Records that succeed leave the queue; the rest are rescheduled.
+
+Usage:
+    python retry_queue.py                   # Queued entries per kind and category
+    python retry_queue.py --list invoice    # Show queued invoices
+    python retry_queue.py --clear           # Empty the queue
+    python retry_queue.py --clear pppoe     # Drop one kind
+
+Options:
+    --file PATH     Queue file (default: RETRY_QUEUE_FILE from config.py, or retry_queue.db)
+    --list KIND     List entries of one kind (client, service, invoice, payment, pppoe)
+    --clear [KIND]  Delete all entries, or all of one kind
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import json_codec
+from uisp_api import error_types
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_FILE = 'retry_queue.db'
+
+KINDS = ('client', 'service', 'invoice', 'payment', 'pppoe')
+TRANSIENT = ('timeout', 'connection', 'server_error', 'rate_limited')
+REPLAY_MODES = ('transient', 'all')
+
+# Failures after which the write may still have been applied by UISP, so a
+# replay checks for the record before creating it again
+AMBIGUOUS = ('timeout', 'connection', 'server_error')
+
+# Backoff before a transient entry is due again: BASE * 2^(attempts - 1), capped
+BACKOFF_BASE = 60
+BACKOFF_MAX = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS failed_records (
+    kind         TEXT NOT NULL,
+    key          TEXT NOT NULL,
+    record       TEXT NOT NULL,
+    category     TEXT NOT NULL,
+    error        TEXT,
+    attempts     INTEGER NOT NULL,
+    first_failed REAL NOT NULL,
+    last_failed  REAL NOT NULL,
+    next_attempt REAL,
+    PRIMARY KEY (kind, key)
+)
+"""
+
+
+def categorize(error):
+    """Category name for an exception raised while sending a record"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        if status == 429:
+            return 'rate_limited'
+        if status >= 500:
+            return 'server_error'
+        if status in (401, 403):
+            return 'auth'
+        if status == 404:
+            return 'not_found'
+        return 'rejected'
+    # Checked first: requests' ConnectTimeout is also a ConnectionError
+    if isinstance(error, error_types().timeout):
+        return 'timeout'
+    if isinstance(error, error_types().connection):
+        return 'connection'
+    return 'error'
+
+
+def backoff(attempts):
+    """Seconds until a transient entry that has failed attempts times is due"""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+class QueuedRecord:
+    __slots__ = ('kind', 'key', 'record', 'category', 'error', 'attempts', 'next_attempt')
+
+    def __init__(self, kind, key, record, category, error, attempts, next_attempt):
+        self.kind = kind
+        self.key = key
+        self.record = record
+        self.category = category
+        self.error = error
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+
+
+class RetryQueue:
+    """Failed records keyed by (kind, key), e.g. ('invoice', '812')"""
+
+    def __init__(self, path=DEFAULT_QUEUE_FILE):
+        self.path = path
+        self.added = 0
+        self.resolved = 0
+        self.conn = sqlite3.connect(path)
+        # WAL + NORMAL: each add is durable across a crash of this process
+        # without an fsync per record
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(_SCHEMA)
+        self.conn.commit()
+
+    def add(self, kind, key, record, error, category=None):
+        """Queue (or re-queue) a failed record; returns its category"""
+        category = category or categorize(error)
+        now = time.time()
+        row = self.conn.execute('SELECT attempts, first_failed FROM failed_records WHERE kind = ? AND key = ?',
+                                (kind, str(key))).fetchone()
+        attempts, first_failed = (row[0] + 1, row[1]) if row else (1, now)
+        next_attempt = now + backoff(attempts) if category in TRANSIENT else None
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO failed_records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, str(key), json_codec.dumps_text(record), category, str(error)[:500],
+                 attempts, first_failed, now, next_attempt))
+        self.added += 1
+        return category
+
+    def resolve(self, kind, key):
+        """Remove a record that has now been written"""
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM failed_records WHERE kind = ? AND key = ?', (kind, str(key)))
+        self.resolved += cursor.rowcount
+
+    def due(self, kinds, mode='transient'):
+        """Entries of the given kinds to replay now.
+
+        mode 'transient': transient entries whose backoff has passed;
+        mode 'all': every entry.
+        """
+        marks = ','.join('?' * len(kinds))
+        sql = f'SELECT * FROM failed_records WHERE kind IN ({marks})'
+        params = list(kinds)
+        if mode != 'all':
+            sql += f" AND category IN ({','.join('?' * len(TRANSIENT))}) AND next_attempt <= ?"
+            params += list(TRANSIENT) + [time.time()]
+        rows = self.conn.execute(sql + ' ORDER BY first_failed', params).fetchall()
+        return [QueuedRecord(kind, key, json_codec.loads(record), category, error, attempts, next_attempt)
+                for kind, key, record, category, error, attempts, _, _, next_attempt in rows]
+
+    def counts(self, kinds=KINDS):
+        """{(kind, category): entries}"""
+        marks = ','.join('?' * len(kinds))
+        rows = self.conn.execute(f'SELECT kind, category, COUNT(*) FROM failed_records '
+                                 f'WHERE kind IN ({marks}) GROUP BY kind, category', list(kinds))
+        return {(kind, category): count for kind, category, count in rows}
+
+    def next_due(self, kinds=KINDS):
+        """When the next transient entry of these kinds becomes due (None if none)"""
+        marks = ','.join('?' * len(kinds))
+        row = self.conn.execute(f'SELECT MIN(next_attempt) FROM failed_records WHERE kind IN ({marks}) '
+                                f'AND next_attempt IS NOT NULL', list(kinds)).fetchone()
+        return row[0]
+
+    def clear(self, kind=None):
+        with self.conn:
+            if kind:
+                return self.conn.execute('DELETE FROM failed_records WHERE kind = ?', (kind,)).rowcount
+            return self.conn.execute('DELETE FROM failed_records').rowcount
+
+    def log_summary(self, kinds, script):
+        """Log what this run queued and what is still waiting"""
+        counts = self.counts(kinds)
+        if not counts:
+            if self.resolved:
+                logger.info(f"Retry queue: {self.resolved} records replayed, none left")
+            return
+        total = sum(counts.values())
+        logger.info(f"Retry queue ({self.path}): {self.added} failures recorded this run, "
+                    f"{self.resolved} replayed, {total} waiting")
+        for (kind, category), count in sorted(counts.items()):
+            kind_type = 'transient' if category in TRANSIENT else 'permanent'
+            logger.info(f"  {kind:8} {category:13} {count:>6}  ({kind_type})")
+        logger.info(f"  Replay with: python {script} --retry-failed "
+                    f"(or --retry-failed all once permanent errors are fixed)")
+
+    def close(self):
+        self.conn.close()
+
+
+def open_queue(config):
+    """RetryQueue at RETRY_QUEUE_FILE from config.py"""
+    return RetryQueue(getattr(config, 'RETRY_QUEUE_FILE', DEFAULT_QUEUE_FILE))
+
+
+def log_replay_start(queue, entries, kinds, mode):
+    """Log what a --retry-failed run is about to replay"""
+    if entries:
+        logger.info(f"Replaying {len(entries)} queued records ({mode}) from {queue.path}")
+        return
+    logger.info(f"Nothing to replay ({mode}) in {queue.path}")
+    next_due = queue.next_due(kinds)
+    if mode == 'transient' and next_due:
+        logger.info(f"  Next transient entry is due at {datetime.fromtimestamp(next_due):%H:%M:%S}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspect or clear the retry queue of failed import records',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--file', default=None, help='Queue file')
+    parser.add_argument('--list', choices=KINDS, help='List entries of one kind')
+    parser.add_argument('--clear', nargs='?', const='', choices=('',) + KINDS, metavar='KIND',
+                        help='Delete all entries, or all entries of one kind')
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import config
+            path = getattr(config, 'RETRY_QUEUE_FILE', DEFAULT_QUEUE_FILE)
+        except ImportError:
+            path = DEFAULT_QUEUE_FILE
+
+    if not os.path.exists(path):
+        print(f"No retry queue at {path}")
+        return
+
+    queue = RetryQueue(path)
+    if args.clear is not None:
+        print(f"Deleted {queue.clear(args.clear or None)} entries from {path}")
+        return
+
+    if args.list:
+        for entry in queue.due((args.list,), mode='all'):
+            due = (datetime.fromtimestamp(entry.next_attempt).strftime('%Y-%m-%d %H:%M')
+                   if entry.next_attempt else '-')
+            print(f"{entry.key:>12}  {entry.category:13} attempts {entry.attempts}  due {due}  {entry.error}")
+        return
+
+    counts = queue.counts()
+    if not counts:
+        print(f"{path}: empty")
+        return
+    for (kind, category), count in sorted(counts.items()):
+        kind_type = 'transient' if category in TRANSIENT else 'permanent'
+        print(f"{kind:8} {category:13} {count:>8}  {kind_type}")
+    print(f"{'total':22} {sum(counts.values()):>8}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(0)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Rollback of an import: delete the records it created in the new UISP
+
+Reads the new-UISP IDs the importers recorded and deletes them in reverse
+dependency order, so nothing is deleted while records still point at it:
+
+    payments -> invoices -> services -> clients
+
+Each kind is deleted with up to --concurrency requests in flight (newest
+first), and requests are started at no more than --rate per second.
+
+The IDs come from the staging database (import_status rows with status
+'created'; see staging.py) or, with --audit, from the *_created events of
+audit files. Records that were there before the import (found by a
+crawl, not created) are never touched.
+
+A rollback is resumable. With staging.db, each deleted record is marked
+'rolled_back' at once: a re-run skips it, and the next import run creates
+it again. An ID that is already gone (404) counts as deleted, so re-running
+a rollback from audit files is safe too. Records that could not be deleted
+stay recorded; run the rollback again to retry them.
+
+--kinds always takes the kinds that depend on the ones named along: invoice
+brings payment, client brings service, invoice and payment. Otherwise a
+deleted parent would leave its children recorded as created (and skipped by
+the next import). Payments alone can be rolled back: import_invoices.py
+posts them again for the invoices that are still there. Services alone
+cannot, since import_clients.py does not revisit imported clients.
+
+Usage:
+    python rollback.py --dry-run                       # What would be deleted
+    python rollback.py --yes                           # Undo every import recorded in staging.db
+    python rollback.py --kinds payment,invoice --yes   # Undo import_invoices.py only
+    python rollback.py --audit import_invoices_*_audit.ndjson --yes
+
+Options:
+    --dry-run           Count the records that would be deleted, send nothing
+    --yes               Really delete (required unless --dry-run)
+    --kinds A,B         Kinds to roll back: payment, invoice, service, client (default: all;
+                        dependent kinds are added, see above)
+    --audit FILE...     Read the created IDs from these audit files instead of staging.db
+    --concurrency N     Deletes in flight (default: UISP_MAX_CONNECTIONS, 10)
+    --rate N            Deletes started per second at most (default: ROLLBACK_RATE, 20; 0 = no limit)
+    --metrics-out FILE  Write per-endpoint request metrics (.json or .prom)
+    --verbose           Log every deleted record
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+import audit_log
+import log_setup
+import metrics
+import staging
+from uisp_api import UISPApi, map_concurrent, client_options
+
+logger = logging.getLogger(__name__)
+
+# Reverse dependency order: a kind is deleted after every kind that refers to it
+KINDS = ('payment', 'invoice', 'service', 'client')
+
+ENDPOINTS = {
+    'payment': '/payments/{}',
+    'invoice': '/invoices/{}',
+    'service': '/clients/services/{}',
+    'client': '/clients/{}',
+}
+
+# Kinds whose records point at records of this kind
+DEPENDENTS = {
+    'client': ('service', 'invoice', 'payment'),
+    'invoice': ('payment',),
+}
+
+DEFAULT_RATE = 20
+
+
+class RateLimiter:
+    """Spaces request starts at least 1/rate seconds apart, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def kinds_arg(value):
+    kinds = [k.strip() for k in value.split(',') if k.strip()]
+    unknown = [k for k in kinds if k not in KINDS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown kind(s): {', '.join(unknown)} (kinds: {', '.join(KINDS)})")
+    if 'service' in kinds and 'client' not in kinds:
+        raise argparse.ArgumentTypeError("services are only rolled back with their clients "
+                                         "(import_clients.py does not re-create them)")
+    return kinds
+
+
+def with_dependents(kinds):
+    """kinds plus every kind that depends on them, in deletion order"""
+    expanded = set(kinds)
+    for kind in kinds:
+        expanded.update(DEPENDENTS.get(kind, ()))
+    return [kind for kind in KINDS if kind in expanded]
+
+
+def created_from_audit(paths):
+    """{kind: [(key, new_id)]} from the *_created events of audit files, newest first"""
+    created = {kind: [] for kind in KINDS}
+    for path in paths:
+        for entry in audit_log.read_events(path, {f'{kind}_created' for kind in KINDS}):
+            if entry.get('new_id') is None:
+                continue
+            kind = entry['event'][:-len('_created')]
+            key = entry.get('original_id') or entry.get('old_id') or entry.get('old_invoice_id') or entry['new_id']
+            created[kind].append((str(key), entry['new_id']))
+    return {kind: records[::-1] for kind, records in created.items()}
+
+
+def created_from_staging(stage):
+    return {kind: stage.created_records(kind) for kind in KINDS}
+
+
+def delete_kind(api, kind, records, concurrency=1, limiter=None, stage=None, verbose=False):
+    """Delete records [(key, new_id)] of one kind; returns (deleted, already gone, failed)"""
+    endpoint = ENDPOINTS[kind]
+    stats = {'deleted': 0, 'gone': 0, 'failed': 0}
+    start_time = time.time()
+
+    def delete(record):
+        if limiter:
+            limiter.wait()
+        return api.delete(endpoint.format(record[1]))
+
+    for i, ((key, new_id), _, error) in enumerate(map_concurrent(delete, records, concurrency), 1):
+        if error is None or getattr(error, 'status_code', None) == 404:
+            outcome = 'deleted' if error is None else 'gone'
+            stats[outcome] += 1
+            if stage:
+                stage.record_rolled_back(kind, key, new_id)
+            audit_log.event(f'{kind}_deleted', key=key, new_id=new_id, already_gone=error is not None)
+            if verbose:
+                logger.info(f"  [{i}/{len(records)}] {kind} {new_id} {outcome}")
+        else:
+            stats['failed'] += 1
+            audit_log.event(f'{kind}_delete_failed', key=key, new_id=new_id, error=str(error)[:200])
+            logger.error(f"  [{i}/{len(records)}] Failed to delete {kind} {new_id}: {error}")
+
+        if i % 200 == 0:
+            elapsed = time.time() - start_time
+            logger.info(f"  {kind}s: {i}/{len(records)} ({i / elapsed:.1f}/s) | "
+                        f"API: {metrics.collector.progress_line()}")
+    return stats
+
+
+def main():
+    log_setup.start_run('rollback', audit=True)
+    parser = argparse.ArgumentParser(
+        description='Delete the records an import created in the new UISP',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Count what would be deleted, send nothing')
+    parser.add_argument('--yes', action='store_true',
+                        help='Really delete the records (required unless --dry-run)')
+    parser.add_argument('--kinds', type=kinds_arg, default=list(KINDS), metavar='A,B',
+                        help=f"Kinds to roll back (default: {','.join(KINDS)})")
+    parser.add_argument('--audit', nargs='+', default=None, metavar='FILE',
+                        help='Read the created IDs from these audit files instead of staging.db')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='Deletes in flight (default: UISP_MAX_CONNECTIONS)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Deletes started per second at most (default: ROLLBACK_RATE, 20; 0 = no limit)')
+    parser.add_argument('--metrics-out', type=str, default=None,
+                        help='Write request metrics to FILE (.prom for Prometheus text, else JSON)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Log every deleted record')
+    args = parser.parse_args()
+    metrics.write_summary_at_exit(args.metrics_out)
+
+    try:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import config
+    except ImportError:
+        logger.error("config.py not found. Ensure it exists in the scripts directory.")
+        sys.exit(1)
+
+    stage = staging.open_staging(config)
+    if args.audit:
+        created = created_from_audit(args.audit)
+        source = ', '.join(args.audit)
+    elif stage:
+        if stage.cleared_new:
+            logger.warning(f"UISP_BASE_URL changed: {stage.path} holds no IDs of this UISP")
+        created = created_from_staging(stage)
+        source = stage.path
+    else:
+        logger.error("No staging database (STAGING_DB is None): pass the import's audit files with --audit")
+        sys.exit(1)
+
+    kinds = with_dependents(args.kinds)
+    added = [kind for kind in kinds if kind not in args.kinds]
+    if added:
+        logger.info(f"Rolling back their dependent {', '.join(added)} records too")
+    logger.info(f"Records created in {config.UISP_BASE_URL} (from {source}):")
+    for kind in kinds:
+        logger.info(f"  {kind + 's':10} {len(created[kind]):>8}")
+    total = sum(len(created[kind]) for kind in kinds)
+    if not total:
+        logger.info("Nothing to roll back")
+        return
+    if args.dry_run:
+        logger.info(f"DRY RUN: {total} records would be deleted")
+        return
+    if not args.yes:
+        logger.error(f"Refusing to delete {total} records without --yes (see --dry-run)")
+        sys.exit(1)
+
+    api = UISPApi(config.UISP_BASE_URL, config.UISP_API_TOKEN,
+                  verify_ssl=getattr(config, 'VERIFY_SSL', False), **client_options(config))
+    if not api.test_connection():
+        logger.error("Cannot connect to new UISP.")
+        sys.exit(1)
+
+    concurrency = args.concurrency or getattr(config, 'UISP_MAX_CONNECTIONS', 10)
+    rate = args.rate if args.rate is not None else getattr(config, 'ROLLBACK_RATE', DEFAULT_RATE)
+    limiter = RateLimiter(rate)
+    logger.info(f"Deleting {total} records ({concurrency} in flight, "
+                f"{f'{rate:g}/s at most' if rate else 'no rate limit'})...")
+
+    start_time = time.time()
+    failed = 0
+    for kind in kinds:
+        if not created[kind]:
+            continue
+        logger.info(f"\n=== Deleting {len(created[kind])} {kind}s ===")
+        stats = delete_kind(api, kind, created[kind], concurrency, limiter, stage, args.verbose)
+        failed += stats['failed']
+        logger.info(f"  {kind}s deleted: {stats['deleted']}, already gone: {stats['gone']}, "
+                    f"failed: {stats['failed']}")
+
+    logger.info("\n" + "=" * 60)
+    logger.info(f"Rollback finished in {(time.time() - start_time) / 60:.1f} minutes, {failed} failed")
+    if failed:
+        logger.info("Run rollback.py again to retry the records that could not be deleted")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
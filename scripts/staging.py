@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Staging database: the local copy of everything the migration has read or written
+
+Without it each script rebuilds its own dicts (client mapping, service map,
+PPPoE map, invoice list) from the CSV or the APIs on every run. With it
+(STAGING_DB in config.py, default staging.db; None turns it off) they share
+one SQLite file with indexed tables:
+
+    csv_clients, csv_services   the parsed CSV (re-parsed only when the file changes)
+    client_duplicates           duplicate -> primary original ID (import_clients.py --dedupe skip/merge)
+    old_records                 old-UISP exports: invoices, services, plans (by kind, id, clientId)
+    old_pppoe                   old client ID -> PPPoE username
+    new_ids                     old key -> new-UISP ID (clients by userIdent, invoices, payments)
+    new_services                new-UISP services (by ID and client ID)
+    import_status               per-record outcome of every import (created, failed, updated, rolled_back)
+    datasets                    when each snapshot was taken and from what
+
+A snapshot that was fetched in full is reused by the next run instead of
+crawling the API again (--refresh fetches it anew); records the importers
+create are added to it as they go. Records already imported (status
+'created' or 'updated') are skipped, so an interrupted run is restarted by
+running it again.
+
+The new-UISP tables belong to one instance: they are cleared when
+UISP_BASE_URL changes. Clear them by hand after resetting the new UISP.
+
+Usage:
+    python staging.py                   # Tables, snapshots and import status counts
+    python staging.py --client 1523     # One old client: CSV, new ID, services, invoices, PPPoE
+    python staging.py --clear new       # Forget the new-UISP side (IDs, services, statuses)
+
+Options:
+    --file PATH        Staging file (default: STAGING_DB from config.py, or staging.db)
+    --client ID        Trace one old client ID across every table
+    --clear [SIDE]     Delete everything, or one side: csv, old or new
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import json_codec
+
+DEFAULT_STAGING_FILE = 'staging.db'
+
+SIDES = ('csv', 'old', 'new')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    name   TEXT PRIMARY KEY,
+    source TEXT,
+    count  INTEGER NOT NULL,
+    saved  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS csv_clients (
+    original_id TEXT NOT NULL,
+    position    INTEGER PRIMARY KEY,
+    record      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS csv_clients_id ON csv_clients (original_id);
+CREATE TABLE IF NOT EXISTS csv_services (
+    original_id TEXT NOT NULL,
+    position    INTEGER NOT NULL,
+    name        TEXT,
+    record      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS csv_services_client ON csv_services (original_id);
+CREATE TABLE IF NOT EXISTS client_duplicates (
+    original_id TEXT PRIMARY KEY,
+    primary_id  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS old_records (
+    kind      TEXT NOT NULL,
+    id        INTEGER NOT NULL,
+    client_id INTEGER,
+    position  INTEGER NOT NULL,
+    record    TEXT NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS old_records_client ON old_records (kind, client_id);
+CREATE TABLE IF NOT EXISTS old_pppoe (
+    client_id TEXT PRIMARY KEY,
+    username  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS new_ids (
+    kind    TEXT NOT NULL,
+    old_key TEXT NOT NULL,
+    new_id  INTEGER NOT NULL,
+    PRIMARY KEY (kind, old_key)
+);
+CREATE INDEX IF NOT EXISTS new_ids_new ON new_ids (kind, new_id);
+CREATE TABLE IF NOT EXISTS new_services (
+    id         INTEGER PRIMARY KEY,
+    client_id  INTEGER,
+    name       TEXT,
+    status     INTEGER,
+    attributes TEXT
+);
+CREATE INDEX IF NOT EXISTS new_services_client ON new_services (client_id);
+CREATE TABLE IF NOT EXISTS import_status (
+    kind    TEXT NOT NULL,
+    key     TEXT NOT NULL,
+    status  TEXT NOT NULL,
+    new_id  INTEGER,
+    error   TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS import_status_status ON import_status (kind, status);
+"""
+
+# Tables (and dataset name prefixes) of each side, for clear()
+_SIDE_TABLES = {
+    'csv': ('csv_clients', 'csv_services', 'client_duplicates'),
+    'old': ('old_records', 'old_pppoe'),
+    'new': ('new_ids', 'new_services', 'import_status'),
+}
+
+# Statuses of records that must not be sent again
+DONE_STATUSES = ('created', 'updated')
+
+
+def file_signature(path):
+    """Size and mtime of a source file, to tell whether a staged parse is current"""
+    st = os.stat(path)
+    return f'{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}'
+
+
+class StagingDB:
+    """The staging SQLite file. Not thread-safe: use it from the main thread only."""
+
+    def __init__(self, path=DEFAULT_STAGING_FILE, new_url=None):
+        self.path = path
+        # migrate.py runs importers side by side: wait for each other's writes
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        self.cleared_new = False
+        if new_url:
+            self._check_target(new_url.rstrip('/'))
+        self.conn.commit()
+
+    def _check_target(self, new_url):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'new_url'").fetchone()
+        if row and row[0] != new_url:
+            self.clear('new')
+            self.cleared_new = True
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('new_url', ?)", (new_url,))
+
+    # --- snapshots --------------------------------------------------------
+
+    def _mark(self, name, count, source=None):
+        self.conn.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?)',
+                          (name, source, count, time.time()))
+
+    def dataset(self, name):
+        """(source, count, saved) of a snapshot, or None if it was never taken in full"""
+        return self.conn.execute('SELECT source, count, saved FROM datasets WHERE name = ?',
+                                 (name,)).fetchone()
+
+    def describe(self, name):
+        """'N records from <time>' for log lines"""
+        _, count, saved = self.dataset(name)
+        return f"{count} records staged {datetime.fromtimestamp(saved):%Y-%m-%d %H:%M}"
+
+    # --- CSV --------------------------------------------------------------
+
+    def csv_current(self, csv_path):
+        row = self.dataset('csv')
+        return row is not None and row[0] == file_signature(csv_path)
+
+    def save_csv(self, csv_path, clients):
+        """Stage parsed CSV clients (with their services)"""
+        with self.conn:
+            self.conn.execute('DELETE FROM csv_clients')
+            self.conn.execute('DELETE FROM csv_services')
+            self.conn.executemany(
+                'INSERT INTO csv_clients VALUES (?, ?, ?)',
+                ((str(c.get('original_id')), n, json_codec.dumps_text(c)) for n, c in enumerate(clients)))
+            self.conn.executemany(
+                'INSERT INTO csv_services VALUES (?, ?, ?, ?)',
+                ((str(c.get('original_id')), n, s.get('name'), json_codec.dumps_text(s))
+                 for c in clients for n, s in enumerate(c.get('services', []))))
+            self._mark('csv', len(clients), file_signature(csv_path))
+
+    def csv_clients(self):
+        """Staged CSV clients in file order (services included, as parsed)"""
+        rows = self.conn.execute('SELECT record FROM csv_clients ORDER BY position')
+        return [json_codec.loads(record) for record, in rows]
+
+    def replace_duplicates(self, links):
+        """Stage {duplicate original ID: primary original ID} of the last import run"""
+        with self.conn:
+            self.conn.execute('DELETE FROM client_duplicates')
+            self.conn.executemany('INSERT INTO client_duplicates VALUES (?, ?)',
+                                  ((str(dup), str(primary)) for dup, primary in links.items()))
+
+    def client_duplicates(self):
+        return dict(self.conn.execute('SELECT original_id, primary_id FROM client_duplicates'))
+
+    # --- old UISP ---------------------------------------------------------
+
+    def replace_old(self, kind, records):
+        """Stage a complete old-UISP export of one kind ('invoice', 'service', 'plan')"""
+        with self.conn:
+            self.conn.execute('DELETE FROM old_records WHERE kind = ?', (kind,))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO old_records VALUES (?, ?, ?, ?, ?)',
+                ((kind, r['id'], r.get('clientId'), n, json_codec.dumps_text(r)) for n, r in enumerate(records)))
+            self._mark(f'old_{kind}', len(records))
+
+    def old_records(self, kind):
+        rows = self.conn.execute('SELECT record FROM old_records WHERE kind = ? ORDER BY position', (kind,))
+        return [json_codec.loads(record) for record, in rows]
+
+    def replace_pppoe(self, mapping):
+        """Stage {old_client_id: pppoe_username}"""
+        with self.conn:
+            self.conn.execute('DELETE FROM old_pppoe')
+            self.conn.executemany('INSERT INTO old_pppoe VALUES (?, ?)', mapping.items())
+            self._mark('old_pppoe', len(mapping))
+
+    def pppoe_mapping(self):
+        return dict(self.conn.execute('SELECT client_id, username FROM old_pppoe'))
+
+    # --- new UISP ---------------------------------------------------------
+
+    def replace_mapping(self, kind, mapping):
+        """Stage a complete {old_key: new_id} mapping crawled from new UISP"""
+        with self.conn:
+            self.conn.execute('DELETE FROM new_ids WHERE kind = ?', (kind,))
+            self.conn.executemany('INSERT INTO new_ids VALUES (?, ?, ?)',
+                                  ((kind, str(key), new_id) for key, new_id in mapping.items()))
+            self._mark(f'new_{kind}', len(mapping))
+
+    def mapping(self, kind):
+        """{old_key: new_id} of one kind"""
+        return dict(self.conn.execute('SELECT old_key, new_id FROM new_ids WHERE kind = ?', (kind,)))
+
+    def replace_new_services(self, services):
+        """Stage every new-UISP service (a complete /clients/services crawl)"""
+        with self.conn:
+            self.conn.execute('DELETE FROM new_services')
+            self._insert_services(services)
+            self._mark('new_service', len(services))
+
+    def add_new_services(self, services):
+        """Stage services created by this run"""
+        with self.conn:
+            self._insert_services(services)
+
+    def _insert_services(self, services):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO new_services VALUES (?, ?, ?, ?, ?)',
+            ((s['id'], s.get('clientId'), s.get('servicePlanName', s.get('name')), s.get('status'),
+              json_codec.dumps_text(s.get('attributes') or [])) for s in services))
+
+    def service_mapping(self):
+        """{new_client_id: [service dicts]} as import_pppoe.build_service_mapping returns"""
+        mapping = {}
+        rows = self.conn.execute('SELECT id, client_id, name, status, attributes FROM new_services ORDER BY id')
+        for service_id, client_id, name, status, attributes in rows:
+            if client_id:
+                mapping.setdefault(client_id, []).append({
+                    'id': service_id, 'name': name or '?', 'status': status,
+                    'attributes': json_codec.loads(attributes),
+                })
+        return mapping
+
+    # --- import status ----------------------------------------------------
+
+    def record(self, kind, key, status, new_id=None, error=None):
+        """Record the outcome of importing one record; a created record also gets its new ID"""
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO import_status VALUES (?, ?, ?, ?, ?, ?)',
+                              (kind, str(key), status, new_id, str(error)[:500] if error else None,
+                               time.time()))
+            if new_id is not None and status == 'created':
+                self.conn.execute('INSERT OR REPLACE INTO new_ids VALUES (?, ?, ?)', (kind, str(key), new_id))
+
+    def done_keys(self, kind):
+        """Keys of the records of one kind that were already written to new UISP"""
+        marks = ','.join('?' * len(DONE_STATUSES))
+        rows = self.conn.execute(f'SELECT key FROM import_status WHERE kind = ? AND status IN ({marks})',
+                                 (kind,) + DONE_STATUSES)
+        return {key for key, in rows}
+
+    def keys_with_status(self, kind, status):
+        """Keys of the records of one kind with this import status"""
+        rows = self.conn.execute('SELECT key FROM import_status WHERE kind = ? AND status = ?', (kind, status))
+        return {key for key, in rows}
+
+    def created_records(self, kind):
+        """[(key, new_id)] of the records of one kind this tool's imports created, newest first"""
+        return self.conn.execute("SELECT key, new_id FROM import_status WHERE kind = ? AND status = 'created' "
+                                 "AND new_id IS NOT NULL ORDER BY updated DESC", (kind,)).fetchall()
+
+    def record_rolled_back(self, kind, key, new_id):
+        """A created record was deleted again: an import run creates it anew"""
+        with self.conn:
+            self.conn.execute("UPDATE import_status SET status = 'rolled_back', error = NULL, updated = ? "
+                              "WHERE kind = ? AND key = ?", (time.time(), kind, str(key)))
+            self.conn.execute('DELETE FROM new_ids WHERE kind = ? AND new_id = ?', (kind, new_id))
+            if kind == 'service':
+                self.conn.execute('DELETE FROM new_services WHERE id = ?', (new_id,))
+
+    def status_counts(self):
+        """{(kind, status): records}"""
+        rows = self.conn.execute('SELECT kind, status, COUNT(*) FROM import_status GROUP BY kind, status')
+        return {(kind, status): count for kind, status, count in rows}
+
+    # --- joins ------------------------------------------------------------
+
+    def client_trace(self, old_client_id):
+        """Everything staged about one old client: invoice -> client -> service -> PPPoE"""
+        key = str(old_client_id)
+        q = self.conn.execute
+        row = q('SELECT record FROM csv_clients WHERE original_id = ?', (key,)).fetchone()
+        new_client = q("SELECT new_id FROM new_ids WHERE kind = 'client' AND old_key = ?", (key,)).fetchone()
+        new_client_id = new_client[0] if new_client else None
+        pppoe = q('SELECT username FROM old_pppoe WHERE client_id = ?', (key,)).fetchone()
+        invoices = q("SELECT r.id, r.record, s.status, s.new_id FROM old_records r "
+                     "LEFT JOIN import_status s ON s.kind = 'invoice' AND s.key = CAST(r.id AS TEXT) "
+                     "WHERE r.kind = 'invoice' AND r.client_id = ? ORDER BY r.position",
+                     (int(key) if key.isdigit() else key,)).fetchall()
+        services = q("SELECT v.id, v.name, v.status, v.attributes, s.status FROM new_services v "
+                     "LEFT JOIN import_status s ON s.kind = 'pppoe' AND s.key = CAST(v.id AS TEXT) "
+                     "WHERE v.client_id = ? ORDER BY v.id", (new_client_id,)).fetchall()
+        return {
+            'csv_client': json_codec.loads(row[0]) if row else None,
+            'new_client_id': new_client_id,
+            'pppoe': pppoe[0] if pppoe else None,
+            'new_services': [{'id': i, 'name': n, 'status': s, 'attributes': json_codec.loads(a),
+                              'pppoe_status': p} for i, n, s, a, p in services],
+            'invoices': [{'id': i, 'invoice': json_codec.loads(r), 'status': s, 'new_id': n}
+                         for i, r, s, n in invoices],
+        }
+
+    # --- maintenance ------------------------------------------------------
+
+    def table_counts(self):
+        tables = [t for side in SIDES for t in _SIDE_TABLES[side]]
+        return {t: self.conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0] for t in tables}
+
+    def clear(self, side=None):
+        """Delete every table of one side (csv, old, new), or everything"""
+        with self.conn:
+            for name in (side,) if side else SIDES:
+                for table in _SIDE_TABLES[name]:
+                    self.conn.execute(f'DELETE FROM {table}')
+                self.conn.execute('DELETE FROM datasets WHERE name = ? OR name LIKE ?', (name, name + '_%'))
+
+    def close(self):
+        self.conn.close()
+
+
+def open_staging(config):
+    """StagingDB at STAGING_DB from config.py (None when it is turned off)"""
+    path = getattr(config, 'STAGING_DB', DEFAULT_STAGING_FILE)
+    if not path:
+        return None
+    return StagingDB(path, getattr(config, 'UISP_BASE_URL', None))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Inspect or clear the migration staging database',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__
+    )
+    parser.add_argument('--file', default=None, help='Staging file')
+    parser.add_argument('--client', default=None, metavar='ID', help='Trace one old client ID')
+    parser.add_argument('--clear', nargs='?', const='', choices=('',) + SIDES, metavar='SIDE',
+                        help='Delete everything, or one side: csv, old or new')
+    args = parser.parse_args()
+
+    path = args.file
+    if path is None:
+        try:
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import config
+            path = getattr(config, 'STAGING_DB', DEFAULT_STAGING_FILE) or DEFAULT_STAGING_FILE
+        except ImportError:
+            path = DEFAULT_STAGING_FILE
+
+    if not os.path.exists(path):
+        print(f"No staging database at {path}")
+        return
+
+    staging = StagingDB(path)
+    if args.clear is not None:
+        staging.clear(args.clear or None)
+        print(f"Cleared {args.clear or 'all tables'} in {path}")
+        return
+
+    if args.client:
+        trace = staging.client_trace(args.client)
+        csv_client = trace['csv_client']
+        name = f"{csv_client['firstName']} {csv_client['lastName']}" if csv_client else '(not in staged CSV)'
+        print(f"Old client {args.client}: {name}")
+        print(f"  New client ID: {trace['new_client_id'] or '-'}")
+        print(f"  PPPoE username (old): {trace['pppoe'] or '-'}")
+        for service in trace['new_services']:
+            pppoe = next((a.get('value') for a in service['attributes'] if a.get('customAttributeId') == 2), None)
+            print(f"  Service {service['id']}: {service['name']} (status {service['status']}, "
+                  f"pppoe {pppoe or '-'}, PPPoE import {service['pppoe_status'] or '-'})")
+        for inv in trace['invoices']:
+            print(f"  Invoice {inv['id']} #{inv['invoice'].get('number', '?')} "
+                  f"total {inv['invoice'].get('total', 0)}: {inv['status'] or 'not imported'}"
+                  f"{' -> ' + str(inv['new_id']) if inv['new_id'] else ''}")
+        return
+
+    print(f"{path}")
+    for table, count in staging.table_counts().items():
+        print(f"  {table:15} {count:>8}")
+    rows = staging.conn.execute('SELECT name, count, saved FROM datasets ORDER BY name').fetchall()
+    if rows:
+        print("Snapshots:")
+        for name, count, saved in rows:
+            print(f"  {name:15} {count:>8}  {datetime.fromtimestamp(saved):%Y-%m-%d %H:%M}")
+    counts = staging.status_counts()
+    if counts:
+        print("Import status:")
+        for (kind, status), count in sorted(counts.items()):
+            print(f"  {kind:8} {status:8} {count:>8}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(0)
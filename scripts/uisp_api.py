@@ -0,0 +1,422 @@
+"""
+Shared UISP CRM API client
+
+Generic client used by the export/import scripts. Every HTTP attempt
+(including rate-limited and failed ones) is recorded in the metrics
+collector so per-endpoint latency and throughput can be reported.
+
+Two transports are available, chosen with UISP_TRANSPORT in config.py:
+
+* requests (default) - HTTP/1.1, one request per connection at a time
+* httpx - connection pool with HTTP/2 multiplexing (pip install 'httpx[http2]'),
+  so concurrent writes (--concurrency) share a few connections
+
+GETs go through the on-disk response cache (response_cache) when
+UISP_CACHE_TTL is set; writes invalidate the cached resources they touch.
+
+Timeouts, retries (jittered backoff, retry budget) and the circuit breaker
+follow the RetryPolicy in retry_policy.
+
+requests and httpx are imported on first use, so importing this module is
+cheap and has no side effects.
+"""
+
+import atexit
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import json_codec
+import metrics
+import profiling
+import response_cache
+import retry_policy
+from lazy_import import lazy_import
+
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
+httpx = lazy_import('httpx')  # optional: only needed for UISP_TRANSPORT = 'httpx'
+
+logger = logging.getLogger(__name__)
+
+TRANSPORTS = ('requests', 'httpx')
+
+ErrorTypes = namedtuple('ErrorTypes', 'connection timeout transport')
+
+
+@functools.lru_cache(maxsize=None)
+def error_types():
+    """Exception classes, for whichever backend is used, of errors that mean
+    "the request never got an answer" (connection), timeouts, and any
+    transport-level failure (recorded in metrics)"""
+    connection = (requests.exceptions.ConnectionError,)
+    timeout = (requests.exceptions.Timeout,)
+    transport = (requests.exceptions.RequestException,)
+    if httpx is not None:
+        connection += (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+        timeout += (httpx.TimeoutException,)
+        transport += (httpx.HTTPError,)
+    return ErrorTypes(connection, timeout, transport)
+
+
+class UISPApiError(Exception):
+    """UISP answered with an HTTP error status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UISPApiError):
+    """Not sent: the circuit breaker is open after repeated failures"""
+
+    def __init__(self, message):
+        super().__init__(message, 503)
+
+
+def request_not_sent(error):
+    """True if a transport error happened before the request reached UISP,
+    so even a POST can safely be sent again"""
+    if httpx is not None and isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # Refused/unreachable: urllib3 wraps a NewConnectionError in MaxRetryError
+        reason = getattr(error.args[0], 'reason', None)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def client_options(config):
+    """UISPApi keyword arguments for the transport, cache and retry settings in config.py"""
+    cache_dir, cache_ttl = response_cache.cache_options(config)
+    return {
+        'transport': getattr(config, 'UISP_TRANSPORT', 'requests'),
+        'http2': getattr(config, 'UISP_HTTP2', True),
+        'max_connections': getattr(config, 'UISP_MAX_CONNECTIONS', 10),
+        'cache_dir': cache_dir,
+        'cache_ttl': cache_ttl,
+        'policy': retry_policy.policy_from_config(config),
+    }
+
+
+def map_concurrent(func, items, workers=1):
+    """Call func(item) for each item on up to workers threads.
+
+    Yields (item, result, error) in input order; error is the exception
+    func raised, or None. items is consumed lazily on the calling thread,
+    a few batches ahead of the results, so it can be a generator that does
+    its own skipping and bookkeeping. workers <= 1 runs inline.
+    """
+    if workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    def outcome(item, future):
+        try:
+            return item, future.result(), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uisp') as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= workers * 4:
+                yield outcome(*pending.popleft())
+        while pending:
+            yield outcome(*pending.popleft())
+
+
+class RecordStream:
+    """Records of a paginated collection, fetched ahead on a background thread.
+
+    Pages go through a queue of at most buffer_pages pages: the fetching
+    thread waits while it is full, so a slow consumer holds back the
+    fetching (backpressure) and memory stays bounded. Iterate it once.
+    A failed fetch ends the stream early; error and next_offset then say
+    why and where to resume.
+    """
+
+    def __init__(self, api, endpoint, page_size=500, offset=0, limit=None, buffer_pages=4):
+        self.api = api
+        self.endpoint = endpoint
+        self.page_size = page_size
+        self.limit = limit
+        self.next_offset = offset
+        self.fetched = 0
+        self.pages = 0
+        self.error = None
+        self.producer_wait = 0.0  # seconds the fetching thread waited on a full queue
+        self.consumer_wait = 0.0  # seconds the consumer waited for a page
+        self._queue = queue.Queue(maxsize=max(1, buffer_pages))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, name='uisp-stream', daemon=True)
+
+    def _produce(self):
+        try:
+            while not self._stop.is_set():
+                batch = min(self.page_size, self.limit - self.fetched) if self.limit else self.page_size
+                if batch <= 0:
+                    break
+                page = self.api.get(f'{self.endpoint}?limit={batch}&offset={self.next_offset}')
+                if page:
+                    self._put(page)
+                self.pages += 1
+                self.fetched += len(page)
+                self.next_offset += len(page)
+                if len(page) < batch:
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def _put(self, page):
+        started = time.time()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(page, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.producer_wait += time.time() - started
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                started = time.time()
+                page = self._queue.get()
+                self.consumer_wait += time.time() - started
+                if page is None:
+                    return
+                yield from page
+        finally:
+            # Also when the consumer stops early: let the fetching thread end
+            self._stop.set()
+
+    def log_summary(self):
+        logger.info(f"Stream of {self.endpoint}: {self.fetched} records in {self.pages} pages; "
+                    f"fetching waited {self.producer_wait:.1f}s on a full queue, "
+                    f"importing waited {self.consumer_wait:.1f}s for pages")
+
+
+def _h2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("HTTP/2 needs the h2 package (pip install 'httpx[http2]'); using HTTP/1.1")
+        return False
+    return True
+
+
+class UISPApi:
+    """Generic UISP CRM API client"""
+
+    def __init__(self, base_url, api_token, verify_ssl=False, metrics_collector=None,
+                 transport='requests', http2=True, max_connections=10,
+                 cache_dir=response_cache.DEFAULT_CACHE_DIR, cache_ttl=None, policy=None):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport} (expected one of {', '.join(TRANSPORTS)})")
+        if transport == 'httpx' and httpx is None:
+            raise RuntimeError("UISP_TRANSPORT = 'httpx' needs httpx (pip install 'httpx[http2]')")
+
+        if not verify_ssl:
+            # Deliberate for self-signed UISP certificates: don't warn on every request
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        self.base_url = base_url.rstrip('/')
+        self.api_token = api_token
+        self.verify_ssl = verify_ssl
+        self.transport = transport
+        self.metrics = metrics_collector or metrics.collector
+        self.policy = policy or retry_policy.RetryPolicy()
+        atexit.register(self.policy.log_summary)
+        headers = {
+            'X-Auth-App-Key': api_token,
+            'Content-Type': 'application/json'
+        }
+
+        if transport == 'httpx':
+            logging.getLogger('httpx').setLevel(logging.WARNING)  # it logs every request at INFO
+            self.session = httpx.Client(
+                headers=headers,
+                verify=verify_ssl,
+                http2=http2 and _h2_available(),
+                timeout=httpx.Timeout(self.policy.read_timeout, connect=self.policy.connect_timeout),
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections),
+            )
+            self._request_options = {}
+        else:
+            self.session = requests.Session()
+            self.session.headers.update(headers)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self._request_options = {'verify': verify_ssl,
+                                     'timeout': (self.policy.connect_timeout, self.policy.read_timeout)}
+
+        # GET response cache (off unless UISP_CACHE_TTL is set)
+        self.cache = None
+        if cache_ttl is not None:
+            self.cache = response_cache.ResponseCache(self.base_url, cache_dir, cache_ttl)
+            atexit.register(self.cache.log_summary)
+
+    def close(self):
+        self.session.close()
+
+    def _body_option(self, data):
+        """Request body pre-encoded with json_codec (Content-Type is a session header)"""
+        if data is None:
+            return {}
+        body = json_codec.dumps(data)
+        return {'content': body} if self.transport == 'httpx' else {'data': body}
+
+    def _send(self, method, endpoint, data=None, headers=None):
+        """Send one HTTP request and record it in the metrics collector"""
+        url = f"{self.base_url}/crm/api/v1.0{endpoint}"
+        start = time.perf_counter()
+        try:
+            with profiling.phase('network_wait'):
+                response = self.session.request(method, url, **self._body_option(data),
+                                                headers=headers, **self._request_options)
+        except error_types().transport as e:
+            self.metrics.record(method, endpoint, type(e).__name__, 0, 0, time.perf_counter() - start)
+            raise
+        request = response.request
+        body = request.content if self.transport == 'httpx' else request.body
+        self.metrics.record(method, endpoint, response.status_code,
+                            len(body) if body else 0, len(response.content),
+                            time.perf_counter() - start)
+        return response
+
+    def _cached_send(self, method, endpoint, data=None):
+        """_send through the response cache.
+
+        Returns (response, cached_body); cached_body is not None when the
+        answer came from the cache (fresh entry or 304 Not Modified).
+        """
+        cache = self.cache
+        if cache is None:
+            return self._send(method, endpoint, data), None
+        if method != 'GET':
+            # After the write (even a failed one may have landed), so GETs
+            # that overlapped it are not served from the cache afterwards
+            try:
+                return self._send(method, endpoint, data), None
+            finally:
+                cache.invalidate(endpoint)
+
+        entry = cache.get(endpoint)
+        if entry is not None and cache.is_fresh(entry):
+            cache.hits += 1
+            return None, entry.body
+
+        # Read before sending: a write that lands meanwhile makes this answer stale
+        generation = cache.generation(endpoint)
+        response = self._send(method, endpoint, headers=entry.validators() if entry else None)
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated += 1
+            cache.touch(endpoint, entry, generation)
+            return None, entry.body
+        if response.status_code == 200:
+            cache.misses += 1
+            cache.put(endpoint, response, generation)
+        return response, None
+
+    def _request(self, method, endpoint, data=None):
+        """Send a request under the retry policy and decode the JSON answer"""
+        policy = self.policy
+        attempt = 0
+        while True:
+            if not policy.breaker.allow():
+                raise CircuitOpenError(f"{method} {endpoint} not sent: circuit breaker open "
+                                       f"(retrying in {policy.breaker.seconds_until_retry():.0f}s)")
+            policy.budget.record_request()
+            try:
+                response, cached = self._cached_send(method, endpoint, data)
+            except error_types().transport as e:
+                policy.breaker.record_failure()
+                if not policy.should_retry(method, attempt, not_sent=request_not_sent(e)):
+                    raise
+                wait = policy.backoff(attempt)
+                logger.warning(f"{method} {endpoint}: {type(e).__name__}, retrying in {wait:.1f}s")
+            else:
+                if cached is not None:
+                    policy.breaker.record_success()
+                    with profiling.phase('json_decode'):
+                        return json_codec.loads(cached) if cached else {}
+
+                status = response.status_code
+                if status >= 500:
+                    policy.breaker.record_failure()
+                else:
+                    # Any other answer (even a 4xx or 429) means UISP is up
+                    policy.breaker.record_success()
+
+                if status < 400:
+                    with profiling.phase('json_decode'):
+                        return json_codec.loads(response.content) if response.content else {}
+                if not policy.should_retry(method, attempt, status=status):
+                    raise UISPApiError(f"HTTP {status}: {response.text[:500]}", status)
+                if status == 429:
+                    wait = policy.retry_after(response, attempt)
+                    logger.warning(f"Rate limited. Waiting {wait:.1f}s...")
+                else:
+                    wait = policy.backoff(attempt)
+                    logger.warning(f"{method} {endpoint}: HTTP {status}, retrying in {wait:.1f}s")
+
+            with profiling.phase('retry_wait'):
+                time.sleep(wait)
+            attempt += 1
+
+    def get(self, endpoint):
+        return self._request('GET', endpoint)
+
+    def post(self, endpoint, data):
+        return self._request('POST', endpoint, data)
+
+    def patch(self, endpoint, data):
+        return self._request('PATCH', endpoint, data)
+
+    def delete(self, endpoint):
+        return self._request('DELETE', endpoint)
+
+    def probe(self, endpoint='/organizations'):
+        """Send one GET with no retries and no cache, for latency measurements.
+
+        Returns (status, seconds, response headers); status is the exception
+        name when no answer came back.
+        """
+        start = time.perf_counter()
+        try:
+            response = self._send('GET', endpoint)
+        except error_types().transport as e:
+            return type(e).__name__, time.perf_counter() - start, {}
+        return response.status_code, time.perf_counter() - start, response.headers
+
+    def test_connection(self):
+        try:
+            # Try /organizations first, fall back to /clients?limit=1
+            try:
+                orgs = self.get('/organizations')
+                logger.info(f"Connected to {self.base_url} ({len(orgs)} org(s))")
+                return True
+            except Exception:
+                self.get('/clients?limit=1')
+                logger.info(f"Connected to {self.base_url} (verified via clients endpoint)")
+                return True
+        except Exception as e:
+            logger.error(f"Connection failed to {self.base_url}: {e}")
+            return False